@@ -0,0 +1,478 @@
+import re
+import time
+import shlex
+import random
+import struct
+import asyncio
+import hashlib
+import click
+from typing import Dict, List, Optional, Tuple
+
+# VARIABLES
+
+props = {
+    'ro.product.model': 'FakeBoard',
+    'ro.product.manufacturer': 'pyADB',
+    'ro.build.version.sdk': '30',
+    'ro.build.version.release': '11',
+    'ro.build.display.id': 'fake-1.0',
+    **{f'persist.fake.property{i}': f'value{i}' for i in range(400)}
+}
+pro_props = {
+    'ro.product.model': 'FakeBoard Pro',
+    'ro.build.version.sdk': '33',
+    'ro.build.version.release': '13',
+    'ro.build.display.id': 'fake-2.0'
+}
+screen = (1920, 1080)
+priorities = 'VDIWEFS'
+tags = ('ActivityManager', 'PackageManager', 'WifiService', 'chromium', 'SurfaceFlinger', 'AudioFlinger')
+
+
+# UTILS
+
+def serial_of(index: int) -> str:
+    """Socket address of the index-th emulated device (starting from 1)"""
+
+    return f'10.{(index >> 16) & 255}.{(index >> 8) & 255}.{index & 255}:5555'
+
+
+def chance(serial: str, salt: str, rate: float) -> bool:
+    """Deterministic coin flip: the same device always gets the same result"""
+
+    digest = hashlib.md5(f'{salt}:{serial}'.encode()).digest()
+    return int.from_bytes(digest[:4], 'little') / 2 ** 32 < rate
+
+
+def block(text: str) -> bytes:
+    """Length-prefixed string of the adb host protocol"""
+
+    data = text.encode()
+    return f'{len(data):04x}'.encode() + data
+
+
+class FakeDevice:
+    """State of an emulated device"""
+
+    def __init__(self, serial: str, connected: bool):
+        self.serial = serial
+        self.connected = connected
+        self.files: Dict[str, Tuple[int, Optional[bytes]]] = dict()
+        self.mtimes: Dict[str, int] = dict()
+        self.hashes: Dict[str, str] = dict()
+        self.packages: Dict[str, int] = dict()
+        self.props = dict(props, **(pro_props if chance(serial, 'pro', 1 / 3) else dict()))
+
+
+class FakeAdbServer:
+    """
+    Emulates an adb server with a fleet of TCP devices. It speaks enough of the
+    host protocol (devices, track-devices, connect, disconnect, transport),
+    of the sync protocol (STAT, LIST, SEND, RECV) and of the exec service
+    (screencap) to run every command of pyADB.
+    Shell commands are interpreted, not executed.
+    """
+
+    def __init__(self, devices: int, connected: bool = False, latency: float = 0.0, bandwidth: float = 0.0,
+                 refuse_rate: float = 0.0, timeout_rate: float = 0.0, fail_rate: float = 0.0, output_size: int = 64,
+                 file_size: int = 1024 * 1024, keep: int = 1024 * 1024, slow_rate: float = 0.0,
+                 log_rate: float = 20.0):
+        self.devices = {serial_of(i): FakeDevice(serial_of(i), connected) for i in range(1, devices + 1)}
+        self.latency = latency
+        self.bandwidth = bandwidth
+        self.refuse_rate = refuse_rate
+        self.timeout_rate = timeout_rate
+        self.fail_rate = fail_rate
+        self.output = 'x' * output_size
+        self.log_rate = log_rate
+        self.keep = keep
+        self.slow = {serial for serial in self.devices if chance(serial, 'slow', slow_rate)}
+        self.trackers: List[asyncio.StreamWriter] = []
+        self.shared = bytes(file_size)
+        shared_hash = hashlib.md5(self.shared).hexdigest()
+        for device in self.devices.values():
+            device.files['/sdcard/bench.bin'] = (file_size, self.shared)
+            device.mtimes['/sdcard/bench.bin'] = 1
+            device.hashes['/sdcard/bench.bin'] = shared_hash
+
+    # HOST PROTOCOL
+
+    async def handle(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+        try:
+            device = None
+            while True:
+                command = await self.read_command(reader)
+                if command is None:
+                    break
+                if device is None and command.startswith('host:transport:'):
+                    device = self.devices.get(command[len('host:transport:'):])
+                    if device is None or not device.connected:
+                        await self.fail(writer, f"device '{command[len('host:transport:'):]}' not found")
+                        break
+                    writer.write(b'OKAY')
+                    continue
+                if device is not None:
+                    await self.transport(device, command, reader, writer)
+                else:
+                    await self.host(command, reader, writer)
+                break
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        finally:
+            if writer in self.trackers:
+                self.trackers.remove(writer)
+            writer.close()
+
+    async def read_command(self, reader: asyncio.StreamReader) -> Optional[str]:
+        try:
+            size = int(await reader.readexactly(4), 16)
+        except asyncio.IncompleteReadError:
+            return None
+        return (await reader.readexactly(size)).decode()
+
+    async def fail(self, writer: asyncio.StreamWriter, message: str) -> None:
+        writer.write(b'FAIL' + block(message))
+        await writer.drain()
+
+    async def host(self, command: str, reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+        if command == 'host:version':
+            writer.write(b'OKAY' + block('0029'))
+        elif command == 'host:devices':
+            writer.write(b'OKAY' + block(self.device_list()))
+        elif command == 'host:track-devices':
+            writer.write(b'OKAY' + block(self.device_list()))
+            await writer.drain()
+            self.trackers.append(writer)
+            await reader.read()
+        elif command.startswith('host:connect:'):
+            await self.connect(command[len('host:connect:'):], reader, writer)
+        elif command.startswith('host:disconnect:'):
+            addr = command[len('host:disconnect:'):]
+            if (device := self.devices.get(addr)) is not None and device.connected:
+                device.connected = False
+                self.notify()
+                writer.write(b'OKAY' + block(f'disconnected {addr}'))
+            else:
+                await self.fail(writer, f"no such device '{addr}'")
+        else:
+            await self.fail(writer, f'unsupported command {command}')
+        await writer.drain()
+
+    async def connect(self, addr: str, reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+        if self.latency:
+            await asyncio.sleep(self.latency)
+        device = self.devices.get(addr)
+        if device is not None and chance(addr, 'timeout', self.timeout_rate):
+            await reader.read()
+            return
+        if device is None or chance(addr, 'refuse', self.refuse_rate):
+            writer.write(b'OKAY' + block(f"failed to connect to '{addr}': Connection refused"))
+        elif device.connected:
+            writer.write(b'OKAY' + block(f'already connected to {addr}'))
+        else:
+            device.connected = True
+            self.notify()
+            writer.write(b'OKAY' + block(f'connected to {addr}'))
+
+    def device_list(self) -> str:
+        return ''.join(f'{serial}\tdevice\n' for serial, device in self.devices.items() if device.connected)
+
+    def notify(self) -> None:
+        for tracker in self.trackers:
+            tracker.write(block(self.device_list()))
+
+    # TRANSPORT
+
+    async def transport(self, device: FakeDevice, command: str, reader: asyncio.StreamReader,
+                        writer: asyncio.StreamWriter) -> None:
+        await self.delay(device)
+        if random.random() < self.fail_rate:
+            await self.fail(writer, 'device offline')
+            return
+        if command == 'shell:sh':
+            writer.write(b'OKAY')
+            await self.session(device, reader, writer)
+        elif command.startswith('shell:logcat '):
+            writer.write(b'OKAY')
+            await self.logcat(device, shlex.split(command[len('shell:logcat '):]), writer)
+        elif command.startswith('shell:'):
+            writer.write(b'OKAY')
+            await self.shell(device, command[len('shell:'):], writer)
+        elif command == 'sync:':
+            writer.write(b'OKAY')
+            await self.sync(device, reader, writer)
+        elif command == 'exec:screencap':
+            writer.write(b'OKAY')
+            await self.screencap(device, writer)
+        else:
+            await self.fail(writer, f'unsupported service {command}')
+
+    async def shell(self, device: FakeDevice, script: str, writer: asyncio.StreamWriter, status: int = 0) -> int:
+        for line in script.split('\n'):
+            for segment in re.split(r';|&&', line):
+                if not (segment := segment.strip()):
+                    continue
+                output, status = await self.run(device, segment.replace('$?', str(status)))
+                writer.write(output.encode())
+                await writer.drain()
+        await writer.drain()
+        return status
+
+    async def session(self, device: FakeDevice, reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+        """
+        Interactive shell: every chunk received costs a round trip and its
+        lines run as they arrive, until exit. Function definitions are only
+        recorded, so calling a function is a no-op.
+        """
+
+        status, pending, functions = 0, b'', set()
+        while chunk := await reader.read(65536):
+            await self.delay(device)
+            *lines, pending = (pending + chunk).split(b'\n')
+            for line in (line.decode(errors='ignore').strip() for line in lines):
+                if line == 'exit':
+                    return
+                if match := re.fullmatch(r'(\w+)\(\) \{', line):
+                    functions.add(match.group(1))
+                elif line != '}' and line.split(' ')[0] not in functions:
+                    status = await self.shell(device, line, writer, status)
+
+    async def delay(self, device: FakeDevice) -> None:
+        if latency := self.latency + (0.1 if device.serial in self.slow else 0.0):
+            await asyncio.sleep(latency)
+
+    async def run(self, device: FakeDevice, command: str) -> Tuple[str, int]:
+        try:
+            args = shlex.split(command.split('|')[0])
+        except ValueError:
+            args = command.split()
+        name = args[0] if args else ''
+        if name == 'echo':
+            return ' '.join(args[1:]) + '\n', 0
+        if name == 'printf' and len(args) > 1:
+            values = iter(args[2:])
+            return re.sub(r'%[sd]', lambda match: next(values, ''), args[1]).replace('\\n', '\n'), 0
+        if name in ('true', 'cd', 'mkdir', 'mv', 'chmod', 'input', 'am', 'settings'):
+            return '', 0
+        if name == 'false':
+            return '', 1
+        if name == 'exit':
+            return '', int(args[1]) if len(args) > 1 else 0
+        if name == 'sleep':
+            await asyncio.sleep(float(args[1]))
+            return '', 0
+        if name == 'rm':
+            for path in args[1:]:
+                device.files.pop(path, None)
+                device.mtimes.pop(path, None)
+                device.hashes.pop(path, None)
+            return '', 0
+        if name == 'getprop':
+            if len(args) > 1:
+                return device.props.get(args[1], '') + '\n', 0
+            return ''.join(f'[{k}]: [{v}]\n' for k, v in device.props.items()), 0
+        if name == 'dumpsys' and len(args) > 2 and args[1] == 'package':
+            version = device.packages.get(args[2])
+            return (f'    versionCode={version} minSdk=21 targetSdk=30\n' if version else ''), 0
+        if name == 'pm' and len(args) > 2 and args[1] == 'install':
+            match = re.search(r'([\w.]+)-(\d+)\.apk$', args[-1])
+            if args[-1] not in device.files or match is None:
+                return 'Failure [INSTALL_FAILED_INVALID_URI]\n', 1
+            device.packages[match.group(1)] = int(match.group(2))
+            return 'Success\n', 0
+        if name == 'pm' and len(args) > 2 and args[1] == 'uninstall':
+            if device.packages.pop(args[2], None) is None:
+                return 'Failure [DELETE_FAILED_INTERNAL_ERROR]\n', 1
+            return 'Success\n', 0
+        if name == 'find' and len(args) > 1:
+            prefix = args[1].rstrip('/') + '/'
+            paths = [path for path in device.files if path.startswith(prefix)]
+            lines = [f'{device.files[path][0]} {device.mtimes[path]} {path}\n' for path in paths]
+            if 'md5sum' in args:
+                lines += [f'{device.hashes[path]}  {path}\n' for path in paths]
+            return ''.join(lines), 0
+        if name == 'cat' and len(args) > 1:
+            size, data = device.files.get(args[1], (0, None))
+            return (data or bytes(size)).decode(errors='ignore'), 0
+        return self.output + '\n', 0
+
+    # SYNC PROTOCOL
+
+    async def sync(self, device: FakeDevice, reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+        while True:
+            try:
+                header = await reader.readexactly(8)
+            except asyncio.IncompleteReadError:
+                return
+            request, size = header[:4].decode(), struct.unpack('<I', header[4:])[0]
+            if request == 'QUIT':
+                return
+            path = (await reader.readexactly(size)).decode()
+            if request == 'STAT':
+                size, _ = device.files.get(path, (0, None))
+                writer.write(b'STAT' + struct.pack('<III', 0o100644 if path in device.files else 0, size,
+                                                   1 if path in device.files else 0))
+            elif request == 'LIST':
+                prefix = path.rstrip('/') + '/'
+                for name, (size, _) in device.files.items():
+                    if name.startswith(prefix) and '/' not in name[len(prefix):]:
+                        entry = name[len(prefix):].encode()
+                        writer.write(b'DENT' + struct.pack('<IIII', 0o100644, size, 1, len(entry)) + entry)
+                writer.write(b'DONE' + bytes(16))
+            elif request == 'SEND':
+                await self.receive(device, path.rsplit(',', 1)[0], reader, writer)
+            elif request == 'RECV':
+                await self.send(device, path, writer)
+            else:
+                await self.fail(writer, f'unsupported sync request {request}')
+                return
+            await writer.drain()
+
+    async def receive(self, device: FakeDevice, path: str, reader: asyncio.StreamReader,
+                      writer: asyncio.StreamWriter) -> None:
+        loop = asyncio.get_running_loop()
+        started = loop.time()
+        chunks, total = [], 0
+        digest = hashlib.md5()
+        while True:
+            header = await reader.readexactly(8)
+            request, size = header[:4], struct.unpack('<I', header[4:])[0]
+            if request == b'DONE':
+                device.mtimes[path] = size
+                break
+            chunk = await reader.readexactly(size)
+            digest.update(chunk)
+            total += size
+            if total <= self.keep:
+                chunks.append(chunk)
+            await self.throttle(started, total)
+        device.files[path] = (total, b''.join(chunks) if total <= self.keep else None)
+        device.hashes[path] = digest.hexdigest()
+        writer.write(b'OKAY' + bytes(4))
+
+    async def send(self, device: FakeDevice, path: str, writer: asyncio.StreamWriter) -> None:
+        if path not in device.files:
+            message = b'No such file or directory'
+            writer.write(b'FAIL' + struct.pack('<I', len(message)) + message)
+            return
+        loop = asyncio.get_running_loop()
+        started = loop.time()
+        size, data = device.files[path]
+        for offset in range(0, size, 64 * 1024):
+            length = min(64 * 1024, size - offset)
+            chunk = data[offset:offset + length] if data is not None else self.shared[:length]
+            writer.write(b'DATA' + struct.pack('<I', length) + chunk)
+            await writer.drain()
+            await self.throttle(started, offset + length)
+        writer.write(b'DONE' + bytes(4))
+
+    async def logcat(self, device: FakeDevice, args: List[str], writer: asyncio.StreamWriter) -> None:
+        """
+        logcat -v epoch printing log_rate lines per second, with random tags
+        and priorities, filtered by the filter specs and by -e. With -d only
+        100 past lines are printed, with -T the given past lines come first.
+        """
+
+        specs, pattern, past, dump = dict(), None, 0, False
+        options = iter(args)
+        for arg in options:
+            if arg == '-d':
+                dump = True
+            elif arg == '-e':
+                pattern = re.compile(next(options))
+            elif arg == '-T':
+                past = int(next(options))
+            elif arg in ('-v', '-b'):
+                next(options)
+            elif ':' in arg:
+                tag, priority = arg.split(':', 1)
+                specs[tag] = priority
+
+        def lines(count: int, start: float, step: float) -> bytes:
+            output = []
+            for index in range(count):
+                tag, priority = random.choice(tags), random.choice(priorities[:-1])
+                message = f'event {random.randrange(1_000_000)} on {device.serial}'
+                if priorities.index(priority) < priorities.index(specs.get(tag, specs.get('*', 'V'))):
+                    continue
+                if pattern is None or pattern.search(message):
+                    output.append(f'{start + index * step:.3f} {1000:5d} {1001:5d} {priority} {tag:<8}: {message}\n')
+            return ''.join(output).encode()
+
+        now = time.time()
+        if dump or past:
+            writer.write(lines(100 if dump else past, now - 10, 0.01))
+            await writer.drain()
+        if dump:
+            return
+        interval = 0.05
+        while True:
+            await asyncio.sleep(interval)
+            count = int(self.log_rate * interval) + (random.random() < self.log_rate * interval % 1)
+            writer.write(lines(count, time.time() - interval, interval / max(1, count)))
+            await writer.drain()
+
+    async def screencap(self, device: FakeDevice, writer: asyncio.StreamWriter) -> None:
+        """Raw RGBA frame, with the header of Android 9, painted with a color of the device"""
+
+        width, height = screen
+        band = (hashlib.md5(device.serial.encode()).digest()[:3] + b'\xff') * width * 64
+        writer.write(struct.pack('<IIII', width, height, 1, 0))
+        started = asyncio.get_running_loop().time()
+        for row in range(0, height, 64):
+            writer.write(band[:min(64, height - row) * width * 4])
+            await writer.drain()
+            await self.throttle(started, (row + 64) * width * 4)
+
+    async def throttle(self, started: float, transferred: int) -> None:
+        if self.bandwidth:
+            delay = transferred / self.bandwidth - (asyncio.get_running_loop().time() - started)
+            if delay > 0:
+                await asyncio.sleep(delay)
+
+    async def serve(self, host: str, port: int) -> None:
+        server = await asyncio.start_server(self.handle, host, port, limit=1024 * 1024, backlog=4096)
+        async with server:
+            await server.serve_forever()
+
+
+# COMMANDS
+
+@click.command()
+@click.help_option('-h', '--help')
+@click.option('-p', '--port', help='Listening port', default=15037, type=int)
+@click.option('-n', '--devices', help='Number of emulated devices', default=100, type=int)
+@click.option('-c', '--connected', help='Devices already connected at startup', is_flag=True)
+@click.option('-l', '--latency', help='Latency added to every request (seconds)', default=0.0, type=float)
+@click.option('-b', '--bandwidth', help='Bandwidth of every device (MB/s, 0 means unlimited)', default=0.0,
+              type=float)
+@click.option('--refuse-rate', help='Fraction of devices refusing the connection', default=0.0, type=float)
+@click.option('--timeout-rate', help='Fraction of devices never answering to connect', default=0.0, type=float)
+@click.option('--fail-rate', help='Probability of a failure of every transport request', default=0.0, type=float)
+@click.option('--slow-rate', help='Fraction of devices answering 100 ms later than the others', default=0.0,
+              type=float)
+@click.option('--output-size', help='Bytes returned by a generic shell command', default=64, type=int)
+@click.option('--file-size', help='Size of /sdcard/bench.bin on every device (bytes)', default=1024 * 1024,
+              type=int)
+@click.option('--log-rate', help='Lines printed by logcat every second on every device', default=20.0, type=float)
+def fake_adb(port: int, devices: int, connected: bool, latency: float, bandwidth: float, refuse_rate: float,
+             timeout_rate: float, fail_rate: float, slow_rate: float, output_size: int, file_size: int,
+             log_rate: float) -> None:
+    """
+    Starts a fake adb server emulating a fleet of devices.
+    Point pyADB to it with the ANDROID_ADB_SERVER_PORT environment variable.
+
+    :Usage example: python3 benchmarks/fake_adb.py --devices 1000 --latency 0.05
+    """
+
+    server = FakeAdbServer(devices, connected, latency, bandwidth * 1024 ** 2, refuse_rate, timeout_rate, fail_rate,
+                           output_size, file_size, slow_rate=slow_rate, log_rate=log_rate)
+    click.echo(f'Fake adb server with {devices} devices listening on 127.0.0.1:{port}', err=True)
+    try:
+        asyncio.run(server.serve('127.0.0.1', port))
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == '__main__':
+    fake_adb()
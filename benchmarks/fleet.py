@@ -0,0 +1,181 @@
+import os
+import sys
+import json
+import time
+import socket
+import tempfile
+import subprocess
+import click
+from typing import List, Dict, Optional
+
+from fake_adb import serial_of
+
+# VARIABLES
+
+here = os.path.dirname(os.path.abspath(__file__))
+main = os.path.join(here, '..', 'src', 'main.py')
+
+
+# UTILS
+
+def free_port() -> int:
+    """Port that is not used by anyone on localhost"""
+
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+def free_ports(count: int) -> int:
+    """First of count consecutive ports that are not used by anyone on localhost"""
+
+    while True:
+        base = free_port()
+        for port in range(base + 1, base + count):
+            with socket.socket() as s:
+                if s.connect_ex(('127.0.0.1', port)) == 0:
+                    break
+        else:
+            return base
+
+
+def start_server(port: int, devices: int, latency: float, bandwidth: float, file_size: int) -> subprocess.Popen:
+    """
+    Starts the fake adb server in another process and waits for it.
+
+    :return: The server process
+    """
+
+    p = subprocess.Popen([sys.executable, os.path.join(here, 'fake_adb.py'), '--port', str(port),
+                          '--devices', str(devices), '--latency', str(latency), '--bandwidth', str(bandwidth),
+                          '--file-size', str(file_size)], stderr=subprocess.DEVNULL)
+    deadline = time.monotonic() + 10
+    while time.monotonic() < deadline:
+        with socket.socket() as s:
+            if s.connect_ex(('127.0.0.1', port)) == 0:
+                return p
+        time.sleep(0.05)
+    p.kill()
+    raise RuntimeError('the fake adb server did not start')
+
+
+def run(args: List[str], cwd: str, env: Dict[str, str]) -> float:
+    """
+    Runs a pyADB command against the fake server.
+
+    :return: Elapsed time (seconds)
+    """
+
+    start = time.perf_counter()
+    p = subprocess.run([sys.executable, main, *args], cwd=cwd, env=env, stdout=subprocess.DEVNULL,
+                       stderr=subprocess.PIPE, universal_newlines=True)
+    elapsed = time.perf_counter() - start
+    if p.returncode != 0:
+        raise RuntimeError(f'{" ".join(args)} failed: {p.stderr.strip()}')
+    return elapsed
+
+
+def scenario(devices: int, workers: int, latency: float, bandwidth: float, file_size: int,
+             shards: int = 1) -> Dict[str, float]:
+    """
+    Measures the fleet hot paths against fresh fake servers, one per shard.
+
+    :return: Throughput of every operation
+    """
+
+    port = free_ports(shards)
+    servers = [start_server(port + index, devices, latency, bandwidth, file_size) for index in range(shards)]
+    try:
+        with tempfile.TemporaryDirectory() as tmp:
+            env = dict(os.environ, ANDROID_ADB_SERVER_PORT=str(port), XDG_CACHE_HOME=tmp, PYADB_SHARDS=str(shards))
+            with open(os.path.join(tmp, 'devices.json'), 'w') as f:
+                json.dump([{'ip': serial_of(i).split(':')[0], 'ports': [{'port': 5555, 'status': 'open'}]}
+                           for i in range(1, devices + 1)], f)
+            with open(os.path.join(tmp, 'payload.bin'), 'wb') as f:
+                f.write(os.urandom(file_size))
+
+            run(['load'], tmp, env)
+            results = dict()
+            results['connect (devices/s)'] = devices / run(['connect', '-w', str(workers)], tmp, env)
+            results['broad-cmd (commands/s)'] = devices / run(['broad-cmd', '-w', str(workers), 'echo', 'hi'],
+                                                              tmp, env)
+            results['push (MB/s)'] = devices * file_size / 1024 ** 2 / run(
+                ['push', '-w', str(workers), 'payload.bin', '/sdcard'], tmp, env)
+            results['pull (MB/s)'] = devices * file_size / 1024 ** 2 / run(
+                ['pull', '-w', str(workers), 'all', '/sdcard/bench.bin', 'pulled'], tmp, env)
+            return results
+    finally:
+        for server in servers:
+            server.kill()
+            server.wait()
+
+
+def last_record(history: str) -> Optional[dict]:
+    """Last record saved in the history file"""
+
+    if not os.path.exists(history):
+        return None
+    with open(history, 'r') as f:
+        lines = [line for line in f if line.strip()]
+    return json.loads(lines[-1]) if lines else None
+
+
+# COMMANDS
+
+@click.command()
+@click.help_option('-h', '--help')
+@click.option('-s', '--sizes', help='Fleet sizes, comma separated', default='10,100,1000')
+@click.option('-w', '--workers', help='Workers passed to the commands', default=64, type=int)
+@click.option('-l', '--latency', help='Latency of every request (seconds)', default=0.02, type=float)
+@click.option('-b', '--bandwidth', help='Bandwidth of every device (MB/s, 0 means unlimited)', default=0.0,
+              type=float)
+@click.option('-f', '--file-size', help='Size of the pushed and pulled file (MB)', default=4.0, type=float)
+@click.option('-t', '--tolerance', help='Max slowdown compared to the previous run before failing', default=0.2,
+              type=float)
+@click.option('-S', '--shards', help='Local adb servers sharing the devices', default=1, type=int)
+@click.option('-H', '--history', help='JSON lines file where the results are appended',
+              default=os.path.join(here, 'fleet.jsonl'))
+def fleet(sizes: str, workers: int, latency: float, bandwidth: float, file_size: float, tolerance: float,
+          shards: int, history: str) -> None:
+    """
+    Measures connect, broad-cmd, push and pull throughput against a fake adb
+    server emulating fleets of different sizes, or one server per shard with
+    --shards. The results are compared with the previous run in the history
+    file: if a throughput dropped more than --tolerance the exit code is 1.
+
+    :Usage example: python3 benchmarks/fleet.py --sizes 10,100
+    """
+
+    previous = last_record(history)
+    results = dict()
+    regressions = []
+    click.echo(f'{"operation":<24} {"devices":>8} {"throughput":>12} {"delta":>8}')
+    for size in (int(s) for s in sizes.split(',')):
+        for operation, value in scenario(size, workers, latency, bandwidth, int(file_size * 1024 ** 2),
+                                         shards).items():
+            key = f'{operation} @ {size}' if shards == 1 else f'{operation} @ {size} x{shards} shards'
+            results[key] = value
+            delta = '-'
+            if previous is not None and key in previous['results']:
+                change = value / previous['results'][key] - 1
+                delta = f'{change:+.0%}'
+                if change < -tolerance:
+                    regressions.append(key)
+            click.echo(f'{operation:<24} {size:>8} {value:>12.1f} {delta:>8}')
+
+    with open(history, 'a') as f:
+        f.write(json.dumps({
+            'timestamp': time.time(),
+            'commit': subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], cwd=here, stdout=subprocess.PIPE,
+                                     stderr=subprocess.DEVNULL, universal_newlines=True).stdout.strip(),
+            'options': dict(workers=workers, latency=latency, bandwidth=bandwidth, file_size=file_size, shards=shards),
+            'results': results
+        }) + '\n')
+
+    if regressions:
+        click.echo(f'REGRESSION: {", ".join(regressions)}', err=True)
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    fleet()
@@ -0,0 +1,121 @@
+import os
+import re
+import sys
+import json
+import time
+import subprocess
+import statistics
+import click
+from typing import List, Tuple, Dict
+
+# VARIABLES
+
+src = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src')
+default_commands = ('--help', 'clear --help', 'show --help', 'exec --help', 'broad-cmd --help', 'push --help',
+                    'install --help', 'scrcpy --help')
+
+
+# UTILS
+
+def parse_importtime(stderr: str) -> Tuple[float, Dict[str, float]]:
+    """
+    Parses the output of python -X importtime.
+
+    :param stderr: Standard error of the process
+    :return: Total import time (ms) of the top level modules, except site, and cumulative time (ms) of every module
+    """
+
+    total = 0.0
+    modules = dict()
+    for line in stderr.splitlines():
+        match = re.match(r'import time:\s+(\d+) \|\s+(\d+) \|( +)(\S+)', line)
+        if match is None:
+            continue
+        cumulative, indent, name = int(match.group(2)) / 1000, len(match.group(3)), match.group(4)
+        modules[name] = cumulative
+        if indent == 1 and name != 'site':
+            total += cumulative
+    return total, modules
+
+
+def measure(command: str, runs: int) -> dict:
+    """
+    Launches the CLI several times and measures its startup.
+
+    :param command: Arguments passed to main.py
+    :param runs: Number of launches
+    :return: Median wall and import times (ms) and the slowest modules of the last launch
+    """
+
+    walls, imports, modules = [], [], dict()
+    for _ in range(runs):
+        start = time.perf_counter()
+        p = subprocess.run([sys.executable, '-X', 'importtime', 'main.py', *command.split()], cwd=src,
+                           stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, universal_newlines=True)
+        walls.append((time.perf_counter() - start) * 1000)
+        total, modules = parse_importtime(p.stderr)
+        imports.append(total)
+    slowest = sorted(modules.items(), key=lambda item: item[1], reverse=True)[:5]
+    return {'wall_ms': statistics.median(walls), 'import_ms': statistics.median(imports), 'slowest': slowest}
+
+
+def last_record(history: str) -> dict:
+    """Last record saved in the history file"""
+
+    if not os.path.exists(history):
+        return dict()
+    with open(history, 'r') as f:
+        lines = [line for line in f if line.strip()]
+    return json.loads(lines[-1]) if lines else dict()
+
+
+# COMMANDS
+
+@click.command()
+@click.help_option('-h', '--help')
+@click.argument('commands', nargs=-1)
+@click.option('-r', '--runs', help='Launches for every command', default=10, type=int)
+@click.option('-H', '--history', help='JSON lines file where the results are appended',
+              default=os.path.join(os.path.dirname(os.path.abspath(__file__)), 'startup.jsonl'))
+@click.option('-v', '--verbose', help='Show the slowest modules of every command', is_flag=True)
+def startup(commands: List[str], runs: int, history: str, verbose: bool) -> None:
+    """
+    Measures the cold start of main.py with python -X importtime and compares
+    it with the previous run saved in the history file.
+
+    :Usage example: python3 benchmarks/startup.py
+
+    :param commands: Commands to measure (default: the --help of the main commands)
+
+    :param runs: Launches for every command
+
+    :param history: History file
+
+    :param verbose: Flag to show the slowest modules
+    """
+
+    previous = last_record(history).get('results', dict())
+    results = dict()
+    click.echo(f'{"command":<20} {"wall (ms)":>10} {"imports (ms)":>13} {"delta (ms)":>11}')
+    for command in commands or default_commands:
+        result = results[command] = measure(command, runs)
+        delta = f'{result["wall_ms"] - previous[command]["wall_ms"]:+.1f}' if command in previous else '-'
+        click.echo(f'{command:<20} {result["wall_ms"]:>10.1f} {result["import_ms"]:>13.1f} {delta:>11}')
+        if verbose:
+            for name, cumulative in result['slowest']:
+                click.echo(f'    {name:<40} {cumulative:>8.1f}')
+
+    commit = subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], cwd=src, stdout=subprocess.PIPE,
+                            stderr=subprocess.DEVNULL, universal_newlines=True).stdout.strip()
+    with open(history, 'a') as f:
+        f.write(json.dumps({
+            'timestamp': time.time(),
+            'commit': commit,
+            'python': sys.version.split()[0],
+            'runs': runs,
+            'results': results
+        }) + '\n')
+
+
+if __name__ == '__main__':
+    startup()
@@ -0,0 +1,28 @@
+from rich.console import RenderableType
+from rich.progress import Column, Text, StyleType, Task, JustifyMethod, ProgressColumn
+from typing import Optional
+
+
+class UpdatableTextColumn(ProgressColumn):
+    """
+    This special type of column represent an extension for the original TextColumn
+    provided from rich. With this class you can instantiate an object and call the
+    setter method to update the displayable text.
+    """
+
+    def __init__(self, text: str = '',
+                 table_column: Optional[Column] = None,
+                 style: StyleType = "none",
+                 justify: JustifyMethod = "left"
+                 ):
+        self.text = text
+        self.style = style
+        self.justify = justify
+        super().__init__(table_column=table_column)
+
+    def set_text(self, new_text: str) -> None:
+        self.text = new_text
+
+    def render(self, task: "Task") -> RenderableType:
+        text = Text(self.text, style=self.style, justify=self.justify)
+        return text
@@ -0,0 +1,196 @@
+import os
+import sys
+import json
+import shutil
+import signal
+import socket
+import struct
+import threading
+import traceback
+import importlib
+from typing import Optional, List, Any
+
+import Utils
+
+# VARIABLES
+
+forwarded = ('exec', 'broad-cmd', 'run-script', 'push', 'show')
+preloaded = ('adbutils', 'rich.console', 'rich.progress', 'rich.table', 'Columns')
+serving = False
+
+
+# CLIENT
+
+def socket_path() -> str:
+    """Path of the unix socket the daemon listens to"""
+
+    return os.path.join(Utils.user_cache_dir(Utils.cache_name, Utils.cache_author), 'daemon.sock')
+
+
+def forward(argv: List[str]) -> Optional[int]:
+    """
+    Runs the command inside the daemon, if it is running, streaming its output.
+
+    :param argv: Command line arguments
+    :return: The exit code of the command, None if the daemon is not running
+    """
+
+    if serving or not os.path.exists(path := socket_path()):
+        return None
+
+    client = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        client.connect(path)
+    except OSError:
+        client.close()
+        return None
+
+    with client:
+        request = {
+            'argv': argv,
+            'cwd': os.getcwd(),
+            'tty': sys.stdout.isatty(),
+            'width': shutil.get_terminal_size().columns
+        }
+        client.sendall(json.dumps(request).encode() + b'\n')
+        stream = client.makefile('rb')
+        while len(header := stream.read(4)) == 4:
+            size, = struct.unpack('>i', header)
+            if size < 0:
+                return struct.unpack('>i', stream.read(4))[0]
+            sys.stdout.buffer.write(stream.read(size))
+            sys.stdout.buffer.flush()
+    return 1
+
+
+def is_running() -> bool:
+    """Checks if a daemon is accepting connections on the socket"""
+
+    if not os.path.exists(path := socket_path()):
+        return False
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as probe:
+        try:
+            probe.connect(path)
+            return True
+        except OSError:
+            return False
+
+
+# SERVER
+
+def run(cli: Any, request: dict, fd: int) -> None:
+    """
+    Executes a forwarded command inside a forked child, with stdout and
+    stderr redirected to fd. It never returns.
+
+    :param cli: Click group
+    :param request: Forwarded request
+    :param fd: Output file descriptor
+    """
+
+    import rich
+    import rich.console
+
+    code = 1
+    try:
+        os.dup2(fd, 1)
+        os.dup2(fd, 2)
+        os.close(fd)
+        os.dup2(os.open(os.devnull, os.O_RDONLY), 0)
+        os.chdir(request['cwd'])
+        signal.signal(signal.SIGINT, signal.SIG_DFL)
+        signal.signal(signal.SIGTERM, signal.SIG_DFL)
+
+        options = dict(force_terminal=request['tty'], width=request['width'])
+        rich.reconfigure(**options)
+        Utils.console.instance = rich.console.Console(**options)
+
+        cli.main(args=request['argv'], prog_name='main.py')
+        code = 0
+    except SystemExit as e:
+        code = e.code if isinstance(e.code, int) else int(e.code is not None)
+    except BaseException:
+        traceback.print_exc()
+    finally:
+        sys.stdout.flush()
+        sys.stderr.flush()
+        os._exit(code)
+
+
+def handle(cli: Any, conn: socket.socket) -> None:
+    """
+    Serves a single client: the command runs in a forked child, so it finds
+    every module already imported and the device registry already populated,
+    and its output is sent back in length-prefixed frames.
+
+    :param cli: Click group
+    :param conn: Client connection
+    """
+
+    with conn:
+        if not (line := conn.makefile('rb').readline()):
+            return
+        request = json.loads(line)
+        read, write = os.pipe()
+        pid = os.fork()
+        if pid == 0:
+            os.close(read)
+            run(cli, request, write)
+        os.close(write)
+
+        try:
+            with os.fdopen(read, 'rb') as pipe:
+                while chunk := pipe.read1(65536):
+                    conn.sendall(struct.pack('>i', len(chunk)) + chunk)
+        except OSError:
+            os.kill(pid, signal.SIGTERM)
+        _, status = os.waitpid(pid, 0)
+        try:
+            conn.sendall(struct.pack('>ii', -1, os.waitstatus_to_exitcode(status)))
+        except OSError:
+            pass
+
+
+def serve(cli: Any, interval: float = 5.0) -> None:
+    """
+    Listens to the unix socket until interrupted (SIGINT or SIGTERM), keeping the device
+    registry updated by the device tracker and the devices probed by the
+    health monitor. The modules used by the forwarded commands are imported
+    in advance, so the children find them ready.
+
+    :param cli: Click group
+    :param interval: Seconds between two health probe rounds
+    """
+
+    global serving
+
+    if is_running():
+        Utils.error(f'[bold red]ERROR:[/] a daemon is already listening on {socket_path()}')
+
+    os.makedirs(os.path.dirname(path := socket_path()), exist_ok=True)
+    if os.path.exists(path):
+        os.unlink(path)
+
+    server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    server.bind(path)
+    server.listen(128)
+    signal.signal(signal.SIGTERM, signal.default_int_handler)
+    for name in preloaded:
+        importlib.import_module(name)
+    Utils.registry.watch()
+    Utils.monitor.start(interval)
+    serving = True
+
+    Utils.log(f'[bold green]SERVING:[/] listening on {path}, press Ctrl+C to stop.')
+    try:
+        while True:
+            conn, _ = server.accept()
+            threading.Thread(target=handle, args=(cli, conn), daemon=True).start()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.close()
+        if os.path.exists(path):
+            os.unlink(path)
+        Utils.log('[bold red]STOPPED:[/] the daemon is not listening anymore.')
+
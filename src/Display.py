@@ -0,0 +1,292 @@
+import bisect
+import asyncio
+from collections import deque
+from typing import Optional, Dict, List, Deque
+from rich.align import Align
+from rich.console import RenderableType, Group
+from rich.panel import Panel
+from rich.table import Table
+from rich.text import Text
+from textual.widget import Widget
+from textual.widgets import Footer
+from textual.app import App
+from textual import events
+
+from Utils import registry, adbutils
+from Mirror import MirrorManager, Session, SessionLimit
+
+# VARIABLES
+
+cell_width = 26
+cell_height = 3
+status_styles = {'device': 'bold green', 'offline': 'bold red', 'unauthorized': 'bold yellow'}
+
+
+class Device:
+    """Panel of a single device, built only while it is visible"""
+
+    __slots__ = ('serial', 'status')
+
+    def __init__(self, serial: str, status: str):
+        self.serial = serial
+        self.status = status
+
+    def render(self, hover: bool, mirrored: bool) -> RenderableType:
+        title = Text(self.serial, style=status_styles.get(self.status, 'dim'), no_wrap=True, overflow='ellipsis')
+        return Panel(Align.center(title, vertical='middle'), height=cell_height,
+                     style=('on red' if hover else ''), title=('mirrored' if mirrored else None),
+                     border_style=('bold cyan' if mirrored else 'none'))
+
+
+class DeviceGrid(Widget):
+    """
+    Grid of the devices sorted by serial. Only the serial and the status of
+    every device are kept: the panels are built at every render for the
+    rows that fit the screen, so the cost of a frame does not depend on the
+    size of the fleet. Clicking a device starts or stops its mirror.
+    """
+
+    def __init__(self, mirrors: MirrorManager):
+        super(DeviceGrid, self).__init__('devices')
+        self.mirrors = mirrors
+        self.notice: Optional[str] = None
+        self.statuses: Dict[str, str] = dict()
+        self.serials: List[str] = []
+        self.matching: List[str] = []
+        self.filter = ''
+        self.filtering = False
+        self.loaded = False
+        self.row = 0
+        self.hover: Optional[int] = None
+
+    # GEOMETRY
+
+    @property
+    def columns(self) -> int:
+        return max(1, self.size.width // cell_width)
+
+    @property
+    def rows(self) -> int:
+        return max(1, (self.size.height - 1) // cell_height)
+
+    def scroll(self, rows: int) -> None:
+        """Moves the first visible row, keeping the last page full"""
+
+        total = -(-len(self.matching) // self.columns)
+        row = max(0, min(self.row + rows, total - self.rows))
+        if row != self.row:
+            self.row = row
+            self.hover = None
+            self.refresh()
+
+    def index_at(self, x: int, y: int) -> Optional[int]:
+        """Index in the matching devices of the panel at x, y, None if there is no panel"""
+
+        if y < 1 or not 0 <= x < self.size.width:
+            return None
+        column = int(x // (self.size.width / self.columns))
+        index = (self.row + (y - 1) // cell_height) * self.columns + column
+        return index if index < len(self.matching) else None
+
+    # DEVICES
+
+    def matches(self, serial: str) -> bool:
+        return self.filter in serial.lower() or self.filter in self.statuses[serial]
+
+    def add(self, serial: str, status: str) -> None:
+        if serial not in self.statuses:
+            bisect.insort(self.serials, serial)
+        elif self.matches(serial):
+            self._discard(self.matching, serial)
+        self.statuses[serial] = status
+        if self.matches(serial):
+            bisect.insort(self.matching, serial)
+
+    def remove(self, serial: str) -> None:
+        if self.statuses.pop(serial, None) is not None:
+            self._discard(self.serials, serial)
+            self._discard(self.matching, serial)
+
+    def set_filter(self, text: str) -> None:
+        self.filter = text.lower()
+        self.matching = [serial for serial in self.serials if self.matches(serial)]
+        self.row = 0
+        self.hover = None
+        self.refresh()
+
+    @staticmethod
+    def _discard(serials: List[str], serial: str) -> None:
+        index = bisect.bisect_left(serials, serial)
+        if index < len(serials) and serials[index] == serial:
+            del serials[index]
+
+    # EVENTS
+
+    def on_mouse_move(self, event: events.MouseMove) -> None:
+        if (index := self.index_at(event.x, event.y)) != self.hover:
+            self.hover = index
+            self.refresh()
+
+    def on_leave(self) -> None:
+        self.hover = None
+        self.refresh()
+
+    def on_mouse_scroll_up(self, event: events.MouseScrollUp) -> None:
+        self.scroll(-1)
+
+    def on_mouse_scroll_down(self, event: events.MouseScrollDown) -> None:
+        self.scroll(1)
+
+    async def on_click(self, event: events.Click) -> None:
+        if (index := self.index_at(event.x, event.y)) is None:
+            return
+        serial = self.matching[index]
+        self.notice = None
+        if serial in self.mirrors:
+            self.mirrors.stop(serial)
+        elif (status := self.statuses[serial]) != 'device':
+            self.notice = f'{serial} is {status}'
+        else:
+            try:
+                await self.mirrors.start(serial)
+            except SessionLimit as e:
+                self.notice = f'{e}, close one first'
+            except OSError as e:
+                self.notice = f'cannot run scrcpy: {e.strerror}'
+        self.refresh()
+
+    # RENDERING
+
+    def summary(self) -> Text:
+        online = sum(1 for status in self.statuses.values() if status == 'device')
+        text = Text.assemble((f' {len(self.statuses)}', 'bold'), ' devices, ', (f'{online}', 'bold green'),
+                             ' online')
+        if self.filter or self.filtering:
+            text.append(f'  filter: {self.filter}{"_" if self.filtering else ""}', style='bold yellow')
+            text.append(f' ({len(self.matching)} matching)')
+        if self.matching:
+            first = self.row * self.columns
+            text.append(f'  {first + 1}-{min(first + self.rows * self.columns, len(self.matching))}', style='dim')
+        if self.mirrors:
+            text.append(f'  {len(self.mirrors)}/{self.mirrors.limit} mirrored', style='bold cyan')
+        if self.notice:
+            text.append(f'  {self.notice}', style='bold red')
+        return text
+
+    def render(self) -> RenderableType:
+        if not self.matching:
+            if not self.loaded:
+                message = Text('Loading devices...', style='yellow')
+            elif self.statuses:
+                message = Text('No device matches the filter. Press \'Esc\' to clear it.', style='bold red')
+            else:
+                message = Text('No devices connected. Press \'Q\' to exit.', style='bold red')
+            return Group(self.summary(), Panel(Align.center(message, vertical='middle'), height=cell_height))
+
+        columns = self.columns
+        grid = Table.grid(expand=True)
+        for _ in range(columns):
+            grid.add_column(ratio=1)
+        first = self.row * columns
+        page = self.matching[first:first + self.rows * columns]
+        for start in range(0, len(page), columns):
+            cells = [Device(serial, self.statuses[serial]).render(first + start + i == self.hover,
+                                                                  serial in self.mirrors)
+                     for i, serial in enumerate(page[start:start + columns])]
+            grid.add_row(*cells)
+        return Group(self.summary(), grid)
+
+
+class Display(App):
+    """
+    App run when scrcpy command is launched. The devices are loaded in a
+    worker thread and then kept up to date by the device tracker, whose
+    events are queued and applied to the grid a few times per second.
+    The mirrors still open are closed when the app quits.
+    """
+
+    def __init__(self, *args, preset: str = 'auto', limit: int = 4, **kwargs):
+        super(Display, self).__init__(*args, **kwargs)
+        self.mirrors = MirrorManager(limit, preset, on_change=self.mirror_changed)
+        self.grid = DeviceGrid(self.mirrors)
+        self.events: Deque['adbutils.DeviceEvent'] = deque()
+
+    async def on_load(self) -> None:
+        await self.bind('q', 'quit', 'Quit')
+        await self.bind('/', 'filter', 'Filter')
+        await self.bind('escape', 'clear', 'Clear filter')
+        await self.bind('x', 'close_mirrors', 'Close mirrors')
+
+    async def on_mount(self) -> None:
+        await self.view.dock(Footer(), edge='bottom')
+        await self.view.dock(self.grid, edge='top')
+        asyncio.get_running_loop().create_task(self.load())
+
+    async def load(self) -> None:
+        registry.listen(self.events.append)
+        devices = await asyncio.get_running_loop().run_in_executor(None, self.watch)
+        for event in devices:
+            self.grid.add(event.serial, event.status)
+        self.grid.loaded = True
+        self.grid.refresh()
+        self.set_interval(0.2, self.drain)
+
+    @staticmethod
+    def watch() -> List['adbutils.DeviceEvent']:
+        registry.watch()
+        return registry.snapshot()
+
+    def drain(self) -> None:
+        """Applies the queued tracker events to the grid, refreshing it once"""
+
+        if not self.events:
+            return
+        while self.events:
+            event = self.events.popleft()
+            if event.present:
+                self.grid.add(event.serial, event.status)
+            else:
+                self.grid.remove(event.serial)
+        self.grid.scroll(0)
+        self.grid.refresh()
+
+    def mirror_changed(self, session: Session) -> None:
+        if session.error is not None:
+            self.grid.notice = f'{session.serial}: {session.error}'
+        self.grid.refresh()
+
+    async def action_close_mirrors(self) -> None:
+        await self.mirrors.close()
+
+    async def action_quit(self) -> None:
+        await self.mirrors.close()
+        await self.shutdown()
+
+    async def action_filter(self) -> None:
+        self.grid.filtering = True
+        self.grid.refresh()
+
+    async def action_clear(self) -> None:
+        self.grid.filtering = False
+        self.grid.set_filter('')
+
+    async def on_key(self, event: events.Key) -> None:
+        grid = self.grid
+        if grid.filtering:
+            if event.key == 'escape':
+                await self.action_clear()
+            elif event.key in ('ctrl+m', 'enter'):
+                grid.filtering = False
+                grid.refresh()
+            elif event.key == 'ctrl+h':
+                grid.set_filter(grid.filter[:-1])
+            elif len(event.key) == 1 and event.key.isprintable():
+                grid.set_filter(grid.filter + event.key)
+            return
+
+        pages = {'up': -1, 'down': 1, 'pageup': -grid.rows, 'pagedown': grid.rows,
+                 'home': -len(grid.matching), 'end': len(grid.matching)}
+        if event.key in pages:
+            grid.scroll(pages[event.key])
+        else:
+            await self.press(event.key)
@@ -0,0 +1,182 @@
+import os
+import json
+import time
+import bisect
+import threading
+from typing import Optional, Dict, List, Tuple
+
+# VARIABLES
+
+buckets = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 300.0)
+
+
+class Histogram:
+    """Histogram of durations with fixed buckets, plus the totals of the observations"""
+
+    def __init__(self):
+        self.counts = [0] * (len(buckets) + 1)
+        self.count = 0
+        self.sum = 0.0
+        self.bytes = 0
+        self.errors = 0
+
+    def observe(self, seconds: float, size: int, failed: bool) -> None:
+        self.counts[bisect.bisect_left(buckets, seconds)] += 1
+        self.count += 1
+        self.sum += seconds
+        self.bytes += size
+        self.errors += failed
+
+    def cumulative(self) -> List[Tuple[str, int]]:
+        """Pairs of upper bound and number of observations below it, as Prometheus expects them"""
+
+        total, pairs = 0, []
+        for bound, count in zip((*(str(b) for b in buckets), '+Inf'), self.counts):
+            total += count
+            pairs.append((bound, total))
+        return pairs
+
+    def to_dict(self) -> dict:
+        return {'count': self.count, 'sum': self.sum, 'bytes': self.bytes, 'errors': self.errors,
+                'buckets': dict(self.cumulative())}
+
+
+class Timer:
+    """
+    Context manager measuring a single operation. The transferred bytes can
+    be set on it before it exits; an exception, or setting failed, marks the
+    operation as failed.
+    """
+
+    __slots__ = ('metrics', 'phase', 'serial', 'bytes', 'failed', 'start')
+
+    def __init__(self, metrics: 'Metrics', phase: str, serial: str):
+        self.metrics = metrics
+        self.phase = phase
+        self.serial = serial
+        self.bytes = 0
+        self.failed = False
+        self.start = 0.0
+
+    def __enter__(self) -> 'Timer':
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc, tb) -> None:
+        self.metrics.observe(self.phase, self.serial, time.perf_counter() - self.start, self.bytes,
+                             self.failed or exc_type is not None)
+
+
+class Metrics:
+    """
+    Records the duration and the transferred bytes of every operation, by
+    phase (connect, enumerate, shell, push, pull, install, screencap) and
+    by device. Every phase has a histogram, every device only the totals,
+    so the memory stays small with large fleets. Nothing is recorded until
+    enable() is called, and recording costs a lock and a few additions.
+    """
+
+    def __init__(self):
+        self.enabled = False
+        self.lock = threading.Lock()
+        self.phases: Dict[str, Histogram] = dict()
+        self.devices: Dict[Tuple[str, str], List[float]] = dict()
+        self.command: Optional[str] = None
+        self.path: Optional[str] = None
+        self.started = 0.0
+        os.register_at_fork(before=self.lock.acquire, after_in_parent=self.lock.release,
+                            after_in_child=self.lock.release)
+
+    def enable(self, command: str, path: str) -> None:
+        """Starts recording the operations of command, exported into path by export()"""
+
+        self.enabled = True
+        self.command = command
+        self.path = path
+        self.started = time.time()
+
+    def timed(self, phase: str, serial: str = '') -> Timer:
+        """Context manager recording an operation of phase on the device serial"""
+
+        return Timer(self, phase, serial)
+
+    def observe(self, phase: str, serial: str, seconds: float, size: int = 0, failed: bool = False) -> None:
+        """Records an operation already measured"""
+
+        if not self.enabled:
+            return
+        with self.lock:
+            if (histogram := self.phases.get(phase)) is None:
+                histogram = self.phases[phase] = Histogram()
+            histogram.observe(seconds, size, failed)
+            if serial:
+                if (totals := self.devices.get((phase, serial))) is None:
+                    totals = self.devices[(phase, serial)] = [0, 0.0, 0, 0]
+                totals[0] += 1
+                totals[1] += seconds
+                totals[2] += size
+                totals[3] += failed
+
+    def to_dict(self) -> dict:
+        with self.lock:
+            devices = dict()
+            for (phase, serial), (count, seconds, size, errors) in sorted(self.devices.items()):
+                devices.setdefault(serial, dict())[phase] = {'count': count, 'sum': seconds, 'bytes': size,
+                                                             'errors': errors}
+            return {
+                'command': self.command,
+                'started': self.started,
+                'elapsed': time.time() - self.started,
+                'phases': {phase: histogram.to_dict() for phase, histogram in sorted(self.phases.items())},
+                'devices': devices
+            }
+
+    def to_prometheus(self) -> str:
+        """Metrics in the Prometheus text exposition format"""
+
+        data = self.to_dict()
+        command = f'command="{data["command"]}"'
+        lines = ['# HELP pyadb_command_seconds Duration of the whole command',
+                 '# TYPE pyadb_command_seconds gauge',
+                 f'pyadb_command_seconds{{{command}}} {data["elapsed"]}',
+                 '# HELP pyadb_phase_seconds Duration of the operations of every phase',
+                 '# TYPE pyadb_phase_seconds histogram']
+        for phase, histogram in data['phases'].items():
+            labels = f'{command},phase="{phase}"'
+            lines += [f'pyadb_phase_seconds_bucket{{{labels},le="{bound}"}} {count}'
+                      for bound, count in histogram['buckets'].items()]
+            lines += [f'pyadb_phase_seconds_sum{{{labels}}} {histogram["sum"]}',
+                      f'pyadb_phase_seconds_count{{{labels}}} {histogram["count"]}']
+
+        for name, key, help_text in (('bytes', 'bytes', 'Bytes transferred'),
+                                     ('errors', 'errors', 'Failed operations')):
+            lines += [f'# HELP pyadb_phase_{name}_total {help_text} by every phase',
+                      f'# TYPE pyadb_phase_{name}_total counter']
+            lines += [f'pyadb_phase_{name}_total{{{command},phase="{phase}"}} {histogram[key]}'
+                      for phase, histogram in data['phases'].items()]
+
+        for name, key, help_text in (('operations', 'count', 'Operations'), ('seconds', 'sum', 'Time spent'),
+                                     ('bytes', 'bytes', 'Bytes transferred'), ('errors', 'errors', 'Failures')):
+            lines += [f'# HELP pyadb_device_{name}_total {help_text} of every device by phase',
+                      f'# TYPE pyadb_device_{name}_total counter']
+            lines += [f'pyadb_device_{name}_total{{{command},phase="{phase}",serial="{serial}"}} {totals[key]}'
+                      for serial, phases in data['devices'].items() for phase, totals in phases.items()]
+        return '\n'.join(lines) + '\n'
+
+    def export(self) -> None:
+        """
+        Writes the metrics into the path given to enable(): a Prometheus
+        textfile if it ends with .prom, JSON otherwise. The file is replaced
+        atomically, so a collector never reads it half written.
+        """
+
+        if not self.enabled or self.path is None:
+            return
+        content = self.to_prometheus() if self.path.endswith('.prom') else json.dumps(self.to_dict(), indent=2)
+        temp = f'{self.path}.{os.getpid()}.tmp'
+        with open(temp, 'w') as f:
+            f.write(content)
+        os.replace(temp, self.path)
+
+
+metrics = Metrics()
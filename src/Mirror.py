@@ -0,0 +1,122 @@
+import os
+import signal
+from typing import Optional, Dict, List, Callable
+
+from Utils import LazyModule, shards
+
+# VARIABLES
+
+asyncio = LazyModule('asyncio')
+presets = {
+    'high': ['-b', '8M'],
+    'medium': ['-b', '4M', '--max-size=1280', '--max-fps=30'],
+    'low': ['-b', '2M', '--max-size=800', '--max-fps=15']
+}
+preset_names = ('auto', *presets)
+
+
+class SessionLimit(Exception):
+    """Raised when a mirror is requested while the maximum number of sessions is running"""
+
+    def __init__(self, limit: int):
+        super(SessionLimit, self).__init__(f'{limit} mirrors are already running')
+        self.limit = limit
+
+
+class Session:
+    """A scrcpy process mirroring a single device"""
+
+    def __init__(self, serial: str, preset: str, process: 'asyncio.subprocess.Process'):
+        self.serial = serial
+        self.preset = preset
+        self.process = process
+        self.error: Optional[str] = None
+
+
+class MirrorManager:
+    """
+    Runs scrcpy sessions as child processes, at most one per device and at
+    most limit at once, without blocking the event loop. With the auto
+    preset the quality is chosen when a session starts, by the number of
+    sessions that will run: one mirror gets the full bitrate, a few share a
+    medium one, many get a low resolution and frame rate, so the adb
+    transport and the host decoder keep up with all of them.
+    """
+
+    def __init__(self, limit: int = 4, preset: str = 'auto',
+                 on_change: Optional[Callable[[Session], None]] = None):
+        self.limit = limit
+        self.preset = preset
+        self.on_change = on_change
+        self.sessions: Dict[str, Session] = dict()
+        self.tasks: List['asyncio.Task'] = []
+
+    def __contains__(self, serial: str) -> bool:
+        return serial in self.sessions
+
+    def __len__(self) -> int:
+        return len(self.sessions)
+
+    def preset_for(self, running: int) -> str:
+        """Preset of a new session started while running sessions are active"""
+
+        if self.preset != 'auto':
+            return self.preset
+        return 'high' if running == 0 else 'medium' if running < 4 else 'low'
+
+    async def start(self, serial: str) -> Session:
+        """
+        Launches scrcpy for a device connected to the adb server, the one of
+        its shard. A second request for the same device returns the running
+        session.
+
+        :param serial: Device serial
+        :return: The session
+        """
+
+        if (session := self.sessions.get(serial)) is not None:
+            return session
+        if len(self.sessions) >= self.limit:
+            raise SessionLimit(self.limit)
+
+        preset = self.preset_for(len(self.sessions))
+        process = await asyncio.create_subprocess_exec(
+            'scrcpy', f'--serial={serial}', f'--window-title={serial}', *presets[preset],
+            stdin=asyncio.subprocess.DEVNULL, stdout=asyncio.subprocess.DEVNULL, stderr=asyncio.subprocess.PIPE,
+            env={**os.environ, 'ANDROID_ADB_SERVER_PORT': str(shards.port(serial))})
+        session = self.sessions[serial] = Session(serial, preset, process)
+        self.tasks.append(asyncio.get_running_loop().create_task(self._wait(session)))
+        self._changed(session)
+        return session
+
+    async def _wait(self, session: Session) -> None:
+        _, stderr = await session.process.communicate()
+        del self.sessions[session.serial]
+        if session.process.returncode not in (0, -signal.SIGTERM):
+            lines = [line.strip() for line in stderr.decode(errors='replace').splitlines() if line.strip()]
+            session.error = lines[-1] if lines else f'exit code {session.process.returncode}'
+        self._changed(session)
+
+    def _changed(self, session: Session) -> None:
+        if self.on_change is not None:
+            self.on_change(session)
+
+    def stop(self, serial: str) -> None:
+        """Closes the mirror of a device, if any"""
+
+        if (session := self.sessions.get(serial)) is not None and session.process.returncode is None:
+            session.process.terminate()
+
+    async def wait(self) -> None:
+        """Waits until every session is closed"""
+
+        while self.tasks:
+            tasks, self.tasks = self.tasks, []
+            await asyncio.gather(*tasks)
+
+    async def close(self) -> None:
+        """Closes every mirror and waits for them"""
+
+        for serial in list(self.sessions):
+            self.stop(serial)
+        await self.wait()
@@ -1,179 +1,2198 @@
 import os
 import sys
+import errno
+import importlib
+import hashlib
+import shlex
+import json
+import sqlite3
+import re
+import math
+import time
+import struct
+import fnmatch
+import bisect
+import heapq
+import mmap
+import socket
 import subprocess
-from rich.align import Align
-from rich.panel import Panel
-from textual.widget import Widget
-from textual.app import App
-from textual.reactive import Reactive
-from textual.events import *
-import pickle
-from rich.console import RenderableType, Console
-from rich.progress import Column, Text, StyleType, Task, JustifyMethod, ProgressColumn
-from typing import Optional, Set, Any
+import threading
+import selectors
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+from types import ModuleType
+from typing import Optional, Set, Any, Callable, Iterable, Iterator, NamedTuple, Dict, List, TextIO, Tuple, Deque
 from appdirs import *
-from adbutils import adb
-from rich.table import Table
+
+from Metrics import metrics
+
+
+class LazyModule:
+    """
+    Proxy that imports the module only the first time one of its attributes
+    is used. The import machinery serializes concurrent first uses, so the
+    threads never see a module that is still being executed.
+    """
+
+    def __init__(self, name: str):
+        self.name = name
+        self.module: Optional[ModuleType] = None
+
+    def __getattr__(self, name: str) -> Any:
+        if self.module is None:
+            self.module = importlib.import_module(self.name)
+        return getattr(self.module, name)
+
+
+class LazyConsole:
+    """Proxy that creates the rich console only the first time it is used"""
+
+    def __init__(self):
+        self.instance = None
+
+    def __getattr__(self, name: str) -> Any:
+        if self.instance is None:
+            from rich.console import Console
+            self.instance = Console()
+        return getattr(self.instance, name)
+
+
+adbutils = LazyModule('adbutils')
 
 # VARIABLES
 
-console = Console()
+console = LazyConsole()
 cache_name = 'MIM_Orchestrator'
 cache_author = 'Bessi-Cardinaletti'
+default_workers = 64
+connect_styles = {
+    'connected': 'bold green',
+    'already connected': 'bold blue',
+    'refused': 'bold red',
+    'timeout': 'bold yellow',
+    'error': 'bold red',
+    'skipped': 'dim'
+}
+screencap_formats = {1: ('RGBX', 4), 2: ('RGBX', 4), 3: ('RGB', 3), 4: ('BGR;16', 2), 5: ('BGRX', 4)}
 
 
 # UTILS
 
-def cache_save(name: str, obj: object) -> None:
+def get_by_status(status: str) -> list:
+    """
+    Utility function to get devices by status.
+
+    :param status: Status
+    :return: A list
+    """
+
+    return registry.by_status(status)
+
+
+def iter_masscan(f: TextIO, chunk_size: int = 1024 * 1024) -> Iterator[dict]:
+    """
+    Parses incrementally a masscan output file, both the -oJ array format
+    and the line delimited one (-oD). Only one chunk of text and one record
+    are in memory at the same time.
+
+    :param f: Text file
+    :param chunk_size: Characters read at a time
+    :return: An iterator of records
+    """
+
+    decoder = json.JSONDecoder()
+    buffer = ''
+    eof = False
+    while True:
+        position = 0
+        while True:
+            while position < len(buffer) and buffer[position] in ' \t\r\n[],':
+                position += 1
+            if position == len(buffer):
+                break
+            try:
+                record, end = decoder.raw_decode(buffer, position)
+            except json.JSONDecodeError:
+                if eof:
+                    raise
+                break
+            position = end
+            yield record
+        buffer = buffer[position:]
+        if eof:
+            return
+        chunk = f.read(chunk_size)
+        eof = chunk == ''
+        buffer += chunk
+
+
+def socket_address(host: str, port: Any) -> str:
+    """Socket address of a host, with the IPv6 addresses in brackets ([::1]:5555)"""
+
+    import ipaddress
+
+    try:
+        if ipaddress.ip_address(host).version == 6:
+            return f'[{host}]:{port}'
+    except ValueError:
+        pass
+    return f'{host}:{port}'
+
+
+def iter_sockets(records: Iterable[dict], ports: Iterable[int]) -> Iterator[str]:
+    """
+    Extracts from masscan records the socket addresses open on the given ports.
+    Every address is returned only once.
+
+    :param records: Records returned by iter_masscan
+    :param ports: Accepted ports
+    :return: An iterator of socket addresses
+    """
+
+    ports = set(int(port) for port in ports)
+    seen = set()
+    for record in records:
+        if 'ip' not in record:
+            continue
+        for entry in record.get('ports') or [record]:
+            if entry.get('port') is None or int(entry['port']) not in ports:
+                continue
+            if entry.get('status', 'open') != 'open':
+                continue
+            if (addr := socket_address(record['ip'], entry['port'])) not in seen:
+                seen.add(addr)
+                yield addr
+
+
+class Outcome(NamedTuple):
+    """Result of a single job executed by run_parallel"""
+
+    item: Any
+    value: Any
+    error: Optional[BaseException]
+    elapsed: float
+
+
+def congested(outcome: Outcome) -> bool:
+    """
+    Tells if a job failed the way it fails when the network or the device is
+    overloaded: it timed out, lost its connection or a connection attempt
+    timed out. An offline host fails the same way, so the Scheduler looks at
+    the rate of these failures and not at the single ones.
+    """
+
+    if outcome.error is not None:
+        return isinstance(outcome.error, (TimeoutError, ConnectionError, adbutils.AdbTimeout))
+    return outcome.value == 'timeout'
+
+
+def subnet_of(item: Any) -> Optional[str]:
+    """The /24 (or /64) subnet of the address of a device, None for USB devices"""
+
+    import ipaddress
+
+    host = str(getattr(item, 'serial', item)).rsplit(':', 1)[0].strip('[]')
+    try:
+        address = ipaddress.ip_address(host)
+    except ValueError:
+        return None
+    return str(ipaddress.ip_network(f'{address}/{24 if address.version == 4 else 64}', strict=False))
+
+
+class Scheduler:
+    """
+    Adaptive limit of the jobs in flight of run_parallel (AIMD).
+    It starts small and doubles every window of jobs (slow start) until the
+    first sign of congestion: the recent rate of jobs timing out or losing
+    their connection rising more than margin above its baseline, or, with
+    latency, the recent job time rising above tolerance times the long-term
+    one (and more than floor seconds above it). Latency is meant for jobs that
+    are mostly a network round trip (connections, short queries): the time of
+    a command or a transfer depends on the command or the payload.
+    After a cut the limit is multiplied by backoff, and grows again by one job
+    every window. Jobs started before a cut cannot cut it again, so a burst of
+    failures caused by the same congestion shrinks the limit only once, while
+    a sustained overload keeps cutting it down to what the network sustains.
+    The baseline starts at zero, only follows the failure rate downwards, and
+    is frozen during congestion. When the limit was cut down to bottom and the
+    jobs keep failing, the failures do not depend on the concurrency (a sweep
+    of mostly offline hosts): their rate becomes the baseline, and the limit
+    goes back to where it was before the cuts.
+    With subnet_cap, at most that many jobs run on the devices of the same
+    subnet (e.g. behind the same access point) at the same time.
+    """
+
+    adaptive = True
+    subnet_cap = 0
+
+    def __init__(self, workers: int, latency: bool = False, initial: int = 8, backoff: float = 0.7,
+                 tolerance: float = 2.0, floor: float = 0.05, margin: float = 0.3, bottom: float = 4.0):
+        self.ceiling = max(1, workers)
+        self.limit = float(min(self.ceiling, initial) if self.adaptive else self.ceiling)
+        self.latency = latency
+        self.backoff = backoff
+        self.tolerance = tolerance
+        self.floor = floor
+        self.margin = margin
+        self.bottom = bottom
+        self.slow_start = True
+        self.started = 0
+        self.recovery = 0
+        self.healthy: Optional[Tuple[float, bool]] = None
+        self.short: Optional[float] = None
+        self.long: Optional[float] = None
+        self.failing: Optional[float] = None
+        self.average: Optional[float] = None
+        self.baseline = 0.0
+        self.subnets: Dict[str, int] = dict()
+
+    def fits(self, subnet: Optional[str]) -> bool:
+        return not self.subnet_cap or subnet is None or self.subnets.get(subnet, 0) < self.subnet_cap
+
+    def start(self, subnet: Optional[str]) -> Tuple[int, Optional[str]]:
+        """Accounts a job that starts, returning what finish() needs to know about it"""
+
+        if subnet is not None:
+            self.subnets[subnet] = self.subnets.get(subnet, 0) + 1
+        self.started += 1
+        return self.started, subnet
+
+    def finish(self, outcome: Outcome, sequence: int, subnet: Optional[str]) -> None:
+        """Adapts the limit to the outcome of a finished job"""
+
+        if subnet is not None:
+            self.subnets[subnet] -= 1
+        if not self.adaptive:
+            return
+
+        failure = float(congested(outcome))
+        self.failing = failure if self.failing is None else 0.9 * self.failing + 0.1 * failure
+        self.average = failure if self.average is None else 0.99 * self.average + 0.01 * failure
+        self.baseline = min(self.baseline, self.average)
+        congestion = self.failing > self.baseline + self.margin
+
+        if self.latency and outcome.error is None and not failure:
+            self.short = outcome.elapsed if self.short is None else 0.8 * self.short + 0.2 * outcome.elapsed
+            self.long = outcome.elapsed if self.long is None else 0.98 * self.long + 0.02 * outcome.elapsed
+            congestion = congestion or self.short > max(self.tolerance * self.long, self.long + self.floor)
+
+        if congestion:
+            if sequence > self.recovery:
+                if self.healthy is None:
+                    self.healthy = (self.limit, self.slow_start)
+                if self.limit <= self.bottom and failure and self.failing > self.baseline + self.margin:
+                    # cutting did not help: the failures do not come from the concurrency
+                    self.baseline = self.average = self.failing
+                    self.limit, self.slow_start = self.healthy
+                    self.healthy = None
+                else:
+                    self.limit = max(1.0, self.limit * self.backoff)
+                    self.slow_start = False
+                self.recovery = self.started
+        else:
+            if self.healthy is not None and self.limit >= self.healthy[0]:
+                self.healthy = None
+            if self.slow_start:
+                self.limit = min(self.ceiling, self.limit + 1)
+            else:
+                self.limit = min(self.ceiling, self.limit + 1 / self.limit)
+
+
+def run_parallel(func: Callable[[Any], Any], items: Iterable[Any], workers: int = default_workers,
+                 latency: bool = False) -> Iterator[Outcome]:
+    """
+    Runs func on every item with a bounded pool of threads.
+    Items are consumed lazily and outcomes are yielded as soon as each job
+    finishes. The number of jobs in flight is adapted by a Scheduler between
+    1 and workers, following the congestion failures and, with latency, the
+    time of the jobs.
+
+    :param func: Function called with a single item
+    :param items: Items to process
+    :param workers: Max number of concurrent jobs
+    :param latency: Flag to also cut the jobs in flight when they get slower (for network round trips only)
+    :return: An iterator of outcomes, in completion order
+    """
+
+    def job(item: Any) -> Outcome:
+        start = time.perf_counter()
+        try:
+            return Outcome(item, func(item), None, time.perf_counter() - start)
+        except Exception as e:
+            return Outcome(item, None, e, time.perf_counter() - start)
+
+    scheduler = Scheduler(workers, latency)
+    iterator = iter(items)
+    deferred = deque()
+    with ThreadPoolExecutor(max_workers=scheduler.ceiling) as pool:
+        pending = dict()
+        exhausted = False
+        while pending or deferred or not exhausted:
+            while len(pending) < int(scheduler.limit):
+                entry = next((entry for entry in deferred if scheduler.fits(entry[1])), None)
+                if entry is not None:
+                    deferred.remove(entry)
+                elif exhausted or len(deferred) >= 4 * scheduler.ceiling:
+                    break
+                else:
+                    try:
+                        item = next(iterator)
+                    except StopIteration:
+                        exhausted = True
+                        continue
+                    entry = (item, subnet_of(item) if scheduler.subnet_cap else None)
+                    if not scheduler.fits(entry[1]):
+                        deferred.append(entry)
+                        continue
+                item, subnet = entry
+                pending[pool.submit(job, item)] = scheduler.start(subnet)
+            if not pending:
+                break
+            done, _ = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                outcome = future.result()
+                scheduler.finish(outcome, *pending.pop(future))
+                yield outcome
+
+
+class Transient(Exception):
+    """Wraps the errors that RetryPolicy has to retry"""
+
+
+class RetryPolicy:
+    """
+    Retries of the device operations, with exponential backoff and a random
+    jitter, so the devices failing together do not retry together.
+    """
+
+    tries = 3
+    delay = 0.5
+    max_delay = 8.0
+    unreachable = (errno.ENETUNREACH, errno.EHOSTUNREACH, errno.ENETDOWN, errno.EHOSTDOWN)
+    offline = re.compile(r"device offline|device '.*' not found|no devices/emulators found|"
+                         r"device still (connecting|authorizing)")
+
+    @staticmethod
+    def message(e: Exception) -> str:
+        return str(e.args[0]) if e.args else ''
+
+    @classmethod
+    def transient(cls, e: Exception) -> bool:
+        """
+        Errors of the transport: the connection was refused, broke or timed
+        out, or the device is offline. They are worth retrying for idempotent
+        operations (transfers, queries), and they are the only ones counted by
+        the circuit breakers. The errors of the request (a missing remote
+        file, a denied permission, a local file that cannot be written) are not.
+        """
+
+        if isinstance(e, (ConnectionError, TimeoutError, adbutils.AdbTimeout)):
+            return True
+        if isinstance(e, OSError):
+            return e.errno in cls.unreachable
+        return type(e) is adbutils.AdbError and (cls.offline.search(cls.message(e)) is not None
+                                                 or cls.message(e) in ('closed', 'connection closed'))
+
+    @classmethod
+    def rejected(cls, e: Exception) -> bool:
+        """
+        Errors raised before the operation reached the device: the only ones
+        worth retrying for operations that must not run twice (shell commands)
+        """
+
+        return isinstance(e, ConnectionRefusedError) or (type(e) is adbutils.AdbError
+                                                         and cls.offline.search(cls.message(e)) is not None)
+
+    @classmethod
+    def call(cls, func: Callable[[], Any], transient: Optional[Callable[[Exception], bool]] = None) -> Any:
+        """
+        Calls func until it succeeds or it fails with a non transient error,
+        at most tries times. The last error is raised as it is.
+
+        :param func: Operation
+        :param transient: Function telling if an error is worth retrying (default: RetryPolicy.transient)
+        :return: The result of func
+        """
+
+        from retry.api import retry_call
+
+        transient = transient or cls.transient
+
+        def attempt() -> Any:
+            try:
+                return func()
+            except Exception as e:
+                if transient(e):
+                    raise Transient() from e
+                raise
+
+        try:
+            return retry_call(attempt, exceptions=Transient, tries=max(1, cls.tries), delay=cls.delay,
+                              max_delay=cls.max_delay, backoff=2, jitter=(0, cls.delay), logger=None)
+        except Transient as e:
+            raise e.__cause__ from None
+
+
+class CircuitOpen(Exception):
+    """Raised instead of operating on a device whose circuit breaker is open"""
+
+    def __init__(self, serial: str, failures: int, until: float):
+        super().__init__(f'skipped, it failed {failures} times in a row '
+                         f'(next attempt after {time.strftime("%H:%M:%S", time.localtime(until))})')
+        self.serial = serial
+
+
+class CircuitBreaker:
+    """
+    Remembers across runs, in the device store, the devices that keep failing.
+    After threshold consecutive failed operations the breaker of a device
+    opens and the device is skipped until the cool-down expires. Then a
+    single operation is let through: a success closes the breaker, a failure
+    opens it again for twice the previous cool-down (up to max_cooldown).
+    """
+
+    threshold = 3
+    cooldown = 300.0
+    max_cooldown = 86400.0
+    enabled = True
+
+    def __init__(self, store: 'DeviceStore'):
+        self.store = store
+        self.states = store.breakers()
+        self.changed: Set[str] = set()
+
+    def check(self, serial: str) -> None:
+        """Raises CircuitOpen if the device has to be skipped"""
+
+        state = self.states.get(serial)
+        if self.enabled and state is not None and state[2] > time.time():
+            raise CircuitOpen(serial, state[0], state[2])
+
+    def record(self, serial: str, success: bool) -> None:
+        """Updates the breaker of the device with the result of an operation"""
+
+        state = self.states.setdefault(serial, [0, 0, 0.0])
+        if success:
+            if state[0] == 0:
+                return
+            state[:] = [0, 0, 0.0]
+        else:
+            state[0] += 1
+            if state[0] >= self.threshold:
+                state[2] = time.time() + min(self.max_cooldown, self.cooldown * 2 ** state[1])
+                state[1] += 1
+        self.changed.add(serial)
+
+    def save(self) -> None:
+        """Persists the breakers changed since the last save"""
+
+        self.store.save_breakers({serial: self.states[serial] for serial in self.changed})
+        self.changed.clear()
+
+
+def run_guarded(func: Callable[[Any], Any], items: Iterable[Any], workers: int = default_workers,
+                success: Optional[Callable[[Outcome], bool]] = None,
+                breaker: Optional[CircuitBreaker] = None, latency: bool = False) -> Iterator[Outcome]:
+    """
+    Like run_parallel, but the items are devices (serials, addresses or
+    device events) protected by their circuit breaker: the ones with an open
+    breaker are not processed, and yielded with a CircuitOpen error, while the
+    outcome of the others updates their breaker. An error that is not a
+    transport one (see RetryPolicy.transient) leaves the breaker as it is.
+
+    :param func: Function called with a single item
+    :param items: Devices to process
+    :param workers: Max number of concurrent jobs
+    :param success: Function telling if an outcome is a success (default: it has no error)
+    :param breaker: Circuit breakers (default: the ones of the device store, opened and closed here)
+    :param latency: Flag to also cut the jobs in flight when they get slower (for network round trips only)
+    :return: An iterator of outcomes, in completion order
+    """
+
+    store = None if breaker is not None else DeviceStore()
+    breaker = breaker or CircuitBreaker(store)
+    success = success or (lambda outcome: outcome.error is None)
+    skipped = []
+
+    def allowed() -> Iterator[Any]:
+        for item in items:
+            try:
+                breaker.check(str(getattr(item, 'serial', item)))
+                yield item
+            except CircuitOpen as e:
+                skipped.append(Outcome(item, None, e, 0.0))
+
+    try:
+        for outcome in run_parallel(func, allowed(), workers, latency):
+            if outcome.error is None or RetryPolicy.transient(outcome.error):
+                breaker.record(str(getattr(outcome.item, 'serial', outcome.item)), success(outcome))
+            while skipped:
+                yield skipped.pop()
+            yield outcome
+        while skipped:
+            yield skipped.pop()
+    finally:
+        breaker.save()
+        if store is not None:
+            store.close()
+
+
+def connect_device(addr: str, timeout: float = 2.0) -> str:
+    """
+    Connects the given socket to the adb server and classifies the answer.
+
+    :param addr: Socket address
+    :param timeout: Timeout of the single attempt (seconds)
+    :return: One of 'connected', 'already connected', 'refused', 'timeout', 'error'
+    """
+
+    with metrics.timed('connect', addr) as timer:
+        result = _connect(addr, timeout)
+        timer.failed = result not in ('connected', 'already connected')
+    return result
+
+
+def _connect(addr: str, timeout: float) -> str:
+    try:
+        answer = RetryPolicy.call(lambda: shards.owner(addr).connect(addr, timeout=timeout), RetryPolicy.rejected)
+    except adbutils.AdbTimeout:
+        return 'timeout'
+    except adbutils.AdbError:
+        return 'error'
+
+    if 'already' in answer:
+        return 'already connected'
+    if 'failed' in answer or 'unable' in answer:
+        return 'timeout' if 'timed out' in answer else 'refused'
+    return 'connected'
+
+
+def installed_version(serial: str, package: str) -> Optional[int]:
     """
-    Saves to a cache file the passed object with pickle module.
+    Asks the device which version of the package is installed.
 
-    :param name: File name
-    :param obj: Object
+    :param serial: Device serial
+    :param package: Package name
+    :return: The versionCode, None if the package is not installed
+    """
+
+    with metrics.timed('shell', serial):
+        output = RetryPolicy.call(lambda: shards.device(serial).shell(
+            f'dumpsys package {package} | grep -m 1 versionCode='))
+    match = re.search(r'versionCode=(\d+)', output)
+    return int(match.group(1)) if match else None
+
+
+def fetch_properties(serial: str) -> Dict[str, str]:
+    """
+    Reads all the system properties of a device with a single getprop.
+
+    :param serial: Device serial
+    :return: A dict name -> value
+    """
+
+    with metrics.timed('shell', serial):
+        output = RetryPolicy.call(lambda: shards.device(serial).shell('getprop', timeout=30))
+    return dict(re.findall(r'^\[([^\]]+)\]: \[(.*)\]$', output, re.MULTILINE))
+
+
+def install_apk(serial: str, source: 'SharedSource', package: str, version: int) -> None:
+    """
+    Pushes the apk mapped by source to the device and installs it.
+    If the device refuses to update the package (downgrade or different
+    signature) it will be uninstalled first. The pushed apk is removed
+    whatever the result.
+
+    :param serial: Device serial
+    :param source: Apk file
+    :param package: Package name
+    :param version: Package versionCode
     :return: None
     """
 
-    if not os.path.exists(user_cache_dir(cache_name, cache_author)):
-        os.mkdir(user_cache_dir(cache_name, cache_author))
+    device = shards.device(serial)
+    remote = f'/data/local/tmp/{package}-{version}.apk'
+    with metrics.timed('push', serial) as timer:
+        timer.bytes = RetryPolicy.call(lambda: device.sync.push(source.reader(), remote))
+    try:
+        try:
+            with metrics.timed('install', serial):
+                device.install_remote(remote)
+        except adbutils.AdbInstallError as e:
+            if e.reason not in ('INSTALL_FAILED_PERMISSION_MODEL_DOWNGRADE',
+                                'INSTALL_FAILED_UPDATE_INCOMPATIBLE',
+                                'INSTALL_FAILED_VERSION_DOWNGRADE'):
+                raise
+            with metrics.timed('install', serial):
+                device.uninstall(package)
+                device.install_remote(remote)
+    finally:
+        try:
+            device.shell(['rm', '-f', remote])
+        except (OSError, adbutils.AdbError):
+            pass
 
-    mode = 'wb'
-    if os.path.exists(user_cache_dir(cache_name, cache_author) + '/' + name + '.pkl'):
-        mode = 'ab'
 
-    with open(user_cache_dir(cache_name, cache_author) + '/' + name + '.pkl', mode) as f:
-        pickle.dump(obj, f)
-    console.print(f'[green]CACHE[/]: {obj} saved to cache.')
+def remote_tree(serial: str, root: str, hashes: bool = False) -> Dict[str, Tuple[str, Optional[str]]]:
+    """
+    Lists every file under a remote directory with a single shell round trip.
+
+    :param serial: Device serial
+    :param root: Remote directory
+    :param hashes: Flag to also compute the md5 of the files
+    :return: A dict relative path -> (size and mtime, md5 or None)
+    """
+
+    tools = "-exec stat -c '%s %Y %n' {} +" + (' -exec md5sum {} +' if hashes else '')
+    with metrics.timed('shell', serial):
+        output = RetryPolicy.call(lambda: shards.device(serial).shell(
+            f'find {shlex.quote(root)} -type f {tools} 2>/dev/null'))
+    prefix = root.rstrip('/') + '/'
+    stats, md5s = dict(), dict()
+    for line in output.splitlines():
+        if re.match(r'[0-9a-f]{32}  ', line):
+            md5s[line[34:]] = line[:32]
+        else:
+            size, mtime, path = (line.split(' ', 2) + ['', ''])[:3]
+            stats[path] = f'{size} {mtime}'
+    return {path[len(prefix):]: (stat, md5s.get(path)) for path, stat in stats.items() if path.startswith(prefix)}
 
 
-def cache_recall(name: str) -> Optional[Set[Any]]:
+def sync_tree(serial: str, local: Dict[str, Tuple[str, str]], root: str, store: 'DeviceStore',
+              hashes: bool = False) -> Tuple[int, int, int]:
     """
-    Loads into a set the content of the cache file.
+    Pushes to a device only the files that are new or changed since the last
+    synchronization of the remote directory. Remote files missing locally are left alone.
+    A file is unchanged if its remote size and mtime are the ones saved in the
+    manifest after the last push of the same md5 (or, with hashes, if the remote md5
+    is the local one).
+    The remote directory is listed once; it is listed again, to record the
+    mtimes given by the device, only if some file was pushed.
 
-    :param name: File name
-    :return: A set
+    :param serial: Device serial
+    :param local: A dict relative path -> (md5, absolute local path)
+    :param root: Remote directory
+    :param store: Device store keeping the manifests
+    :param hashes: Flag to compare remote md5 instead of the manifest
+    :return: Files pushed, bytes pushed, files unchanged
     """
 
-    if not os.path.exists(user_cache_dir(cache_name, cache_author)):
-        os.mkdir(user_cache_dir(cache_name, cache_author))
+    device = shards.device(serial)
+    manifest = store.manifest(serial, root)
+    remote = remote_tree(serial, root, hashes)
 
-    if not os.path.exists(user_cache_dir(cache_name, cache_author) + '/' + name + '.pkl'):
-        console.print(f'[red]CACHE[/]: {name}.pkl does not exist.')
-        sys.exit()
+    changed = []
+    for path, (md5, _) in local.items():
+        if path not in remote:
+            changed.append(path)
+        elif hashes:
+            if remote[path][1] != md5:
+                changed.append(path)
+        elif manifest.get(path) != (md5, remote[path][0]):
+            changed.append(path)
 
-    with open(user_cache_dir(cache_name, cache_author) + '/' + name + '.pkl', 'rb') as f:
-        obj = pickle.load(f)
-    console.print(f'[green]CACHE[/]: {obj} loaded from cache.')
-    return set(obj)
+    pushed = 0
+    for path in changed:
+        with metrics.timed('push', serial) as timer:
+            timer.bytes = RetryPolicy.call(lambda: device.sync.push(local[path][1], root.rstrip('/') + '/' + path))
+        pushed += timer.bytes
 
+    if changed:
+        remote = remote_tree(serial, root)
+    files = {path: (md5, remote[path][0]) for path, (md5, _) in local.items() if path in remote}
+    if files != manifest:
+        store.save_manifest(serial, root, files)
+    return len(changed), pushed, len(local) - len(changed)
 
-def get_by_status(status: str) -> list:
+
+def pull_remote(serial: str, remote: str, local: str, callback: Optional[Callable[[int], None]] = None) -> int:
     """
-    Utility function to get devices by status.
+    Streams a remote file straight into a local one, chunk by chunk, so it
+    is never held in memory. If the transfer fails the partial file is removed
+    and, if the error is transient, the transfer starts again.
 
-    :param status: Status
-    :return: A list
+    :param serial: Device serial
+    :param remote: Remote path/to/file
+    :param local: Local path/to/file
+    :param callback: Function called with the size of every chunk written (negative when a partial file is discarded)
+    :return: Number of bytes written
     """
 
-    device_tracker = adb.track_devices()
-    devices = []
-    for device in [next(device_tracker) for _ in range(len(adb.device_list()))]:
-        if device.status == status:
-            devices.append(device)
-    return devices
+    def attempt() -> int:
+        size = 0
+        try:
+            with open(local, 'wb') as f:
+                for chunk in shards.device(serial).sync.iter_content(remote):
+                    f.write(chunk)
+                    size += len(chunk)
+                    if callback is not None:
+                        callback(len(chunk))
+        except BaseException:
+            if os.path.exists(local):
+                os.remove(local)
+            if callback is not None and size:
+                callback(-size)
+            raise
+        return size
+
+    with metrics.timed('pull', serial) as timer:
+        timer.bytes = RetryPolicy.call(attempt)
+    return timer.bytes
+
+
+def capture_screen(serial: str, timeout: float = 30.0) -> 'Image.Image':
+    """
+    Captures the screen of the device reading the raw framebuffer of
+    screencap through the exec service: the device spends no time encoding
+    a PNG and no byte is translated by a terminal. The pixels are received
+    into a single buffer and decoded as RGB, the alpha of a screen being
+    always opaque, so the image is never copied to be resized or saved.
+
+    :param serial: Device serial
+    :param timeout: Timeout of every read (seconds)
+    :return: An RGB image
+    """
+
+    from PIL import Image
+
+    def attempt() -> 'Image.Image':
+        with shards.device(serial).open_transport(timeout=timeout) as conn:
+            conn.send_command('exec:screencap')
+            conn.check_okay()
+            if len(header := conn.read(12)) < 12:
+                raise adbutils.AdbError('screencap returned no header')
+            width, height, pixel_format = struct.unpack('<III', header)
+            if pixel_format not in screencap_formats or width * height == 0:
+                raise adbutils.AdbError(f'unsupported screen {width}x{height} format {pixel_format}')
+            raw_mode, depth = screencap_formats[pixel_format]
+
+            # since Android 9 the header has a fourth field, the color space
+            buffer = bytearray(width * height * depth + 4)
+            view, received = memoryview(buffer), 0
+            while received < len(buffer) and (size := conn.conn.recv_into(view[received:])):
+                received += size
+
+        if (offset := received - width * height * depth) not in (0, 4):
+            raise adbutils.AdbError(f'screencap truncated after {received} bytes')
+        timer.bytes = len(header) + received
+        return Image.frombytes('RGB', (width, height), view[offset:received], 'raw', raw_mode)
+
+    with metrics.timed('screencap', serial) as timer:
+        return RetryPolicy.call(attempt)
+
+
+class ScriptResult(NamedTuple):
+    """Output and exit code of a single command of a script, returncode is None if it did not run"""
+
+    command: str
+    output: str
+    returncode: Optional[int]
+
+
+class Script:
+    """
+    List of shell commands run on a device in a single shell session, so
+    a runbook costs one round trip instead of one per command. The commands
+    are wrapped in a function, which the shell parses completely before
+    running it: the commands cannot read the rest of the script from the
+    session input, and the working directory and the variables are kept
+    from one command to the next. After every command a line with a random
+    marker, its index and its exit code is printed, and the output is split
+    back on these lines.
+    """
+
+    def __init__(self, commands: List[str]):
+        self.commands = commands
+        self.marker = f'pyadb-{os.urandom(8).hex()}'
+
+    @classmethod
+    def load(cls, path: str) -> 'Script':
+        """Reads a script file with one command per line, ignoring blank lines and # comments"""
+
+        with open(path, 'r') as f:
+            return cls([line.strip() for line in f if line.strip() and not line.lstrip().startswith('#')])
+
+    def source(self) -> str:
+        lines = ['pyadb_script() {']
+        for index, command in enumerate(self.commands):
+            lines += [command, f"printf '\\n{self.marker} {index} %d\\n' $?"]
+        lines += ['}', 'pyadb_script </dev/null 2>&1', 'exit']
+        return '\n'.join(lines) + '\n'
+
+    def parse(self, output: str) -> List[ScriptResult]:
+        """
+        Splits the output of the session by command. If the session ended
+        early (an exit, or a syntax error) the rest of the output goes to the
+        first command that did not finish.
+        """
+
+        results, start = [], 0
+        for match in re.finditer(rf'\n?{self.marker} (\d+) (\d+)\n', output):
+            results.append(ScriptResult(self.commands[int(match.group(1))], output[start:match.start()],
+                                        int(match.group(2))))
+            start = match.end()
+        for command in self.commands[len(results):]:
+            results.append(ScriptResult(command, output[start:], None))
+            start = len(output)
+        return results
+
+
+def run_script(serial: str, script: Script) -> List[ScriptResult]:
+    """
+    Runs a script on a device in a single shell session. Only the failures
+    happening before the session is open are retried, a script is never
+    run twice.
+
+    :param serial: Device serial
+    :param script: Script
+    :return: The result of every command of the script
+    """
+
+    def attempt() -> str:
+        session = shards.device(serial).shell('sh', stream=True)
+        try:
+            session.conn.sendall(source)
+            return session.read_until_close()
+        finally:
+            session.close()
+
+    source = script.source().encode()
+    with metrics.timed('shell', serial):
+        output = RetryPolicy.call(attempt, RetryPolicy.rejected)
+    return script.parse(output)
+
+
+def stream_shell(serial: str, command: str, write: Callable[[bytes], None]) -> int:
+    """
+    Runs a shell command passing its output to write chunk by chunk, as it
+    arrives, so the output is never held in memory. The exit code is read
+    from a marker line printed after the command, which is not passed on.
+    Only the failures happening before the command starts are retried.
+
+    :param serial: Device serial
+    :param command: Shell command
+    :param write: Function called with every chunk of output
+    :return: The exit code of the command
+    """
+
+    marker = f'pyadb-{os.urandom(8).hex()}'
+    device = shards.device(serial)
+    with metrics.timed('shell', serial) as timer:
+        session = RetryPolicy.call(lambda: device.shell(f"{command}\nprintf '\\n%s %d\\n' {marker} $?", stream=True),
+                                   RetryPolicy.rejected)
+        keep = len(marker) + 8
+        pending = b''
+        try:
+            while chunk := session.conn.recv(65536):
+                timer.bytes += len(chunk)
+                pending += chunk
+                if len(pending) > keep:
+                    write(pending[:-keep])
+                    pending = pending[-keep:]
+        finally:
+            session.close()
+
+        if (match := re.search(rb'\n' + marker.encode() + rb' (\d+)\n$', pending)) is None:
+            write(pending)
+            raise adbutils.AdbError('the shell session was interrupted')
+        write(pending[:match.start()])
+    return int(match.group(1))
+
+
+def open_logcat(serial: str, args: Iterable[str]) -> 'adbutils.AdbConnection':
+    """
+    Starts logcat on the device, with the epoch of every line as its first
+    field, and returns the connection its output is streamed on.
+
+    :param serial: Device serial
+    :param args: Further logcat arguments (filter specs, buffers...)
+    :return: The connection
+    """
+
+    command = ' '.join(map(shlex.quote, ['logcat', '-v', 'threadtime', '-v', 'epoch', *args]))
+    return RetryPolicy.call(lambda: shards.device(serial).shell(command, stream=True), RetryPolicy.rejected)
+
+
+def log_timestamp(line: bytes) -> Optional[float]:
+    """Epoch of a logcat line printed with -v epoch, None for the lines without it"""
+
+    try:
+        return float(line.split(None, 1)[0])
+    except (ValueError, IndexError):
+        return None
+
+
+class LogMultiplexer:
+    """
+    Follows the output of many logcat connections from a single thread: the
+    sockets are watched by a selector and every ready device gets a single
+    read per round, so a chatty device cannot starve the others. The lines
+    are held for window seconds in a heap ordered by timestamp, then
+    released in order, so the merged stream is sorted even if the devices
+    answer with different delays. A device with limit lines waiting is not
+    read until half of them are released: its socket buffers fill up and
+    the device is slowed down, so the memory stays bounded.
+    """
+
+    def __init__(self, connections: Dict[str, 'adbutils.AdbConnection'], window: float = 0.5, limit: int = 5000):
+        self.connections = connections
+        self.window = window
+        self.limit = limit
+        self.selector = selectors.DefaultSelector()
+        self.heap: List[Tuple[float, int, float, str, bytes]] = []
+        self.sequence = 0
+        self.pending: Dict[str, int] = dict.fromkeys(connections, 0)
+        self.partial: Dict[str, bytes] = dict.fromkeys(connections, b'')
+        self.last: Dict[str, float] = dict.fromkeys(connections, 0.0)
+        self.paused: Set[str] = set()
+        for serial, connection in connections.items():
+            connection.conn.setblocking(False)
+            self.selector.register(connection.conn, selectors.EVENT_READ, serial)
+
+    def lines(self) -> Iterator[List[Tuple[str, bytes]]]:
+        """
+        Yields the released lines, as batches of serial and line without the
+        newline, until every connection is closed.
+        """
+
+        while self.selector.get_map() or self.heap:
+            timeout = self.window if not self.heap else max(0.0, self.heap[0][2] + self.window - time.monotonic())
+            if self.selector.get_map():
+                for key, _ in self.selector.select(timeout):
+                    self._read(key.data, key.fileobj)
+            else:
+                time.sleep(timeout)
+            if batch := self._release(time.monotonic() - self.window):
+                yield batch
+
+    def _read(self, serial: str, conn: socket.socket) -> None:
+        try:
+            chunk = conn.recv(65536)
+        except BlockingIOError:
+            return
+        except OSError:
+            chunk = b''
+        if not chunk:
+            self.close(serial)
+            if self.partial[serial]:
+                self._push(serial, self.partial[serial], time.monotonic())
+            return
+
+        *lines, self.partial[serial] = (self.partial[serial] + chunk).split(b'\n')
+        arrival = time.monotonic()
+        for line in lines:
+            self._push(serial, line.rstrip(b'\r'), arrival)
+        if self.pending[serial] >= self.limit:
+            self.selector.unregister(conn)
+            self.paused.add(serial)
+
+    def _push(self, serial: str, line: bytes, arrival: float) -> None:
+        # the lines without a timestamp stay after the previous one of their device
+        timestamp = log_timestamp(line)
+        self.last[serial] = timestamp = timestamp if timestamp is not None else self.last[serial]
+        self.sequence += 1
+        heapq.heappush(self.heap, (timestamp, self.sequence, arrival, serial, line))
+        self.pending[serial] += 1
+
+    def _release(self, arrived: float) -> List[Tuple[str, bytes]]:
+        batch = []
+        while self.heap and (self.heap[0][2] <= arrived or not self.selector.get_map()):
+            _, _, _, serial, line = heapq.heappop(self.heap)
+            self.pending[serial] -= 1
+            batch.append((serial, line))
+        for serial in [serial for serial in self.paused if self.pending[serial] <= self.limit // 2]:
+            self.paused.discard(serial)
+            self.selector.register(self.connections[serial].conn, selectors.EVENT_READ, serial)
+        return batch
+
+    def close(self, serial: Optional[str] = None) -> None:
+        """Closes the connection of a device, or all of them"""
+
+        for serial in [serial] if serial is not None else list(self.connections):
+            if (connection := self.connections.pop(serial, None)) is None:
+                continue
+            if serial not in self.paused:
+                self.selector.unregister(connection.conn)
+            self.paused.discard(serial)
+            connection.close()
+
+
+class RotatingLog:
+    """
+    File rotated when it grows beyond size bytes: the full file is renamed
+    into path.1, path.1 into path.2 and so on, keeping at most keep of them.
+    """
+
+    def __init__(self, path: str, size: int, keep: int = 5):
+        self.path = path
+        self.size = size
+        self.keep = keep
+        self.file = open(path, 'ab')
+        self.written = self.file.tell()
+
+    def write(self, data: bytes) -> None:
+        if self.written > 0 and self.written + len(data) > self.size:
+            self.rotate()
+        self.file.write(data)
+        self.written += len(data)
+
+    def rotate(self) -> None:
+        self.file.close()
+        for index in range(self.keep - 1, 0, -1):
+            if os.path.exists(older := f'{self.path}.{index}'):
+                os.replace(older, f'{self.path}.{index + 1}')
+        if self.keep > 0:
+            os.replace(self.path, f'{self.path}.1')
+        self.file = open(self.path, 'wb')
+        self.written = 0
+
+    def close(self) -> None:
+        self.file.close()
+
+
+def raise_file_limit(needed: int) -> None:
+    """Raises the soft limit of the open files, up to the hard one, if needed descriptors would not fit"""
+
+    import resource
+
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    if soft != resource.RLIM_INFINITY and soft < needed:
+        limit = needed if hard == resource.RLIM_INFINITY else min(hard, needed)
+        resource.setrlimit(resource.RLIMIT_NOFILE, (limit, hard))
 
 
-def connected_devices() -> Table:
+def serial_dir(serial: str) -> str:
+    """Directory name usable on every filesystem for a device serial"""
+
+    return re.sub(r'[^\w.-]', '_', serial)
+
+
+def connected_devices() -> 'Table':
     """
-    Creates a table containing all the devices connected.
+    Creates a table containing all the devices connected, together with
+    the statistics of the health monitor, the sickest devices first.
 
     :return: A table
     """
 
+    from rich.table import Table
+
     table = Table(expand=True, show_lines=True)
-    table.add_column("Devices address", style="cyan bold")
-    table.add_column("Present", style="cyan bold")
+    table.add_column("Devices address", style="cyan bold", no_wrap=True)
     table.add_column("ADB status", style="cyan bold")
+    for column in ("p50 (ms)", "p95 (ms)", "p99 (ms)", "Uptime", "Failures", "Reconnects"):
+        table.add_column(column, style="cyan bold", justify="right")
 
-    devices = get_by_status('device')
-
-    with console.status('[yellow]Executing[/]', spinner='dots'):
-        for device in devices:
-            table.add_row(str(device.serial), str(device.present), str(device.status))
+    health = monitor.snapshot()
+    serials = list(health) + [device.serial for device in get_by_status('device') if device.serial not in health]
+    for serial in serials:
+        status = registry.status(serial) or 'gone'
+        if (stats := health.get(serial)) is None:
+            table.add_row(serial, status, *['-'] * 6)
+            continue
+        rtts = [stats.percentile(p) for p in (50, 95, 99)]
+        uptime = int(stats.uptime)
+        table.add_row(
+            serial, status,
+            *[f'{rtt * 1000:.1f}' if rtt is not None else '-' for rtt in rtts],
+            f'{uptime // 3600}:{uptime // 60 % 60:02d}:{uptime % 60:02d}' if stats.up_since else '-',
+            f'[bold red]{stats.failures}[/] ({stats.total_failures})' if stats.failures
+            else f'0 ({stats.total_failures})',
+            str(stats.reconnects),
+            style='red' if stats.failures else None
+        )
 
     return table
 
 
-class UpdatableTextColumn(ProgressColumn):
+class ShardPool:
     """
-    This special type of column represent an extension for the original TextColumn
-    provided from rich. With this class you can instantiate an object and call the
-    setter method to update the displayable text.
+    Local adb servers sharing the fleet, on consecutive ports starting from
+    the one of the default server. Every TCP device is owned by a single
+    server, chosen by consistent hashing of its serial, so each server
+    carries about 1/count of the transports and changing count moves only
+    about 1/count of them. USB devices always stay on the first server.
+    With a single shard the default adbutils client is used as it is.
     """
 
-    def __init__(self, text: str = '',
-                 table_column: Optional[Column] = None,
-                 style: StyleType = "none",
-                 justify: JustifyMethod = "left"
-                 ):
-        self.text = text
-        self.style = style
-        self.justify = justify
-        super().__init__(table_column=table_column)
+    replicas = 128
 
-    def set_text(self, new_text: str) -> None:
-        self.text = new_text
+    def __init__(self, count: int = 1):
+        self.lock = threading.Lock()
+        self.ports: List[int] = []
+        self.hashes: List[int] = []
+        self.owners: List[int] = []
+        self.clients: Dict[int, 'adbutils.AdbClient'] = dict()
+        self.started = False
+        self.resize(count)
+        os.register_at_fork(before=self.lock.acquire, after_in_parent=self.lock.release,
+                            after_in_child=self.lock.release)
 
-    def render(self, task: "Task") -> RenderableType:
-        text = Text(self.text, style=self.style, justify=self.justify)
-        return text
+    def resize(self, count: int) -> None:
+        """Spreads the devices over count servers, the first one listening on ANDROID_ADB_SERVER_PORT"""
 
+        base = int(os.environ.get('ANDROID_ADB_SERVER_PORT', 5037))
+        with self.lock:
+            self.ports = [base + index for index in range(max(1, count))]
+            ring = sorted((self._hash(f'shard-{index}-{replica}'), index)
+                          for index in range(len(self.ports)) for replica in range(self.replicas))
+            self.hashes = [point for point, _ in ring]
+            self.owners = [index for _, index in ring]
+            self.clients.clear()
+            self.started = False
 
-class Device(Widget):
-    """Widget that displays a device"""
+    @staticmethod
+    def _hash(key: str) -> int:
+        return int.from_bytes(hashlib.md5(key.encode()).digest()[:8], 'big')
 
-    title = Reactive('')
-    mouse_over = Reactive(False)
+    def __len__(self) -> int:
+        return len(self.ports)
 
-    def __init__(self, title: str, hover_color: str, text_color: str):
-        super(Device, self).__init__('')
-        self.title = title
-        self.hover_color = hover_color
-        self.text_color = text_color
+    def port(self, serial: str) -> int:
+        """Port of the server owning the device"""
 
-    def on_enter(self) -> None:
-        self.mouse_over = True
+        if len(self.ports) == 1 or ':' not in serial:
+            return self.ports[0]
+        index = bisect.bisect(self.hashes, self._hash(serial)) % len(self.hashes)
+        return self.ports[self.owners[index]]
 
-    def on_leave(self) -> None:
-        self.mouse_over = False
+    def start(self) -> None:
+        """Starts the servers of the shards that are not listening yet"""
 
-    def on_click(self, event: Click) -> None:
-        if '5555' in self.title:
-            subprocess.run(['scrcpy', f'--tcpip={self.title}'], capture_output=True)
-        else:
+        with self.lock:
+            if self.started:
+                return
+            for port in self.ports[1:]:
+                with socket.socket() as probe:
+                    if probe.connect_ex(('127.0.0.1', port)) == 0:
+                        continue
+                subprocess.run([adbutils.adb_path(), '-P', str(port), 'start-server'], timeout=20.0,
+                               stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+            self.started = True
+
+    def client(self, port: int) -> 'adbutils.AdbClient':
+        """Client of the server listening on port"""
+
+        if port == self.ports[0]:
+            return adbutils.adb
+        self.start()
+        with self.lock:
+            if (client := self.clients.get(port)) is None:
+                client = self.clients[port] = adbutils.AdbClient(port=port)
+        return client
+
+    def owner(self, serial: str) -> 'adbutils.AdbClient':
+        """Client of the server owning the device, the one to connect it to"""
+
+        return self.client(self.port(serial))
+
+    def device(self, serial: str) -> 'adbutils.AdbDevice':
+        return self.owner(serial).device(serial)
+
+    def all(self) -> List[Tuple[int, 'adbutils.AdbClient']]:
+        """Port and client of every shard"""
+
+        return [(port, self.client(port)) for port in self.ports]
+
+    def strays(self) -> List[Tuple[int, str]]:
+        """Port and serial of the TCP devices connected to a shard not owning them, e.g. after a resize"""
+
+        return [(port, info.serial) for port, client in self.all() for info in client.list()
+                if ':' in info.serial and self.port(info.serial) != port]
+
+
+shards = ShardPool()
+
+
+class DeviceRegistry:
+    """
+    In-process index of the devices known by the adb servers.
+    The whole list is fetched with a single host query per shard and cached
+    for ttl seconds. Once watch() is called, the index is kept up to date by
+    the events of the device trackers, one per shard, and never rebuilt
+    again, and every event is also passed to the listeners added with
+    listen(). A device is taken only from the shard owning it, so a USB
+    device seen by every server is listed once.
+    """
+
+    def __init__(self, ttl: float = 2.0):
+        self.ttl = ttl
+        self.lock = threading.Lock()
+        self.devices: Dict[str, 'adbutils.DeviceEvent'] = dict()
+        self.statuses: Dict[str, Dict[str, 'adbutils.DeviceEvent']] = dict()
+        self.expires = 0.0
+        self.watching = False
+        self.listeners: List[Callable[['adbutils.DeviceEvent'], None]] = []
+        os.register_at_fork(before=self.lock.acquire, after_in_parent=self.lock.release,
+                            after_in_child=self.lock.release)
+
+    def refresh(self, force: bool = False) -> None:
+        """Fetches the device list from the adb servers if the cache is expired"""
+
+        with self.lock:
+            if self.watching or (not force and time.monotonic() < self.expires):
+                return
+            self.devices.clear()
+            self.statuses.clear()
+            with metrics.timed('enumerate'):
+                devices = [(port, info) for port, client in shards.all() for info in client.list()]
+            for port, info in devices:
+                if shards.port(info.serial) == port:
+                    self._index(adbutils.DeviceEvent(True, info.serial, info.state))
+            self.expires = time.monotonic() + self.ttl
+
+    def invalidate(self) -> None:
+        """Forces the next lookup to query the adb server"""
+
+        self.expires = 0.0
+
+    def apply(self, event: 'adbutils.DeviceEvent') -> None:
+        """Updates the index with a single tracker event"""
+
+        with self.lock:
+            if (old := self.devices.pop(event.serial, None)) is not None:
+                self.statuses[old.status].pop(event.serial, None)
+            if event.present:
+                self._index(event)
+        for listener in self.listeners:
+            listener(event)
+
+    def listen(self, listener: Callable[['adbutils.DeviceEvent'], None]) -> None:
+        """
+        Calls listener with every tracker event. It runs in the tracker
+        thread, so it must be quick and thread safe.
+        """
+
+        self.listeners.append(listener)
+
+    def watch(self) -> None:
+        """Starts a daemon thread per shard feeding the index with the device tracker events"""
+
+        def track(port: int, client: 'adbutils.AdbClient') -> None:
+            try:
+                for event in client.track_devices():
+                    if shards.port(event.serial) == port:
+                        self.apply(event)
+            except adbutils.AdbError:
+                pass
+            finally:
+                self.watching = False
+                self.invalidate()
+
+        if self.watching:
+            return
+        self.refresh(force=True)
+        self.watching = True
+        for port, client in shards.all():
+            threading.Thread(target=track, args=(port, client), daemon=True).start()
+
+    def _index(self, event: 'adbutils.DeviceEvent') -> None:
+        self.devices[event.serial] = event
+        self.statuses.setdefault(event.status, dict())[event.serial] = event
+
+    def snapshot(self) -> List['adbutils.DeviceEvent']:
+        """Every device known by the adb server, whatever its status"""
+
+        self.refresh()
+        with self.lock:
+            return list(self.devices.values())
+
+    def by_status(self, status: str) -> List['adbutils.DeviceEvent']:
+        self.refresh()
+        with self.lock:
+            return list(self.statuses.get(status, dict()).values())
+
+    def status(self, serial: str) -> Optional[str]:
+        self.refresh()
+        with self.lock:
+            event = self.devices.get(serial)
+        return event.status if event is not None else None
+
+    def __contains__(self, serial: str) -> bool:
+        return self.status(serial) == 'device'
+
+    def __len__(self) -> int:
+        return len(self.by_status('device'))
+
+
+registry = DeviceRegistry()
+
+
+class DeviceHealth:
+    """Rolling health statistics of a single device"""
+
+    def __init__(self, window: int):
+        self.rtts: Deque[float] = deque(maxlen=window)
+        self.probes = 0
+        self.failures = 0
+        self.total_failures = 0
+        self.reconnects = 0
+        self.up_since: Optional[float] = None
+        self.last_seen: Optional[float] = None
+
+    def success(self, rtt: float) -> None:
+        self.probes += 1
+        self.failures = 0
+        self.rtts.append(rtt)
+        self.last_seen = time.time()
+        if self.up_since is None:
+            self.up_since = self.last_seen
+
+    def failure(self) -> None:
+        self.probes += 1
+        self.failures += 1
+        self.total_failures += 1
+        self.up_since = None
+
+    def percentile(self, p: float) -> Optional[float]:
+        """RTT (seconds) below which p percent of the recent probes fall"""
+
+        if not self.rtts:
+            return None
+        ordered = sorted(self.rtts)
+        return ordered[min(len(ordered) - 1, int(p / 100 * len(ordered)))]
+
+    @property
+    def uptime(self) -> float:
+        return time.time() - self.up_since if self.up_since is not None else 0.0
+
+    @property
+    def sickness(self) -> Tuple[int, float]:
+        """Sort key: devices failing their probes first, then the slowest ones"""
+
+        p95 = self.percentile(95)
+        return self.failures, p95 if p95 is not None else -1.0
+
+
+class HealthMonitor:
+    """
+    Probes the connected devices with a cheap shell echo and keeps rolling
+    RTT percentiles, uptime and consecutive failures of each one in memory.
+    Every device has a persistent shell session: a probe round writes one
+    echo into all the sessions at once and collects the answers with a
+    selector, so it costs no new connection and no thread per device.
+    Dropped TCP devices are reconnected at the end of every round, unless
+    they were disconnected on purpose (kill-server records it in the device
+    store). The devices down for more than give_up seconds are forgotten.
+    """
+
+    def __init__(self, timeout: float = 2.0, window: int = 120, give_up: float = 600.0):
+        self.timeout = timeout
+        self.window = window
+        self.give_up = give_up
+        self.lock = threading.Lock()
+        self.health: Dict[str, DeviceHealth] = dict()
+        self.sessions: Dict[str, 'adbutils.AdbConnection'] = dict()
+        self.down_since: Dict[str, float] = dict()
+        self.store: Optional[DeviceStore] = None
+        self.rounds = 0
+        self.running = False
+        os.register_at_fork(before=self.lock.acquire, after_in_parent=self.lock.release,
+                            after_in_child=self._forked)
+
+    def probe(self) -> None:
+        """Runs a single probe round on all the connected devices"""
+
+        serials = [event.serial for event in registry.by_status('device')]
+        missing = [serial for serial in serials if serial not in self.sessions]
+        for outcome in run_parallel(lambda serial: shards.device(serial).shell('sh', stream=True), missing,
+                                    latency=True):
+            if outcome.error is not None:
+                self._record(outcome.item, None)
+            else:
+                self.sessions[outcome.item] = outcome.value
+
+        self.rounds += 1
+        marker = f'pyadb-probe-{self.rounds}'.encode()
+        sent, answers = dict(), dict()
+        selector = selectors.DefaultSelector()
+        for serial in serials:
+            if (session := self.sessions.get(serial)) is None:
+                continue
+            try:
+                session.conn.sendall(b'echo ' + marker + b'\n')
+            except OSError:
+                self._drop(serial)
+                continue
+            sent[serial] = time.perf_counter()
+            answers[serial] = b''
+            selector.register(session.conn, selectors.EVENT_READ, serial)
+
+        deadline = time.perf_counter() + self.timeout
+        while selector.get_map() and (left := deadline - time.perf_counter()) > 0:
+            for key, _ in selector.select(left):
+                serial = key.data
+                try:
+                    data = key.fileobj.recv(4096)
+                except OSError:
+                    data = b''
+                if data:
+                    answers[serial] += data
+                    if marker not in answers[serial]:
+                        continue
+                    self._record(serial, time.perf_counter() - sent[serial])
+                else:
+                    self._drop(serial)
+                selector.unregister(key.fileobj)
+
+        # a late answer would desynchronize the session, so it is opened again
+        for key in list(selector.get_map().values()):
+            self._drop(key.data)
+        selector.close()
+
+    def reconnect(self) -> None:
+        """
+        Reconnects the monitored TCP devices that are not online anymore,
+        forgetting the ones disconnected on purpose or down for too long.
+        """
+
+        with self.lock:
+            known = list(self.health)
+        dropped = [serial for serial in known if registry.status(serial) != 'device']
+        now = time.monotonic()
+        for serial in set(known) - set(dropped):
+            self.down_since.pop(serial, None)
+
+        if self.store is None:
+            self.store = DeviceStore()
+        gone = self.store.disconnected(dropped)
+        gone.update(serial for serial in dropped if now - self.down_since.setdefault(serial, now) > self.give_up)
+        for serial in gone:
+            self.forget(serial)
+        dropped = [serial for serial in dropped if serial not in gone and ':' in serial]
+
+        def again(serial: str) -> str:
+            if registry.status(serial) is not None:
+                shards.owner(serial).disconnect(serial)
+            return connect_device(serial, self.timeout)
+
+        for outcome in run_parallel(again, dropped, latency=True):
+            if outcome.value == 'connected':
+                with self.lock:
+                    self.health[outcome.item].reconnects += 1
+        if dropped:
+            registry.invalidate()
+
+    def start(self, interval: float = 5.0) -> None:
+        """Starts a daemon thread probing the devices every interval seconds"""
+
+        def loop() -> None:
+            while True:
+                started = time.monotonic()
+                try:
+                    self.probe()
+                    self.reconnect()
+                except adbutils.AdbError:
+                    pass
+                time.sleep(max(0.0, interval - (time.monotonic() - started)))
+
+        if self.running:
+            return
+        self.running = True
+        threading.Thread(target=loop, daemon=True).start()
+
+    def snapshot(self) -> Dict[str, DeviceHealth]:
+        """Health of every monitored device, the sickest first"""
+
+        with self.lock:
+            return dict(sorted(self.health.items(), key=lambda item: item[1].sickness, reverse=True))
+
+    def _forked(self) -> None:
+        # the sessions belong to the parent, a child probing the devices opens its own
+        self.sessions = dict()
+        self.running = False
+        self.lock.release()
+
+    def _record(self, serial: str, rtt: Optional[float]) -> None:
+        with self.lock:
+            health = self.health.setdefault(serial, DeviceHealth(self.window))
+            if rtt is None:
+                health.failure()
+            else:
+                health.success(rtt)
+
+    def _drop(self, serial: str) -> None:
+        self._record(serial, None)
+        if (session := self.sessions.pop(serial, None)) is not None:
+            session.close()
+
+    def forget(self, serial: str) -> None:
+        """Stops monitoring a device, until it is online again"""
+
+        with self.lock:
+            self.health.pop(serial, None)
+        self.down_since.pop(serial, None)
+        if (session := self.sessions.pop(serial, None)) is not None:
+            session.close()
+
+
+monitor = HealthMonitor()
+
+
+class DeviceStore:
+    """
+    SQLite database saved in the cache directory with a row for every socket address.
+    Every row keeps when the address was last seen by a scan and the result
+    and latency of the last connection attempt.
+    """
+
+    alive = ('connected', 'already connected')
+
+    def __init__(self, name: str = 'devices'):
+        os.makedirs(user_cache_dir(cache_name, cache_author), exist_ok=True)
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(user_cache_dir(cache_name, cache_author) + '/' + name + '.db',
+                                  check_same_thread=False)
+        self.db.executescript("""
+            PRAGMA journal_mode = WAL;
+            PRAGMA synchronous = NORMAL;
+            CREATE TABLE IF NOT EXISTS devices (
+                address TEXT PRIMARY KEY,
+                last_seen REAL,
+                last_connect REAL,
+                last_result TEXT,
+                latency REAL
+            );
+            CREATE INDEX IF NOT EXISTS devices_last_connect ON devices (last_result, last_connect);
+            CREATE TABLE IF NOT EXISTS hashes (
+                path TEXT PRIMARY KEY,
+                size INTEGER,
+                mtime INTEGER,
+                md5 TEXT
+            );
+            CREATE TABLE IF NOT EXISTS breakers (
+                serial TEXT PRIMARY KEY,
+                failures INTEGER,
+                trips INTEGER,
+                open_until REAL
+            );
+            CREATE TABLE IF NOT EXISTS properties (
+                serial TEXT PRIMARY KEY,
+                fetched REAL,
+                props TEXT
+            );
+            CREATE TABLE IF NOT EXISTS manifests (
+                serial TEXT,
+                root TEXT,
+                path TEXT,
+                md5 TEXT,
+                stat TEXT,
+                PRIMARY KEY (serial, root, path)
+            );
+        """)
+        if name == 'devices':
+            self.import_pickle(user_cache_dir(cache_name, cache_author) + '/devices.pkl')
+
+    def import_pickle(self, path: str) -> None:
+        """
+        Imports, once, the addresses saved by the older versions into the
+        devices.pkl cache file, which is then renamed to devices.pkl.imported.
+
+        :param path: Path of the pickle cache file
+        :return: None
+        """
+
+        import pickle
+
+        if not os.path.exists(path):
+            return
+        addresses = set()
+        try:
+            with open(path, 'rb') as f:
+                # every load appended a new list to the file
+                while True:
+                    addresses.update(str(addr) for addr in pickle.load(f))
+        except EOFError:
             pass
+        except (OSError, pickle.UnpicklingError, TypeError) as e:
+            log(f'[bold yellow]CACHE:[/] unable to import {path} ({e}), run load again to recover its devices.')
+            return
+        imported = self.save(addresses)
+        os.replace(path, path + '.imported')
+        log(f'[green]CACHE[/]: {imported} devices imported from {path} into the device store.')
+
+    def save(self, addresses: Iterable[str]) -> int:
+        """
+        Inserts the addresses or refreshes their last_seen field.
 
-    def render(self) -> RenderableType:
-        obj = Align.center(Text(self.title), style=self.text_color, vertical='middle')
-        return Panel(obj, style=(self.hover_color if self.mouse_over else ''))
+        :param addresses: Socket addresses
+        :return: Number of addresses processed
+        """
 
+        now = time.time()
+        with self.lock, self.db:
+            cursor = self.db.executemany(
+                'INSERT INTO devices (address, last_seen) VALUES (?, ?) '
+                'ON CONFLICT (address) DO UPDATE SET last_seen = excluded.last_seen',
+                ((addr, now) for addr in addresses)
+            )
+        return cursor.rowcount
 
-class Display(App):
-    """App run when scrcpy command is launched"""
+    def record(self, address: str, result: str, latency: float) -> None:
+        """
+        Saves the result of a connection attempt.
 
-    async def on_load(self) -> None:
-        await self.bind('q', 'quit')
+        :param address: Socket address
+        :param result: Result returned by connect_device
+        :param latency: Time spent by the attempt (seconds)
+        :return: None
+        """
 
-    async def on_mount(self) -> None:
-        connected = get_by_status('device')
-        if len(connected) > 0:
-            devices = (Device(item.serial, hover_color='on red', text_color='bold green') for item in connected)
-            await self.view.dock(*devices, edge='top')
-        else:
-            await self.view.dock(
-                Device('No devices connected. Press \'Q\' to exit.', hover_color='', text_color='bold red'),
-                edge='top'
+        with self.lock, self.db:
+            self.db.execute(
+                'INSERT INTO devices (address, last_seen, last_connect, last_result, latency) VALUES (?, ?, ?, ?, ?) '
+                'ON CONFLICT (address) DO UPDATE SET last_connect = excluded.last_connect, '
+                'last_result = excluded.last_result, latency = excluded.latency',
+                (address, time.time(), time.time(), result, latency)
+            )
+
+    def addresses(self, since: Optional[float] = None) -> List[str]:
+        """
+        Recalls the addresses, the ones that connected most recently first.
+
+        :param since: If specified, only the addresses connected in the last `since` seconds
+        :return: A list
+        """
+
+        alive = ','.join('?' * len(self.alive))
+        query = 'SELECT address FROM devices'
+        params = []
+        if since is not None:
+            query += f' WHERE last_result IN ({alive}) AND last_connect >= ?'
+            params = [*self.alive, time.time() - since]
+        query += f' ORDER BY last_result IN ({alive}) DESC, last_connect DESC, latency'
+        with self.lock:
+            return [row[0] for row in self.db.execute(query, [*params, *self.alive])]
+
+    def disconnected(self, addresses: List[str]) -> Set[str]:
+        """
+        Tells which addresses were disconnected on purpose (kill-server) since
+        their last connection attempt.
+
+        :param addresses: Socket addresses
+        :return: A set
+        """
+
+        if not addresses:
+            return set()
+        with self.lock:
+            rows = self.db.execute(f"SELECT address FROM devices WHERE last_result = 'disconnected' "
+                                   f"AND address IN ({','.join('?' * len(addresses))})", addresses).fetchall()
+        return {row[0] for row in rows}
+
+    def file_hash(self, path: str) -> str:
+        """
+        Returns the md5 of a local file, computing it only if the file
+        changed since the last time.
+
+        :param path: Absolute path of the local file
+        :return: Hex digest
+        """
+
+        info = os.stat(path)
+        with self.lock:
+            row = self.db.execute('SELECT md5 FROM hashes WHERE path = ? AND size = ? AND mtime = ?',
+                                  (path, info.st_size, info.st_mtime_ns)).fetchone()
+        if row is not None:
+            return row[0]
+
+        digest = hashlib.md5()
+        with open(path, 'rb') as f:
+            while chunk := f.read(1024 * 1024):
+                digest.update(chunk)
+        with self.lock, self.db:
+            self.db.execute('INSERT OR REPLACE INTO hashes (path, size, mtime, md5) VALUES (?, ?, ?, ?)',
+                            (path, info.st_size, info.st_mtime_ns, digest.hexdigest()))
+        return digest.hexdigest()
+
+    def properties(self, serials: Iterable[str], max_age: float) -> Dict[str, Dict[str, str]]:
+        """
+        Recalls the system properties of the devices fetched in the last max_age seconds.
+
+        :param serials: Device serials
+        :param max_age: Max age of the properties (seconds)
+        :return: A dict serial -> properties, without the devices missing or expired
+        """
+
+        with self.lock:
+            rows = self.db.execute('SELECT serial, props FROM properties WHERE fetched >= ?',
+                                   (time.time() - max_age,)).fetchall()
+        wanted = set(serials)
+        return {serial: json.loads(props) for serial, props in rows if serial in wanted}
+
+    def save_properties(self, properties: Dict[str, Dict[str, str]]) -> None:
+        """
+        Saves the system properties just fetched from the devices.
+
+        :param properties: A dict serial -> properties
+        :return: None
+        """
+
+        now = time.time()
+        with self.lock, self.db:
+            self.db.executemany('INSERT OR REPLACE INTO properties (serial, fetched, props) VALUES (?, ?, ?)',
+                                ((serial, now, json.dumps(props)) for serial, props in properties.items()))
+
+    def manifest(self, serial: str, root: str) -> Dict[str, Tuple[str, str]]:
+        """
+        Recalls what was synchronized into a remote directory of a device.
+
+        :param serial: Device serial
+        :param root: Remote directory
+        :return: A dict relative path -> (md5 pushed, remote size and mtime)
+        """
+
+        with self.lock:
+            rows = self.db.execute('SELECT path, md5, stat FROM manifests WHERE serial = ? AND root = ?',
+                                   (serial, root)).fetchall()
+        return {path: (md5, stat) for path, md5, stat in rows}
+
+    def save_manifest(self, serial: str, root: str, files: Dict[str, Tuple[str, str]]) -> None:
+        """
+        Replaces the manifest of a remote directory of a device.
+
+        :param serial: Device serial
+        :param root: Remote directory
+        :param files: A dict relative path -> (md5 pushed, remote size and mtime)
+        :return: None
+        """
+
+        with self.lock, self.db:
+            self.db.execute('DELETE FROM manifests WHERE serial = ? AND root = ?', (serial, root))
+            self.db.executemany('INSERT INTO manifests (serial, root, path, md5, stat) VALUES (?, ?, ?, ?, ?)',
+                                ((serial, root, path, md5, stat) for path, (md5, stat) in files.items()))
+
+    def breakers(self) -> Dict[str, List]:
+        """
+        Recalls the circuit breakers of the devices that failed recently.
+
+        :return: A dict serial -> [consecutive failures, times opened, open until]
+        """
+
+        with self.lock:
+            return {row[0]: list(row[1:]) for row in
+                    self.db.execute('SELECT serial, failures, trips, open_until FROM breakers')}
+
+    def save_breakers(self, states: Dict[str, List]) -> None:
+        """
+        Saves the circuit breakers of the devices, forgetting the closed ones.
+
+        :param states: A dict serial -> [consecutive failures, times opened, open until]
+        :return: None
+        """
+
+        with self.lock, self.db:
+            self.db.executemany('DELETE FROM breakers WHERE serial = ?',
+                                ((serial,) for serial, state in states.items() if state[0] == 0))
+            self.db.executemany(
+                'INSERT OR REPLACE INTO breakers (serial, failures, trips, open_until) VALUES (?, ?, ?, ?)',
+                ((serial, *state) for serial, state in states.items() if state[0] > 0)
             )
 
+    def __len__(self) -> int:
+        with self.lock:
+            return self.db.execute('SELECT COUNT(*) FROM devices').fetchone()[0]
+
+    def close(self) -> None:
+        self.db.close()
+
+
+class Selector:
+    """
+    Filter on the system properties of the devices. The expression is a
+    comma separated list of conditions, all of them have to match:
+    name=pattern (shell wildcards, | between alternatives), name!=pattern,
+    name~regex, and name<value, name<=value, name>value, name>=value,
+    compared as numbers when both sides are numbers. The names are property
+    names or one of the aliases, like model or sdk.
+    """
+
+    aliases = {
+        'model': 'ro.product.model',
+        'manufacturer': 'ro.product.manufacturer',
+        'brand': 'ro.product.brand',
+        'device': 'ro.product.device',
+        'board': 'ro.product.board',
+        'abi': 'ro.product.cpu.abi',
+        'sdk': 'ro.build.version.sdk',
+        'android': 'ro.build.version.release',
+        'firmware': 'ro.build.display.id',
+        'fingerprint': 'ro.build.fingerprint'
+    }
+    operators = ('!=', '<=', '>=', '=', '~', '<', '>')
+
+    def __init__(self, expression: str):
+        self.conditions: List[Tuple[str, str, str]] = []
+        for condition in (c.strip() for c in expression.split(',')):
+            match = re.fullmatch(r'([\w.-]+)\s*(!=|<=|>=|=|~|<|>)\s*(.*)', condition)
+            if match is None:
+                raise ValueError(f'invalid condition "{condition}"')
+            name, operator, value = match.groups()
+            if operator == '~':
+                try:
+                    re.compile(value)
+                except re.error as e:
+                    raise ValueError(f'invalid regex "{value}": {e}')
+            self.conditions.append((self.aliases.get(name, name), operator, value))
+
+    def matches(self, properties: Dict[str, str]) -> bool:
+        return all(self._compare(properties.get(name), operator, value) for name, operator, value in self.conditions)
+
+    @staticmethod
+    def _compare(actual: Optional[str], operator: str, value: str) -> bool:
+        if actual is None:
+            return operator == '!='
+        if operator in ('=', '!='):
+            found = any(fnmatch.fnmatchcase(actual, pattern.strip()) for pattern in value.split('|'))
+            return found == (operator == '=')
+        if operator == '~':
+            return re.search(value, actual) is not None
+        try:
+            left, right = float(actual), float(value)
+        except ValueError:
+            left, right = actual, value
+        return {'<': left < right, '<=': left <= right, '>': left > right, '>=': left >= right}[operator]
+
+
+class PropertyIndex:
+    """
+    System properties of the devices, cached in the device store for ttl
+    seconds: the devices missing or expired are asked with a getprop,
+    concurrently, and the others are answered in-process.
+    """
+
+    ttl = 3600.0
+
+    def __init__(self, store: Optional[DeviceStore] = None):
+        self.store = store or DeviceStore()
+
+    def lookup(self, serials: List[str], workers: int = default_workers,
+               refresh: bool = False) -> Dict[str, Dict[str, str]]:
+        """
+        Properties of the devices, the ones that cannot be read are missing.
+
+        :param serials: Device serials
+        :param workers: Max number of devices asked at the same time
+        :param refresh: Flag to ignore the cache
+        :return: A dict serial -> properties
+        """
+
+        properties = dict() if refresh else self.store.properties(serials, self.ttl)
+        fetched = {outcome.item: outcome.value
+                   for outcome in run_parallel(fetch_properties, [s for s in serials if s not in properties], workers,
+                                                latency=True)
+                   if outcome.error is None}
+        self.store.save_properties(fetched)
+        properties.update(fetched)
+        return properties
+
+
+def select_devices(serials: List[str], expression: Optional[str], workers: int = default_workers,
+                   properties: Optional[Dict[str, Dict[str, str]]] = None) -> List[str]:
+    """
+    Utility function to keep the devices matching a selector expression.
+
+    :param serials: Device serials
+    :param expression: Selector expression, None to keep all of them
+    :param workers: Max number of devices asked at the same time for their properties
+    :param properties: Properties already looked up, None to look them up
+    :return: A list
+    """
+
+    if not expression:
+        return serials
+    try:
+        selector = Selector(expression)
+    except ValueError as e:
+        error(f'[bold red]SELECT ERROR:[/] {e}')
+    if properties is None:
+        properties = PropertyIndex().lookup(serials, workers)
+    selected = [serial for serial in serials if serial in properties and selector.matches(properties[serial])]
+    log(f'[bold blue]SELECTED:[/] {len(selected)}/{len(serials)} devices')
+    if not selected:
+        error('[bold red]No device matches the selection.[/]')
+    return selected
+
+
+
+def parse_sockets(socket: str, connect: bool = False) -> List[str]:
+    """
+    Utility function to get the connected devices of a comma separated list
+    of serials. The ones that are not connected are reported and left out.
+
+    :param socket: Comma separated serials or socket addresses
+    :param connect: Flag to connect first the socket addresses that are not connected yet
+    :return: A list, in the given order and without duplicates
+    """
+
+    serials = list(dict.fromkeys(serial.strip() for serial in socket.split(',') if serial.strip()))
+    if connect:
+        for serial in serials:
+            if serial not in registry and re.fullmatch(r'.+:\d+', serial):
+                connect_device(serial)
+        registry.invalidate()
+    devices = [serial for serial in serials if serial in registry]
+    for serial in serials:
+        if serial not in devices:
+            log(f'[bold red]{serial} not connected.[/]')
+    return devices
+
+class SharedSource:
+    """
+    Local file mapped in memory only once and shared between many readers.
+    Every reader streams the same pages to its own device, so pushing a file
+    to N devices does not read it N times from the disk.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self.file = open(path, 'rb')
+        self.size = os.fstat(self.file.fileno()).st_size
+        self.map = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ) if self.size > 0 else None
+        self.view = memoryview(self.map) if self.map is not None else memoryview(b'')
+
+    def reader(self, callback: Optional[Callable[[int], None]] = None) -> 'SharedReader':
+        return SharedReader(self.view, callback)
+
+    def close(self) -> None:
+        self.view.release()
+        if self.map is not None:
+            self.map.close()
+        self.file.close()
+
+    def __enter__(self) -> 'SharedSource':
+        return self
+
+    def __exit__(self, *args) -> None:
+        self.close()
+
+
+class SharedReader:
+    """
+    File-like cursor over a SharedSource. The callback receives the number of
+    bytes read since its last call, in steps of at least report_every bytes.
+    """
+
+    report_every = 1024 * 1024
+
+    def __init__(self, view: memoryview, callback: Optional[Callable[[int], None]] = None):
+        self.view = view
+        self.callback = callback
+        self.offset = 0
+        self.unreported = 0
+
+    def read(self, size: int = -1) -> bytes:
+        end = len(self.view) if size < 0 else min(len(self.view), self.offset + size)
+        chunk = self.view[self.offset:end].tobytes()
+        self.offset = end
+        self.unreported += len(chunk)
+        if self.callback is not None and (self.unreported >= self.report_every or not chunk):
+            self.callback(self.unreported)
+            self.unreported = 0
+        return chunk
+
+
+def open_output(path: str, compress: str = 'none') -> Any:
+    """
+    Opens a file for writing in binary mode, compressed with gzip or zstd.
+
+    :param path: Local path/to/file
+    :param compress: One of 'none', 'gzip', 'zstd'
+    :return: A file object
+    """
+
+    if compress == 'gzip':
+        import gzip
+
+        return gzip.open(path, 'wb', compresslevel=6)
+    if compress == 'zstd':
+        try:
+            import zstandard
+        except ImportError:
+            error('[bold red]ERROR:[/] zstd compression needs the zstandard package (pip install zstandard).')
+        return zstandard.open(path, 'wb')
+    return open(path, 'wb')
+
+
+class OutputSink:
+    """
+    Destination of the outputs of a command run on many devices, written as
+    the devices finish. If the path ends with .ndjson or .jsonl every device
+    gets a JSON record in it, keeping at most limit bytes of its output in
+    memory. Any other path is a directory: the whole output of every device
+    is streamed into its own file, and the exit codes go into index.ndjson.
+    Either way the memory does not grow with the fleet or with the output.
+    """
+
+    suffixes = {'none': '', 'gzip': '.gz', 'zstd': '.zst'}
+
+    def __init__(self, path: str, command: str, compress: Optional[str] = None, limit: int = 1024 ** 2):
+        if compress is None:
+            compress = next((name for name, suffix in self.suffixes.items() if suffix and path.endswith(suffix)),
+                            'none')
+        self.suffix = self.suffixes[compress]
+        self.compress = compress
+        self.command = command
+        self.limit = limit
+        self.lock = threading.Lock()
+
+        base = path[:-len(self.suffix)] if self.suffix and path.endswith(self.suffix) else path
+        self.ndjson = base.endswith(('.ndjson', '.jsonl'))
+        if self.ndjson:
+            self.directory = None
+            self.path = base + self.suffix
+        else:
+            self.directory = path
+            os.makedirs(path, exist_ok=True)
+            self.path = os.path.join(path, 'index.ndjson' + self.suffix)
+        self.records = open_output(self.path, compress)
+
+    def __enter__(self) -> 'OutputSink':
+        return self
+
+    def __exit__(self, exc_type, exc, tb) -> None:
+        self.close()
+
+    def device(self, serial: str) -> 'DeviceOutput':
+        """Output of a single device, to be used as a context manager"""
+
+        return DeviceOutput(self, serial)
+
+    def record(self, record: dict) -> None:
+        line = (json.dumps(record) + '\n').encode()
+        with self.lock:
+            self.records.write(line)
+
+    def close(self) -> None:
+        self.records.close()
+
+
+class DeviceOutput:
+    """
+    Output of a device being written into an OutputSink. When it exits the
+    record of the device is written, with the error that interrupted it, if
+    any.
+    """
+
+    def __init__(self, sink: OutputSink, serial: str):
+        self.sink = sink
+        self.serial = serial
+        self.buffer = bytearray()
+        self.size = 0
+        self.returncode: Optional[int] = None
+        self.file: Optional[Any] = None
+        self.name = serial_dir(serial) + '.out' + sink.suffix
+        self.start = 0.0
+
+    def __enter__(self) -> 'DeviceOutput':
+        self.start = time.perf_counter()
+        if self.sink.directory is not None:
+            self.file = open_output(os.path.join(self.sink.directory, self.name), self.sink.compress)
+        return self
+
+    def write(self, chunk: bytes) -> None:
+        self.size += len(chunk)
+        if self.file is not None:
+            self.file.write(chunk)
+        elif (room := self.sink.limit - len(self.buffer)) > 0:
+            self.buffer += chunk[:room]
+
+    def __exit__(self, exc_type, exc, tb) -> None:
+        record = {'serial': self.serial, 'command': self.sink.command, 'returncode': self.returncode,
+                  'elapsed': round(time.perf_counter() - self.start, 3), 'bytes': self.size,
+                  'error': None if exc is None else str(exc) or exc_type.__name__}
+        if self.file is not None:
+            self.file.close()
+            record['file'] = self.name
+        else:
+            record['output'] = self.buffer.decode(errors='replace')
+            record['truncated'] = self.size > len(self.buffer)
+        self.sink.record(record)
+
+
+class ContactSheet:
+    """
+    Grid of the thumbnails of many screens, sorted by serial, with the serial
+    under each one, split into pages of at most per_page screens. Every
+    thumbnail is pasted into its cell as soon as it arrives, and a page is
+    written and released once all its cells are filled: with the devices
+    captured in serial order only one or two pages are in memory at a time
+    (about 21 MB each with 160 pixels cells), whatever the number of screens.
+    """
+
+    label_height = 14
+
+    def __init__(self, serials: List[str], path: str, size: int = 160, per_page: int = 256):
+        self.size = size
+        self.path = path
+        self.per_page = per_page
+        self.cells = {serial: index for index, serial in enumerate(sorted(serials))}
+        self.counts = [min(per_page, len(self.cells) - start) for start in range(0, len(self.cells), per_page)]
+        self.missing = list(self.counts)
+        self.columns = max(1, math.ceil(math.sqrt(min(len(self.cells), per_page))))
+        self.pages: Dict[int, Tuple['Image.Image', 'ImageDraw.ImageDraw']] = dict()
+        self.paths: List[str] = []
+
+    def page(self, index: int) -> Tuple['Image.Image', 'ImageDraw.ImageDraw']:
+        """Image of a page and its drawing context, allocated on first use"""
+
+        from PIL import Image, ImageDraw
+
+        if (page := self.pages.get(index)) is None:
+            rows = math.ceil(self.counts[index] / self.columns)
+            image = Image.new('RGB', (self.columns * self.size, rows * (self.size + self.label_height)), (24, 24, 24))
+            page = self.pages[index] = (image, ImageDraw.Draw(image))
+        return page
+
+    def origin(self, serial: str) -> Tuple[int, int, int]:
+        """Page and top left corner of the cell of the device"""
+
+        page, index = divmod(self.cells[serial], self.per_page)
+        return page, index % self.columns * self.size, index // self.columns * (self.size + self.label_height)
+
+    def add(self, serial: str, image: Optional['Image.Image'], failure: Optional[str] = None) -> None:
+        """
+        Pastes the screen of the device, scaled down to fit its cell, or the
+        failure when there is no image. The page is written when it is full.
+
+        :param serial: Device serial
+        :param image: Screen, None if it could not be captured
+        :param failure: Short reason of the failure
+        """
+
+        index, x, y = self.origin(serial)
+        sheet, draw = self.page(index)
+        if image is not None:
+            image.thumbnail((self.size, self.size))
+            sheet.paste(image, (x + (self.size - image.width) // 2, y + (self.size - image.height) // 2))
+        else:
+            draw.rectangle((x, y, x + self.size - 1, y + self.size - 1), fill=(64, 16, 16))
+            draw.text((x + 4, y + 4), (failure or 'failed')[:self.size // 6], fill=(255, 96, 96))
+        draw.text((x + 2, y + self.size + 1), serial[:self.size // 6],
+                  fill=(255, 255, 255) if image is not None else (255, 96, 96))
+
+        self.missing[index] -= 1
+        if self.missing[index] == 0:
+            self.save(index)
+
+    def save(self, index: int) -> None:
+        """Writes a page into path, or into path-1, path-2... if there are many, and releases it"""
+
+        sheet, _ = self.pages.pop(index)
+        path = self.path
+        if len(self.counts) > 1:
+            root, extension = os.path.splitext(self.path)
+            path = f'{root}-{index + 1}{extension}'
+        options = {'quality': 85} if path.lower().endswith(('.jpg', '.jpeg')) else dict()
+        sheet.save(path, **options)
+        self.paths.append(path)
+
+    def close(self) -> None:
+        """Writes the pages still missing some screens"""
+
+        for index in sorted(self.pages):
+            self.save(index)
+
 
 def error(string: str) -> None:
     """Error printing"""
@@ -1,22 +1,52 @@
 import pathlib
-import json
 from json import JSONDecodeError
-from rich.progress import track, Progress, SpinnerColumn
-import adbutils
-from time import sleep
 import shutil
+import subprocess
 from typing import Union
 import re
+import tempfile
+from contextlib import nullcontext
+import queue
 import click
 
 from Utils import *
+import Daemon
+from Mirror import MirrorManager, Session, SessionLimit, preset_names
 
 
 # COMMANDS
 
 @click.group()
-def cli():
-    pass
+@click.option('-m', '--metrics', 'metrics_path', help='Export the timings of the command into this file '
+                                                     '(Prometheus textfile if it ends with .prom, JSON otherwise)')
+@click.option('--subnet-cap', help='Max number of devices of the same subnet (/24 or /64) working at the same time',
+              default=0, type=int)
+@click.option('--fixed-workers', help='Always keep --workers operations in flight instead of adapting them',
+              is_flag=True)
+@click.option('--tries', help='Attempts of every device operation failing for a transient reason', default=3,
+              type=int)
+@click.option('--ignore-breakers', help='Operate also on the devices that failed repeatedly in the last runs',
+              is_flag=True)
+@click.option('--props-ttl', help='Seconds the system properties of the devices are cached for --select',
+              default=3600.0, type=float)
+@click.option('--shards', 'shards_count', help='Number of local adb servers sharing the devices (env: PYADB_SHARDS)',
+              default=1, type=click.IntRange(min=1), envvar='PYADB_SHARDS')
+@click.pass_context
+def cli(ctx: click.Context, metrics_path: Optional[str], subnet_cap: int, fixed_workers: bool, tries: int,
+        ignore_breakers: bool, props_ttl: float, shards_count: int):
+    if ctx.invoked_subcommand in Daemon.forwarded and (code := Daemon.forward(sys.argv[1:])) is not None:
+        sys.exit(code)
+
+    Scheduler.subnet_cap = subnet_cap
+    Scheduler.adaptive = not fixed_workers
+    RetryPolicy.tries = tries
+    CircuitBreaker.enabled = not ignore_breakers
+    PropertyIndex.ttl = props_ttl
+    shards.resize(shards_count)
+
+    if metrics_path:
+        metrics.enable(ctx.invoked_subcommand, metrics_path)
+        ctx.call_on_close(metrics.export)
 
 
 @cli.command()
@@ -24,7 +54,13 @@ def cli():
 @click.argument('net', nargs=1, required=True)
 @click.argument('port', nargs=1, required=True)
 @click.option('--ipv6', help='IPV6 flag', is_flag=True)
-def masscan(net: str, port: Union[str, int], ipv6: bool) -> None:
+@click.option('-c', '--connect', 'pipeline', help='Connect to the ADB sockets while the scan is running', is_flag=True)
+@click.option('-p', '--adb-port', help='ADB port to connect, can be repeated (default: 5555)', default=[5555],
+              multiple=True, type=int)
+@click.option('-w', '--workers', help='Max number of concurrent connections', default=default_workers, type=int)
+@click.option('-t', '--timeout', help='Timeout of every single connection attempt (seconds)', default=2.0, type=float)
+def masscan(net: str, port: Union[str, int], ipv6: bool, pipeline: bool, adb_port: list, workers: int,
+            timeout: float) -> None:
     """
     Performs a masscan on the given net (example: 192.168.1.0/24)
     and check if there are services listening to the given port or range
@@ -41,8 +77,19 @@ def masscan(net: str, port: Union[str, int], ipv6: bool) -> None:
     :param port: Port or range of ports
 
     :param ipv6: Flag to know if the passed address is ipv6
+
+    :param pipeline: Flag to connect the devices as soon as they are discovered
+
+    :param adb_port: ADB port to connect
+
+    :param workers: Max number of concurrent connections
+
+    :param timeout: Timeout of every single connection attempt
     """
 
+    from rich.progress import Progress, SpinnerColumn
+    from Columns import UpdatableTextColumn
+
     if not net or not port:
         error('[bold red]You need to provide both network/mask and port or range.[/]')
 
@@ -60,7 +107,15 @@ def masscan(net: str, port: Union[str, int], ipv6: bool) -> None:
         if len(mask := socket_components[1]) > 2:
             error(f'[bold red]ERROR:[/] {mask} is not a valid representation of a bit mask [cyan](example: .../24)[/]')
 
-    with subprocess.Popen(['masscan', net, '-p', port, '-oJ', 'devices.json'], stdout=subprocess.PIPE,
+    args = ['masscan', net, '-p', port, '-oJ', 'devices.json']
+    if pipeline:
+        args.append('--interactive')
+
+    store = DeviceStore()
+    results = dict.fromkeys(connect_styles, 0)
+    discovered = queue.Queue()
+
+    with subprocess.Popen(args, stdout=subprocess.PIPE,
                           bufsize=10000,
                           stderr=subprocess.STDOUT,
                           universal_newlines=True) as p:
@@ -73,207 +128,380 @@ def masscan(net: str, port: Union[str, int], ipv6: bool) -> None:
                 found_column,
                 waiting_column
         ) as progress:
+
+            def connect_discovered(addr: str) -> str:
+                start = time.perf_counter()
+                result = connect_device(addr, timeout)
+                store.record(addr, result, time.perf_counter() - start)
+                progress.console.print(f'[{connect_styles[result]}]{result.upper()}[/]: {addr}')
+                return result
+
+            def connect_all() -> None:
+                for outcome in run_guarded(connect_discovered, iter(discovered.get, None), workers,
+                                           lambda o: o.value in DeviceStore.alive, CircuitBreaker(store), latency=True):
+                    if isinstance(outcome.error, CircuitOpen):
+                        results['skipped'] += 1
+                    else:
+                        results[outcome.value if outcome.error is None else 'error'] += 1
+
+            connector = threading.Thread(target=connect_all, daemon=True)
+            if pipeline:
+                connector.start()
+
             scan_task = progress.add_task('[yellow bold]Performing masscan', total=100.00)
-            while (line := p.stdout.readline()) != '':
-                if '%' not in line:
-                    match = re.match(r'\s+', line)
-                    if match is None:
-                        progress.console.print(f'[cyan bold]SUBPROCESS[/]: {line}', end='')
-                else:
-                    fields = line.split(',')
-                    if 'waiting' in fields[2]:
-                        waiting_column.set_text(fields[2].strip().replace('-secs', 's'))
+            try:
+                while (line := p.stdout.readline()) != '':
+                    if pipeline and (match := re.search(r'Discovered open port (\d+)/tcp on (\S+)', line)):
+                        if int(match.group(1)) in adb_port:
+                            addr = socket_address(match.group(2), match.group(1))
+                            store.save([addr])
+                            discovered.put(addr)
+                    elif '%' not in line:
+                        match = re.match(r'\s+', line)
+                        if match is None:
+                            progress.console.print(f'[cyan bold]SUBPROCESS[/]: {line}', end='')
                     else:
-                        found_column.set_text(fields[3].strip().replace('\n', '').upper())
-                    progress.update(scan_task, completed=float(fields[1][:fields[1].rfind('%')]))
+                        fields = line.split(',')
+                        if 'waiting' in fields[2]:
+                            waiting_column.set_text(fields[2].strip().replace('-secs', 's'))
+                        else:
+                            found_column.set_text(fields[3].strip().replace('\n', '').upper())
+                        progress.update(scan_task, completed=float(fields[1][:fields[1].rfind('%')]))
+            finally:
+                # the sentinel stops the connector even when the scan is interrupted
+                discovered.put(None)
+
+            if pipeline:
+                connector.join()
+
+    if pipeline:
+        registry.invalidate()
+        log(' '.join(f'[{connect_styles[k]}]{k.upper()}[/]: {v}' for k, v in results.items()))
 
 
 @cli.command()
 @click.help_option('-h', '--help')
 @click.option('-f', '--file', help='JSON file containing the result of a masscan search', default='devices.json')
-def load(file: str) -> None:
+@click.option('-p', '--port', help='ADB port, can be repeated (default: 5555)', default=[5555], multiple=True,
+              type=int)
+def load(file: str, port: list) -> None:
     """
-    Loads the sockets found by masscan command into a cache_file.
+    Loads the sockets found by masscan command into the SQLite device store.
     You can also provide a different file specifying the path/to/file.json with --file option.
     Note that only sockets with ADB port open will be considered.
+    The file is parsed incrementally, so its size does not matter.
 
     :Usage example: python3 main.py load
 
     :param file: File (default: devices.json)
+
+    :param port: ADB port (default: 5555)
     """
 
     if not os.path.exists('./' + file):
         error(f'[bold red]ERROR[/]: {file} does not exist.')
 
-    with open(file, 'r') as f:
+    store = DeviceStore()
+    loaded = 0
+    batch = []
+    with open(file, 'r') as f, console.status('[yellow]Loading[/]', spinner='dots') as status:
         try:
-            data = json.load(f)
-            log(f'[bold green]SUCCESS[/]: Data got from file {file}')
+            for addr in iter_sockets(iter_masscan(f), port):
+                batch.append(addr)
+                if len(batch) == 10000:
+                    loaded += store.save(batch)
+                    batch.clear()
+                    status.update(f'[yellow]Loading[/] {loaded} devices')
+            loaded += store.save(batch)
         except JSONDecodeError:
             error(f'[bold red]ERROR[/]: Unable to read json data from {file} [cyan](empty?)[/]')
 
-    devices = []
-    for d in data:
-        if '5555' == d['ports'][0]['port']:
-            continue
-        devices.append(f"{d['ip']}:{d['ports'][0]['port']}")
+    if loaded == 0:
+        error(f'[bold red]ERROR[/]: No ADB socket found in {file} [cyan](empty?)[/]')
 
-    cache_save('devices', devices)
+    log(f'[bold green]SUCCESS[/]: Data got from file {file}')
+    log(f'[green]CACHE[/]: {loaded} devices saved to cache ({len(store)} known).')
 
 
 @cli.command()
 @click.help_option('-h', '--help')
 @click.option('-s', '--socket', help='Specific socket address')
-def connect(socket: str) -> None:
+@click.option('-w', '--workers', help='Max number of concurrent connections', default=default_workers, type=int)
+@click.option('-t', '--timeout', help='Timeout of every single attempt (seconds)', default=2.0, type=float)
+@click.option('-S', '--since', help='Only the devices connected in the last given hours', type=float)
+def connect(socket: str, workers: int, timeout: float, since: float) -> None:
     """
-    Connects all the devices found into the cache_file to the given adb session.
+    Connects the devices known by the SQLite device store to the given adb session.
+    The attempts run concurrently, at most --workers at the same time,
+    starting from the devices that connected most recently.
 
     :Usage example: python3 main.py connect
 
     :param socket: Specific socket to connect
+
+    :param workers: Max number of concurrent connections
+
+    :param timeout: Timeout of every single attempt
+
+    :param since: Only the devices connected in the last given hours
     """
 
-    success = False
-    connection = None
-    if not socket:
-        devices = cache_recall('devices')
+    from rich.progress import Progress, SpinnerColumn
 
-        if len(devices) == 0:
-            error('[bold red]ERROR:[/] there is no device inside the cache file.')
+    store = DeviceStore()
 
-        with console.status('[yellow]Connecting devices[/]', spinner='dots'):
-            for addr in devices:
-                try:
-                    adb.connect(addr, timeout=2.0)
-                    success = True
-                except adbutils.AdbTimeout:
-                    continue
-    else:
-        try:
-            connection = adb.connect(socket, timeout=2.0)
-            success = True
-        except adbutils.AdbTimeout:
-            pass
-    if success is True:
-        if connection is not None:
-            if 'failed' in connection or 'unable' in connection or 'already' in connection:
-                error(f'[bold red]ERROR:[/] {connection}')
-            else:
-                log(f'[bold green]CONNECTED:[/] you\'re now friend of {socket}!')
+    if socket:
+        start = time.perf_counter()
+        result = connect_device(socket, timeout)
+        store.record(socket, result, time.perf_counter() - start)
+        if result == 'connected':
+            log(f'[bold green]CONNECTED:[/] you\'re now friend of {socket}!')
         else:
-            log('[green bold]CONNECTED:[/] wow! You\'re not alone!')
+            error(f'[bold red]ERROR:[/] {socket} {result}')
+        return
+
+    devices = store.addresses(since * 3600 if since is not None else None)
+
+    if len(devices) == 0:
+        error('[bold red]ERROR:[/] there is no device inside the device store.')
+
+    if len(shards) > 1 and (strays := shards.strays()):
+        for port, serial in strays:
+            shards.client(port).disconnect(serial)
+        log(f'[bold blue]MOVED:[/] {len(strays)} devices to the adb server of their shard')
+
+    results = dict.fromkeys(connect_styles, 0)
+    with Progress(SpinnerColumn(spinner_name='dots', finished_text='✔'), *Progress.get_default_columns()) as progress:
+        connect_task = progress.add_task('[yellow bold]Connecting devices', total=len(devices))
+        for outcome in run_guarded(lambda addr: connect_device(addr, timeout), devices, workers,
+                                   lambda o: o.value in DeviceStore.alive, CircuitBreaker(store), latency=True):
+            progress.advance(connect_task)
+            if isinstance(outcome.error, CircuitOpen):
+                results['skipped'] += 1
+                continue
+            result = outcome.value if outcome.error is None else 'error'
+            results[result] += 1
+            store.record(outcome.item, result, outcome.elapsed)
+            progress.console.print(f'[{connect_styles[result]}]{result.upper()}[/]: {outcome.item}')
+    registry.invalidate()
+
+    log(' '.join(f'[{connect_styles[k]}]{k.upper()}[/]: {v}' for k, v in results.items()))
+    if results['connected'] + results['already connected'] > 0:
+        log('[green bold]CONNECTED:[/] wow! You\'re not alone!')
     else:
         error('[bold red]Something went wrong during the connection[/]')
 
 
 @cli.command('show')
 @click.help_option('-h', '--help')
-def show_devices() -> None:
+@click.option('-p', '--probe', help='Probe the devices once before showing them', is_flag=True)
+def show_devices(probe: bool) -> None:
     """
     Shows a table with the information of the connected devices.
+    The RTT, uptime and failures columns are filled by the health monitor
+    of the daemon (see serve); without it, --probe measures them once.
 
     :Usage example: python3 main.py show
+
+    :param probe: Flag to probe the devices
     """
+
+    if probe:
+        monitor.probe()
     log(connected_devices())
 
 
+@cli.command('props')
+@click.help_option('-h', '--help')
+@click.option('-S', '--select', help='Only the devices whose properties match, e.g. "model=Pixel*,sdk>=30"')
+@click.option('-k', '--keys', help='Comma separated properties (or aliases) to show',
+              default='model,sdk,android,firmware')
+@click.option('-r', '--refresh', help='Read the properties again instead of using the cache', is_flag=True)
+@click.option('-w', '--workers', help='Max number of devices read at the same time',
+              default=default_workers, type=int)
+def show_properties(select: Optional[str], keys: str, refresh: bool, workers: int) -> None:
+    """
+    Shows a table with some system properties of the connected devices.
+    The properties are cached for --props-ttl seconds, so the same index
+    answers the --select option of the other commands.
+
+    :Usage example: python3 main.py props -S "manufacturer=samsung" -k model,sdk,abi
+
+    :param select: Selector on the device properties
+
+    :param keys: Properties to show
+
+    :param refresh: Flag to ignore the cache
+
+    :param workers: Max number of concurrent devices
+    """
+
+    from rich.table import Table
+
+    serials = [item.serial for item in get_by_status('device')]
+    if len(serials) == 0:
+        error('[bold red]No devices connected.[/]')
+
+    properties = PropertyIndex().lookup(serials, workers, refresh)
+    serials = select_devices(serials, select, workers, properties)
+
+    names = [name.strip() for name in keys.split(',') if name.strip()]
+    table = Table(expand=True)
+    table.add_column('Devices address', style='cyan bold', no_wrap=True)
+    for name in names:
+        table.add_column(name, style='cyan bold')
+    for serial in serials:
+        if (values := properties.get(serial)) is None:
+            table.add_row(serial, *['[bold red]unreadable[/]'] + ['-'] * (len(names) - 1), style='red')
+        else:
+            table.add_row(serial, *[values.get(Selector.aliases.get(name, name), '-') for name in names])
+    log(table)
+
+
 @cli.command('broad-cmd')
 @click.help_option('-h', '--help')
 @click.argument('command', nargs=-1, required=True)
-def broadcast_command(command: str) -> None:
+@click.option('-w', '--workers', help='Max number of devices running the command at the same time',
+              default=default_workers, type=int)
+@click.option('-o', '--output', help='Write the outputs into this NDJSON file (.ndjson or .jsonl) or directory '
+                                     'instead of printing them')
+@click.option('-z', '--compress', help='Compression of the output files (default: from the extension)',
+              type=click.Choice(list(OutputSink.suffixes)))
+@click.option('--max-output', help='Max bytes of output kept for every device in an NDJSON file',
+              default=1024 ** 2, type=int)
+@click.option('-S', '--select', help='Only the devices whose properties match, e.g. "model=Pixel*,sdk>=30"')
+def broadcast_command(command: str, workers: int, output: Optional[str], compress: Optional[str],
+                      max_output: int, select: Optional[str]) -> None:
     """
     Executes a shell command to all the connected devices.
-    If at least one device returned an output, the user can choose
-    if he wants to see it or not.
+    The command runs on the devices concurrently and the result of
+    every device is printed as soon as it finishes, together with
+    its exit status and the elapsed time. With --output the outputs are
+    streamed into files instead, so they never pile up in memory.
 
     :Usage example: python3 main.py broad-cmd <command>
 
     :param command: Command
+
+    :param workers: Max number of concurrent devices
+
+    :param output: NDJSON file or directory receiving the outputs
+
+    :param compress: Compression of the output files
+
+    :param max_output: Max bytes of output kept for every device in an NDJSON file
+
+    :param select: Selector on the device properties
     """
 
-    if len(adb.device_list()) == 0:
+    from rich.progress import Progress, SpinnerColumn
+
+    devices = get_by_status('device')
+
+    if len(devices) == 0:
         error('[bold red]No devices connected.[/]')
 
     if not command:
         error(f'[bold red]There is no command to execute.[/]')
 
-    output = dict()
-    devices = get_by_status('device')
-
-    with console.status('[bold yellow]Executing[/]', spinner='dots'):
-        for item in devices:
-            device = adb.device(item.serial)
-            output[item.serial] = device.shell(command)
-    log('[bold green]DONE[/]')
-
-    if len(output) > 0:
-        check = False
-        for key in output.keys():
-            if len(output.get(key)) > 0:
-                check = True
-                break
-        if check:
-            while True:
-                log('You obtained some results, do you wanna display them? [cyan](Y/n)[/] ', end='')
-                answer = console.input()
-
-                if answer == 'Y' or answer == 'y' or answer == 'YES' or answer == 'yes' or answer == '':
-                    table = Table(expand=True, show_lines=True)
-                    table.add_column("Device", style="cyan bold", justify='center')
-                    table.add_column("Output", style="cyan bold", justify='left')
-
-                    for key in output.keys():
-                        table.add_row(key, output.get(key))
-
-                    log(table)
-                    break
-
-                elif answer == 'N' or answer == 'n' or answer == 'NO' or answer == 'no':
-                    break
+    if select:
+        selected = set(select_devices([item.serial for item in devices], select, workers))
+        devices = [item for item in devices if item.serial in selected]
+
+    sink = OutputSink(output, ' '.join(command), compress, max_output) if output else None
+    quoted = ' '.join(map(shlex.quote, command))
+
+    def run(item: 'adbutils.DeviceEvent') -> Union['adbutils.ShellReturn', DeviceOutput]:
+        if sink is None:
+            buffer = bytearray()
+            returncode = stream_shell(item.serial, quoted, buffer.extend)
+            return adbutils.ShellReturn(command=quoted, returncode=returncode, output=buffer.decode(errors='replace'))
+        with sink.device(item.serial) as out:
+            out.returncode = stream_shell(item.serial, quoted, out.write)
+        return out
+
+    returned = False
+    failed = 0
+    with sink or nullcontext(), \
+         Progress(SpinnerColumn(spinner_name='dots', finished_text='✔'), *Progress.get_default_columns()) as progress:
+        exec_task = progress.add_task('[bold yellow]Executing', total=len(devices))
+        for outcome in run_guarded(run, devices, workers):
+            serial = outcome.item.serial
+            if outcome.error is not None:
+                failed += 1
+                progress.console.print(f'[bold red]{serial}[/] failed after {outcome.elapsed:.2f}s: {outcome.error}')
+            elif sink is not None:
+                returned = returned or outcome.value.size > 0
+                style = 'bold green' if outcome.value.returncode == 0 else 'bold red'
+                progress.console.print(f'[cyan bold]{serial}[/] [{style}]exit {outcome.value.returncode}[/] '
+                                       f'in {outcome.elapsed:.2f}s, {outcome.value.size} bytes')
+            else:
+                style = 'bold green' if outcome.value.returncode == 0 else 'bold red'
+                progress.console.print(f'[cyan bold]{serial}[/] [{style}]exit {outcome.value.returncode}[/] '
+                                       f'in {outcome.elapsed:.2f}s')
+                if len(text := outcome.value.output.rstrip()) > 0:
+                    returned = True
+                    progress.console.print(text, markup=False, highlight=False)
+            progress.advance(exec_task)
+    if sink is not None:
+        log(f'[bold green]SAVED:[/] {sink.path}')
+    log('[bold green]DONE[/]' if failed == 0 else f'[bold red]DONE:[/] {failed} devices failed')
 
-                else:
-                    log('[bold red]Please type only (Y/n) letters.[/]', end='\r')
-                    sleep(2)
-        else:
-            log('[blue]No output returned.[/]')
+    if not returned:
+        log('[blue]No output returned.[/]')
 
 
 @cli.command('exec')
 @click.help_option('-h', '--help')
 @click.argument('socket', nargs=1, required=True)
 @click.argument('command', nargs=-1, required=True)
-def execute(socket: str, command: str) -> None:
+@click.option('-o', '--output', help='Write the output into this NDJSON file (.ndjson or .jsonl) or directory '
+                                     'instead of printing it')
+@click.option('-z', '--compress', help='Compression of the output files (default: from the extension)',
+              type=click.Choice(list(OutputSink.suffixes)))
+@click.option('--max-output', help='Max bytes of output kept in an NDJSON file', default=1024 ** 2, type=int)
+def execute(socket: str, command: str, output: Optional[str], compress: Optional[str], max_output: int) -> None:
     """
     Execute the given command to the given remote device.
-    If an output is returned it will print it.
+    If an output is returned it will print it, or stream it into
+    --output.
 
     :Usage example: python3 main.py 192.168.1.10:5555 <command>
 
     :param socket: Socket address
 
     :param command: Command
-    """
 
-    devices = get_by_status('device')
+    :param output: NDJSON file or directory receiving the output
 
-    if len(devices) == 0:
-        error('[bold red]No devices connected.[/]')
+    :param compress: Compression of the output file
 
-    found = False
-    for item in devices:
-        if item.serial == socket:
-            found = True
+    :param max_output: Max bytes of output kept in an NDJSON file
+    """
+
+    if len(registry) == 0:
+        error('[bold red]No devices connected.[/]')
 
-    if not found:
+    if socket not in registry:
         error(f'[bold red]{socket} not connected.[/]')
 
     if not command:
         error(f'[bold red]There is no command to execute.[/]')
 
+    if output:
+        try:
+            with OutputSink(output, ' '.join(command), compress, max_output) as sink, sink.device(socket) as out:
+                out.returncode = stream_shell(socket, ' '.join(map(shlex.quote, command)), out.write)
+        except adbutils.AdbError:
+            error('[bold red]Something went wrong during the execution.[/]')
+        log(f'[bold green]SAVED:[/] exit {out.returncode}, {out.size} bytes into {sink.path}')
+        return
+
     output = ''
     try:
-        device = adb.device(socket)
-        output = device.shell(command)
+        device = shards.device(socket)
+        with metrics.timed('shell', socket):
+            output = RetryPolicy.call(lambda: device.shell(command), RetryPolicy.rejected)
     except adbutils.AdbError:
         error('[bold red]Something went wrong during the execution.[/]')
 
@@ -283,17 +511,228 @@ def execute(socket: str, command: str) -> None:
         error('[blue]No output returned.[/]')
 
 
+@cli.command('run-script')
+@click.help_option('-h', '--help')
+@click.argument('script', nargs=1, required=True, type=click.Path(exists=True, dir_okay=False))
+@click.option('-s', '--socket', help='Specific devices, comma separated (default: all the connected devices)')
+@click.option('-w', '--workers', help='Max number of devices running the script at the same time',
+              default=default_workers, type=int)
+@click.option('-e', '--errors-only', help='Print only the commands that failed or did not run', is_flag=True)
+@click.option('-S', '--select', help='Only the devices whose properties match, e.g. "model=Pixel*,sdk>=30"')
+def run_script_command(script: str, socket: Optional[str], workers: int, errors_only: bool,
+                       select: Optional[str]) -> None:
+    """
+    Executes a script, one shell command per line, on the connected devices.
+    Every device runs the whole script in a single shell session, so the
+    working directory and the variables are kept between the commands, and
+    the output and the exit status of every command are printed separately.
+
+    :Usage example: python3 main.py run-script runbook.sh
+
+    :param script: Local path/to/script
+
+    :param socket: Devices running the script
+
+    :param workers: Max number of concurrent devices
+
+    :param errors_only: Flag to print only the failed commands
+
+    :param select: Selector on the device properties
+    """
+
+    from rich.progress import Progress, SpinnerColumn
+    from rich.markup import escape
+
+    commands = Script.load(script)
+    if not commands.commands:
+        error(f'[bold red]There is no command to execute.[/]')
+
+    if socket:
+        devices = parse_sockets(socket)
+    else:
+        devices = [item.serial for item in get_by_status('device')]
+
+    if len(devices) == 0:
+        error('[bold red]No devices connected.[/]')
+
+    devices = select_devices(devices, select, workers)
+
+    failed, errors = 0, 0
+    with Progress(SpinnerColumn(spinner_name='dots', finished_text='✔'), *Progress.get_default_columns()) as progress:
+        exec_task = progress.add_task('[bold yellow]Executing', total=len(devices))
+        for outcome in run_guarded(lambda serial: run_script(serial, commands), devices, workers):
+            serial = outcome.item
+            if outcome.error is not None:
+                failed += 1
+                progress.console.print(f'[bold red]{serial}[/] failed after {outcome.elapsed:.2f}s: {outcome.error}')
+                progress.advance(exec_task)
+                continue
+
+            succeeded = sum(1 for result in outcome.value if result.returncode == 0)
+            errors += succeeded < len(outcome.value)
+            style = 'bold green' if succeeded == len(outcome.value) else 'bold red'
+            progress.console.print(f'[cyan bold]{serial}[/] [{style}]{succeeded}/{len(outcome.value)} succeeded[/] '
+                                   f'in {outcome.elapsed:.2f}s')
+            for result in outcome.value:
+                if errors_only and result.returncode == 0:
+                    continue
+                status = 'not run' if result.returncode is None else f'exit {result.returncode}'
+                style = 'green' if result.returncode == 0 else 'red'
+                progress.console.print(f'[dim]$[/] {escape(result.command)} [{style}]{status}[/]')
+                if len(output := result.output.rstrip()) > 0:
+                    progress.console.print(output, markup=False, highlight=False)
+            progress.advance(exec_task)
+    if failed == 0 and errors == 0:
+        log('[bold green]DONE[/]')
+    else:
+        log(f'[bold red]DONE:[/] {failed} devices failed, {errors} devices with failed commands')
+
+
+@cli.command('logs')
+@click.help_option('-h', '--help')
+@click.argument('filterspecs', nargs=-1)
+@click.option('-s', '--socket', help='Specific devices, comma separated (default: all the connected devices)')
+@click.option('-S', '--select', help='Only the devices whose properties match, e.g. "model=Pixel*,sdk>=30"')
+@click.option('-b', '--buffer', 'buffers', help='Log buffer to read, can be repeated (default: main, system, crash)',
+              multiple=True)
+@click.option('-e', '--regex', help='Only the lines matching the regular expression (filtered on the devices)')
+@click.option('-T', '--tail', help='Start from the last given lines instead of the new ones', type=int)
+@click.option('-d', '--dump', help='Print the logs collected so far and exit', is_flag=True)
+@click.option('-o', '--output', help='Directory where the logs of every device are also written')
+@click.option('--rotate-size', help='Size of a log file before it is rotated (MB)', default=10.0, type=float)
+@click.option('--keep', help='Rotated log files kept for every device', default=5, type=int)
+@click.option('-q', '--quiet', help='Do not print the merged logs, only write them into --output', is_flag=True)
+@click.option('--window', help='Seconds the lines are held to sort them by timestamp', default=0.5, type=float)
+@click.option('-w', '--workers', help='Max number of devices starting logcat at the same time',
+              default=default_workers, type=int)
+def logs(filterspecs: Tuple[str], socket: Optional[str], select: Optional[str], buffers: Tuple[str],
+         regex: Optional[str], tail: Optional[int], dump: bool, output: Optional[str], rotate_size: float, keep: int,
+         quiet: bool, window: float, workers: int) -> None:
+    """
+    Follows the logcat of the connected devices at the same time, merging
+    them into a single stream ordered by timestamp, every line prefixed by
+    its device. The filter specs (e.g. ActivityManager:I *:S), the buffers
+    and the regex are applied by logcat on the devices.
+
+    :Usage example: python3 main.py logs -o logs ActivityManager:I *:S
+
+    :param filterspecs: Logcat filter specs
+
+    :param socket: Devices to follow
+
+    :param select: Selector on the device properties
+
+    :param buffers: Log buffers
+
+    :param regex: Regular expression the lines have to match
+
+    :param tail: Number of past lines to start from
+
+    :param dump: Flag to exit when the logs collected so far are printed
+
+    :param output: Output directory
+
+    :param rotate_size: Size of a log file before it is rotated
+
+    :param keep: Number of rotated log files kept
+
+    :param quiet: Flag to only write the logs into output
+
+    :param window: Seconds the lines are held to be sorted
+
+    :param workers: Max number of concurrent devices
+    """
+
+    if quiet and not output:
+        error('[bold red]ERROR:[/] --quiet needs --output, or nothing would be shown.')
+
+    if socket:
+        devices = parse_sockets(socket)
+    else:
+        devices = [item.serial for item in get_by_status('device')]
+
+    if len(devices) == 0:
+        error('[bold red]No devices connected.[/]')
+
+    devices = select_devices(devices, select, workers)
+
+    args = [arg for buffer in buffers for arg in ('-b', buffer)]
+    if regex:
+        args += ['-e', regex]
+    if tail:
+        args += ['-T', str(tail)]
+    if dump:
+        args.append('-d')
+    args += filterspecs
+
+    raise_file_limit(len(devices) * (2 if output else 1) + 64)
+    connections = dict()
+    for outcome in run_guarded(lambda serial: open_logcat(serial, args), devices, workers):
+        if outcome.error is not None:
+            log(f'[bold red]FAILED[/]: {outcome.item} {outcome.error}')
+        else:
+            connections[outcome.item] = outcome.value
+    if not connections:
+        error('[bold red]Something went wrong starting logcat[/]')
+
+    files = dict()
+    if output:
+        os.makedirs(output, exist_ok=True)
+        files = {serial: RotatingLog(os.path.join(output, f'{serial_dir(serial)}.log'), int(rotate_size * 1024 ** 2),
+                                     keep) for serial in connections}
+
+    # plain writes instead of rich, which could not keep up with thousands of lines per second
+    stdout = sys.stdout.buffer
+    colors = sys.stdout.isatty()
+    prefixes = {serial: (f'\x1b[{31 + index % 6}m{serial}\x1b[0m ' if colors else f'{serial} ').encode()
+                for index, serial in enumerate(sorted(connections))}
+    counts = dict.fromkeys(connections, 0)
+
+    if not dump:
+        log(f'[bold green]FOLLOWING:[/] {len(connections)} devices, press Ctrl+C to stop.')
+    multiplexer = LogMultiplexer(connections, window)
+    start = time.perf_counter()
+    try:
+        for batch in multiplexer.lines():
+            for serial, line in batch:
+                counts[serial] += 1
+                if files:
+                    files[serial].write(line + b'\n')
+            if not quiet:
+                stdout.write(b''.join(prefixes[serial] + line + b'\n' for serial, line in batch))
+                stdout.flush()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        multiplexer.close()
+        for file in files.values():
+            file.close()
+
+    log(f'[bold green]DONE:[/] {sum(counts.values())} lines from {sum(1 for n in counts.values() if n)}/'
+        f'{len(counts)} devices in {time.perf_counter() - start:.2f}s.')
+
+
 @cli.command('push')
 @click.help_option('-h', '--help')
 @click.argument('local', nargs=1, required=True)
 @click.argument('remote', nargs=1, required=True)
 @click.option('-s', '--socket', help='Specific device (socket address)')
-def push_file(local: str, remote: str, socket: str) -> None:
+@click.option('-w', '--workers', help='Max number of devices receiving the file at the same time',
+              default=default_workers, type=int)
+@click.option('--sync', 'sync_dir', help='Synchronize a directory, pushing only new or changed files', is_flag=True)
+@click.option('--hash', 'hashes', help='With --sync, compare the md5 of the remote files', is_flag=True)
+@click.option('-S', '--select', help='Only the devices whose properties match, e.g. "model=Pixel*,sdk>=30"')
+def push_file(local: str, remote: str, socket: str, workers: int, sync_dir: bool, hashes: bool,
+              select: Optional[str]) -> None:
     """
     Pushes a local file into all the remote machines.
     The remote path has to be absolute.
     If the argument --socket is specified the file
     will be pushed only to that.
+    The local file is read only once and streamed
+    to the devices concurrently.
+    With --sync, local has to be a directory and only its
+    new or changed files are pushed into the remote one.
 
     :Usage example: python3 main.py push example.txt /sdcard
 
@@ -302,9 +741,20 @@ def push_file(local: str, remote: str, socket: str) -> None:
     :param remote: Remote destination
 
     :param socket: Specific device
+
+    :param workers: Max number of concurrent devices
+
+    :param sync_dir: Flag to synchronize a directory
+
+    :param hashes: Flag to compare remote md5
+
+    :param select: Selector on the device properties
     """
 
-    if len(adb.device_list()) == 0:
+    from rich.progress import Progress, SpinnerColumn, DownloadColumn, TransferSpeedColumn
+    from Columns import UpdatableTextColumn
+
+    if len(registry) == 0:
         error('[bold red]No devices connected.[/]')
 
     if not local or not remote:
@@ -313,132 +763,451 @@ def push_file(local: str, remote: str, socket: str) -> None:
     if not pathlib.PurePath(remote).is_absolute():
         error(f'[bold red]PATH ERROR:[/] {remote} is not an absolute path.')
 
+    serials = select_devices([socket] if socket else [item.serial for item in get_by_status('device')], select,
+                             workers)
+
+    if sync_dir:
+        push_tree(local, remote, serials, workers, hashes)
+        return
+
+    if not os.path.isfile(local):
+        error(f'[bold red]ERROR:[/] {local} does not exist.')
+
     if not remote.endswith(local):
         filename = local.split('/')[-1]
         remote = os.path.join(remote, filename)
 
-    success = False
+    pushed = 0
 
-    if not socket:
-        devices = get_by_status('device')
-
-        for item in track(devices, description='Pushing'):
-            try:
-                device = adb.device(item.serial)
-                device.sync.push(str(local), str(remote))
-                success = True
-            except Union[TypeError, RuntimeError, adbutils.AdbError]:
-                continue
-    else:
-        try:
-            device = adb.device(socket)
-            device.sync.push(str(local), str(remote))
-            success = True
-        except Union[TypeError, RuntimeError, adbutils.AdbError]:
-            pass
+    with SharedSource(local) as source:
+        devices_column = UpdatableTextColumn(f'0/{len(serials)} devices', justify='center', style='bold blue')
+        with Progress(
+                SpinnerColumn(spinner_name='dots', finished_text='✔'),
+                *Progress.get_default_columns(),
+                DownloadColumn(),
+                TransferSpeedColumn(),
+                devices_column
+        ) as progress:
+            push_task = progress.add_task('[yellow bold]Pushing', total=source.size * len(serials))
+
+            def push(serial: str) -> int:
+                def attempt() -> int:
+                    reader = source.reader(lambda n: progress.advance(push_task, n))
+                    try:
+                        return shards.device(serial).sync.push(reader, remote)
+                    except Exception:
+                        progress.advance(push_task, reader.unreported - reader.offset)
+                        raise
+
+                return RetryPolicy.call(attempt)
+
+            for outcome in run_guarded(push, serials, workers):
+                if not isinstance(outcome.error, CircuitOpen):
+                    metrics.observe('push', outcome.item, outcome.elapsed, outcome.value or 0,
+                                    outcome.error is not None)
+                if outcome.error is not None:
+                    progress.console.print(f'[bold red]FAILED[/]: {outcome.item} {outcome.error}')
+                    progress.advance(push_task, source.size)
+                else:
+                    pushed += 1
+                    speed = outcome.value / max(outcome.elapsed, 1e-6) / 1024 ** 2
+                    progress.console.print(f'[bold green]PUSHED[/]: {outcome.item} '
+                                           f'in {outcome.elapsed:.2f}s ({speed:.2f} MB/s)')
+                devices_column.set_text(f'{pushed}/{len(serials)} devices')
 
-    if success is True:
+    if pushed > 0:
         who = socket if socket else 'everyone'
         log(f'[bold green]PUSH:[/] your little file is now property of {who}!')
     else:
         error('[bold red]Something went wrong during the transfer[/]')
 
 
+def push_tree(local: str, remote: str, serials: List[str], workers: int, hashes: bool) -> None:
+    """
+    Synchronizes a local directory into a remote one on all the devices,
+    concurrently, pushing only the files that are new or changed.
+
+    :param local: Local directory
+
+    :param remote: Remote directory
+
+    :param serials: Devices to synchronize
+
+    :param workers: Max number of concurrent devices
+
+    :param hashes: Flag to compare remote md5
+    """
+
+    from rich.progress import Progress, SpinnerColumn
+
+    if not os.path.isdir(local):
+        error(f'[bold red]ERROR:[/] {local} is not a directory.')
+
+    store = DeviceStore()
+    files = dict()
+    with console.status('[yellow]Hashing local files[/]', spinner='dots'):
+        for directory, _, names in os.walk(local):
+            for name in names:
+                path = os.path.abspath(os.path.join(directory, name))
+                files[pathlib.Path(path).relative_to(os.path.abspath(local)).as_posix()] = (store.file_hash(path), path)
+    log(f'[bold green]SYNC:[/] {len(files)} local files')
+
+    synced = 0
+    total = 0
+    with Progress(SpinnerColumn(spinner_name='dots', finished_text='✔'), *Progress.get_default_columns()) as progress:
+        sync_task = progress.add_task('[yellow bold]Synchronizing', total=len(serials))
+        for outcome in run_guarded(lambda serial: sync_tree(serial, files, remote, store, hashes), serials, workers,
+                                   breaker=CircuitBreaker(store)):
+            if outcome.error is not None:
+                progress.console.print(f'[bold red]FAILED[/]: {outcome.item} {outcome.error}')
+            else:
+                synced += 1
+                changed, size, unchanged = outcome.value
+                total += size
+                progress.console.print(f'[bold green]SYNCED[/]: {outcome.item} {changed} pushed '
+                                       f'({size / 1024 ** 2:.2f} MB), {unchanged} unchanged '
+                                       f'in {outcome.elapsed:.2f}s')
+            progress.advance(sync_task)
+
+    if synced > 0:
+        log(f'[bold green]PUSH:[/] {synced}/{len(serials)} devices synchronized, {total / 1024 ** 2:.2f} MB pushed.')
+    else:
+        error('[bold red]Something went wrong during the transfer[/]')
+
+
 @cli.command('pull')
 @click.help_option('-h', '--help')
 @click.argument('socket', nargs=1, required=True)
 @click.argument('remote', nargs=1, required=True)
 @click.argument('local', nargs=1, required=True)
-def pull_file(socket: str, remote: str, local: str) -> None:
+@click.option('-w', '--workers', help='Max number of devices sending the file at the same time',
+              default=default_workers, type=int)
+@click.option('-S', '--select', help='Only the devices whose properties match, e.g. "model=Pixel*,sdk>=30"')
+def pull_file(socket: str, remote: str, local: str, workers: int, select: Optional[str]) -> None:
     """
     Pull a file from the specified remote device into the local one.
+    The socket can also be a comma separated list of devices, or all
+    for every connected device: in that case local is a directory and
+    every copy is written into a sub directory named after its device.
+    The files are streamed to disk concurrently.
 
     :Usage example: python3 main.py pull 192.168.1.10:5555 /sdcard/remote.txt local.txt
 
-    :param socket: Socket address
+    :Usage example: python3 main.py pull all /sdcard/remote.txt ./pulled
+
+    :param socket: Socket address, comma separated addresses or all
 
     :param remote: Remote path/to/file
 
-    :param local: Local path/to/file
-    """
+    :param local: Local path/to/file (or directory)
 
-    devices = get_by_status('device')
+    :param workers: Max number of concurrent devices
 
-    if len(devices) == 0:
-        error('[bold red]No devices connected.[/]')
+    :param select: Selector on the device properties
+    """
 
-    found = False
-    for item in devices:
-        if item.serial == socket:
-            found = True
+    from rich.progress import Progress, SpinnerColumn, TextColumn, DownloadColumn, TransferSpeedColumn
+    from Columns import UpdatableTextColumn
 
-    if not found:
-        error(f'[bold red]{socket} not connected.[/]')
+    if len(registry) == 0:
+        error('[bold red]No devices connected.[/]')
 
     if not pathlib.PurePath(remote).is_absolute():
         error(f'[bold red]PATH ERROR:[/] {remote} is not an absolute path.')
 
-    try:
-        device = adb.device(socket)
-        device.sync.pull(str(remote), str(local))
-    except adbutils.AdbError:
+    filename = pathlib.PurePosixPath(remote).name
+    if socket == 'all':
+        serials = [item.serial for item in get_by_status('device')]
+    else:
+        serials = parse_sockets(socket)
+    if len(serials) == 0:
+        error('[bold red]No devices connected.[/]')
+    serials = select_devices(serials, select, workers)
+
+    if len(serials) == 1 and socket != 'all' and not select:
+        destinations = {serials[0]: os.path.join(local, filename) if os.path.isdir(local) else local}
+    else:
+        destinations = {serial: os.path.join(local, serial_dir(serial), filename) for serial in serials}
+
+    def pull(serial: str) -> int:
+        os.makedirs(os.path.dirname(destinations[serial]) or '.', exist_ok=True)
+        return pull_remote(serial, remote, destinations[serial], lambda n: progress.advance(pull_task, n))
+
+    pulled, size = 0, 0
+    start = time.perf_counter()
+    devices_column = UpdatableTextColumn(f'0/{len(serials)} devices', justify='center', style='bold blue')
+    with Progress(
+            SpinnerColumn(spinner_name='dots', finished_text='✔'),
+            TextColumn('[progress.description]{task.description}'),
+            DownloadColumn(),
+            TransferSpeedColumn(),
+            devices_column
+    ) as progress:
+        pull_task = progress.add_task('[yellow bold]Pulling', total=None)
+
+        for outcome in run_guarded(pull, serials, workers):
+            if outcome.error is not None:
+                progress.console.print(f'[bold red]FAILED[/]: {outcome.item} {outcome.error}')
+            else:
+                pulled += 1
+                size += outcome.value
+                speed = outcome.value / max(outcome.elapsed, 1e-6) / 1024 ** 2
+                progress.console.print(f'[bold green]PULLED[/]: {outcome.item} -> {destinations[outcome.item]} '
+                                       f'{outcome.value / 1024 ** 2:.2f} MB in {outcome.elapsed:.2f}s '
+                                       f'({speed:.2f} MB/s)')
+            devices_column.set_text(f'{pulled}/{len(serials)} devices')
+        progress.update(pull_task, total=progress.tasks[0].completed)
+
+    if pulled == 0:
         error('[bold red]Something went wrong during communication.[/]')
-    log(f'[bold green]SUCCESS:[/] you stole {remote} -> {local} little file.')
+    log(f'[bold green]SUCCESS:[/] you stole {remote} from {pulled}/{len(serials)} devices, '
+        f'{size / 1024 ** 2:.2f} MB in {time.perf_counter() - start:.2f}s.')
 
 
 @cli.command()
 @click.help_option('-h', '--help')
 @click.argument('apk', nargs=1, required=True)
-def install(apk: str) -> None:
+@click.option('-w', '--workers', help='Max number of devices installing at the same time',
+              default=default_workers, type=int)
+@click.option('-f', '--force', help='Install also where the same version is already present', is_flag=True)
+@click.option('-S', '--select', help='Only the devices whose properties match, e.g. "model=Pixel*,sdk>=30"')
+def install(apk: str, workers: int, force: bool, select: Optional[str]) -> None:
     """
     Performs the installation of the given apk on all the connected devices.
     The apk can be bot a path/to/file.apk and url/to/file.apk
+    Devices already running the same version of the package are skipped,
+    unless --force is specified.
 
     :Usage example: python3 main.py install application.apk
 
     :param apk: Apk file
+
+    :param workers: Max number of concurrent devices
+
+    :param force: Flag to install on up-to-date devices too
+
+    :param select: Selector on the device properties
     """
 
-    if len(adb.device_list()) == 0:
+    from rich.progress import track, Progress, SpinnerColumn
+    import requests
+    import apkutils2
+
+    if len(registry) == 0:
         error('[bold red]No devices connected.[/]')
 
     if not apk:
         error('[bold red]You need to provide an apk file.[/]')
 
-    success = False
-    devices = get_by_status('device')
+    with tempfile.TemporaryDirectory() as tmp:
+        if re.match(r'^https?://', apk):
+            with console.status('[yellow]Downloading[/]', spinner='dots'):
+                path = os.path.join(tmp, 'download.apk')
+                with requests.get(apk, stream=True) as response:
+                    response.raise_for_status()
+                    with open(path, 'wb') as f:
+                        shutil.copyfileobj(response.raw, f)
+        elif os.path.isfile(apk):
+            path = apk
+        else:
+            error(f'[bold red]ERROR:[/] {apk} does not exist.')
 
-    for item in track(devices, description='[yellow]Installing items[/]'):
         try:
-            device = adb.device(item.serial)
-            device.install(apk, nolaunch=True, uninstall=True, silent=True)
-            success = True
-        except Union[RuntimeError, TypeError, BrokenPipeError, adbutils.AdbError, adbutils.AdbInstallError]:
-            continue
-    if success is True:
+            manifest = apkutils2.APK(path).manifest
+            package, version = manifest.package_name, int(manifest.version_code)
+        except Exception:
+            error(f'[bold red]ERROR:[/] unable to read the manifest of {apk}.')
+        log(f'[bold green]APK:[/] {package} versionCode {version}')
+
+        serials = select_devices([item.serial for item in get_by_status('device')], select, workers)
+        outdated = serials
+        if not force:
+            outdated = []
+            skipped = 0
+            for outcome in track(run_guarded(lambda serial: installed_version(serial, package), serials, workers),
+                                 total=len(serials), description='[yellow]Checking versions[/]'):
+                if isinstance(outcome.error, CircuitOpen):
+                    skipped += 1
+                elif outcome.error is not None or outcome.value != version:
+                    outdated.append(outcome.item)
+            log(f'[bold blue]UP TO DATE:[/] {len(serials) - len(outdated) - skipped}/{len(serials)} devices')
+            if skipped:
+                log(f'[dim]SKIPPED:[/] {skipped} devices that failed repeatedly in the last runs')
+
+        installed = 0
+        with SharedSource(path) as source, Progress(SpinnerColumn(spinner_name='dots', finished_text='✔'),
+                                                    *Progress.get_default_columns()) as progress:
+            install_task = progress.add_task('[yellow]Installing items[/]', total=len(outdated))
+            for outcome in run_guarded(lambda serial: install_apk(serial, source, package, version),
+                                        outdated, workers):
+                if outcome.error is not None:
+                    progress.console.print(f'[bold red]FAILED[/]: {outcome.item} {outcome.error}')
+                else:
+                    installed += 1
+                    progress.console.print(f'[bold green]INSTALLED[/]: {outcome.item} in {outcome.elapsed:.2f}s')
+                progress.advance(install_task)
+
+    if installed == len(outdated):
         log('[bold green]SUCCESS:[/] your brand new app is now available everywhere!')
+    elif installed > 0:
+        log(f'[bold yellow]PARTIAL:[/] installed on {installed}/{len(outdated)} devices.')
     else:
         error('[bold red]Something went wrong during the installation[/]')
 
 
+@cli.command('snapshot')
+@click.help_option('-h', '--help')
+@click.option('-s', '--socket', help='Specific devices, comma separated (default: all the connected devices)')
+@click.option('-S', '--select', help='Only the devices whose properties match, e.g. "model=Pixel*,sdk>=30"')
+@click.option('-o', '--output', help='Directory of the screenshots and of the contact sheet', default='snapshots')
+@click.option('-f', '--format', 'image_format', help='Format of the screenshots', default='png',
+              type=click.Choice(['png', 'jpg']))
+@click.option('--sheet-only', help='Write only the contact sheet, not the screenshots', is_flag=True)
+@click.option('-t', '--thumb-size', help='Size of the thumbnails of the contact sheet (pixels)', default=160,
+              type=int)
+@click.option('-w', '--workers', help='Max number of devices captured at the same time (each one holds a screen '
+                                      'in memory)', default=16, type=int)
+def snapshot(socket: Optional[str], select: Optional[str], output: str, image_format: str, sheet_only: bool,
+             thumb_size: int, workers: int) -> None:
+    """
+    Captures the screen of the connected devices, concurrently, saving a
+    screenshot per device and a contact sheet with all of them scaled down.
+    The raw framebuffer is read, so the devices do not encode any image.
+
+    :Usage example: python3 main.py snapshot -o whiteboards
+
+    :param socket: Devices to capture
+
+    :param select: Selector on the device properties
+
+    :param output: Output directory
+
+    :param image_format: Format of the screenshots
+
+    :param sheet_only: Flag to skip the screenshots
+
+    :param thumb_size: Size of the thumbnails
+
+    :param workers: Max number of concurrent devices
+    """
+
+    from rich.progress import Progress, SpinnerColumn
+
+    if socket:
+        devices = parse_sockets(socket)
+    else:
+        devices = [item.serial for item in get_by_status('device')]
+
+    if len(devices) == 0:
+        error('[bold red]No devices connected.[/]')
+
+    # captured in the order of the sheet, so its pages are filled one after the other
+    devices = sorted(select_devices(devices, select, workers))
+    os.makedirs(output, exist_ok=True)
+    sheet = ContactSheet(devices, os.path.join(output, 'sheet.jpg'), thumb_size)
+    options = {'compress_level': 1} if image_format == 'png' else {'quality': 90}
+
+    def capture(serial: str) -> 'Image.Image':
+        image = capture_screen(serial)
+        if not sheet_only:
+            image.save(os.path.join(output, f'{serial_dir(serial)}.{image_format}'), **options)
+        image.thumbnail((thumb_size, thumb_size))
+        return image
+
+    captured = 0
+    start = time.perf_counter()
+    with Progress(SpinnerColumn(spinner_name='dots', finished_text='✔'), *Progress.get_default_columns()) as progress:
+        snapshot_task = progress.add_task('[bold yellow]Capturing', total=len(devices))
+        for outcome in run_guarded(capture, devices, workers):
+            if outcome.error is not None:
+                progress.console.print(f'[bold red]FAILED[/]: {outcome.item} {outcome.error}')
+                sheet.add(outcome.item, None, str(outcome.error) or type(outcome.error).__name__)
+            else:
+                captured += 1
+                sheet.add(outcome.item, outcome.value)
+            progress.advance(snapshot_task)
+
+    sheet.close()
+    saved = sheet.paths[0] if len(sheet.paths) == 1 else f'{len(sheet.paths)} pages in {output}'
+    if captured > 0:
+        log(f'[bold green]SNAPSHOT:[/] {captured}/{len(devices)} screens captured in '
+            f'{time.perf_counter() - start:.2f}s, contact sheet saved to {saved}')
+    else:
+        error('[bold red]Something went wrong during the capture[/]')
+
+
 @cli.command()
-@click.option('-s', '--socket', help='Specific device')
-def scrcpy(socket) -> None:
+@click.help_option('-h', '--help')
+@click.option('-s', '--socket', help='Specific devices, comma separated')
+@click.option('-p', '--preset', help='Quality of the mirrors (auto lowers it as more mirrors run)', default='auto',
+              type=click.Choice(preset_names))
+@click.option('-n', '--max-sessions', help='Max number of mirrors running at once', default=4, type=int)
+def scrcpy(socket: Optional[str], preset: str, max_sessions: int) -> None:
     """
     Launches a textual app with a list of connected sockets.
-    Clicking on a socket panel it will automatically start scrcpy for that device
+    Clicking on a socket panel it will automatically start scrcpy for that device,
+    clicking it again closes the mirror
 
     :Usage example: python3 main.py scrcpy
 
-    :param socket: Specific socket to display
+    :param socket: Specific sockets to mirror without the app
+
+    :param preset: Bitrate and size preset of the mirrors
+
+    :param max_sessions: Max number of mirrors running at once
     """
 
+    import asyncio
+
     if not socket:
-        Display.run()
-    else:
-        with console.status('[yellow]Executing[/]', spinner='dots'):
-            subprocess.run(['scrcpy', f'--tcpip={socket}'], capture_output=True)
-        log('[bold green]DONE[/]')
+        from Display import Display
+
+        Display.run(preset=preset, limit=max_sessions)
+        return
+
+    def report(session: Session) -> None:
+        if session.serial in manager:
+            log(f'[bold green]MIRRORING:[/] {session.serial} ({session.preset})')
+        elif session.error is not None:
+            log(f'[bold red]FAILED:[/] {session.serial}: {session.error}')
+        else:
+            log(f'[bold yellow]CLOSED:[/] {session.serial}')
+
+    async def mirror(serials: List[str]) -> None:
+        for serial in serials:
+            try:
+                await manager.start(serial)
+            except SessionLimit as e:
+                log(f'[bold yellow]SKIPPED:[/] {serial}: {e}')
+            except OSError as e:
+                error(f'[bold red]ERROR:[/] cannot run scrcpy: {e.strerror}')
+        await manager.wait()
+
+    serials = parse_sockets(socket, connect=True)
+    if len(serials) == 0:
+        error('[bold red]No devices connected.[/]')
+    manager = MirrorManager(max_sessions, preset, on_change=report)
+    asyncio.run(mirror(serials))
+    log('[bold green]DONE[/]')
+
+
+@cli.command('serve')
+@click.help_option('-h', '--help')
+@click.option('-i', '--interval', help='Seconds between two health probes of the devices', default=5.0,
+              type=float)
+def serve(interval: float) -> None:
+    """
+    Starts a daemon that keeps the device registry and all the modules warm.
+    While it is running, exec, broad-cmd, run-script, push and show are forwarded to it
+    through a unix socket inside the cache directory, and every device is
+    probed periodically by the health monitor.
+
+    :Usage example: python3 main.py serve
+
+    :param interval: Seconds between two probe rounds
+    """
+
+    Daemon.serve(cli, interval)
 
 
 @cli.command('clear')
@@ -458,12 +1227,17 @@ def kill_server() -> None:
     """Emulates the adb kill-server command. All the devices will be disconnected from this adb session."""
 
     devices = get_by_status('device')
+    store = DeviceStore()
     with console.status('[yellow]Disconnecting[/]', spinner='dots'):
         for item in devices:
             try:
-                adb.disconnect(item.serial)
+                shards.owner(item.serial).disconnect(item.serial)
             except adbutils.AdbError:
                 continue
+            if ':' in item.serial:
+                # tells the health monitor of the daemon not to reconnect it
+                store.record(item.serial, 'disconnected', 0.0)
+    registry.invalidate()
     log('[bold red]DISCONNECTED:[/] everything fine, but now you are alone.')
 
 
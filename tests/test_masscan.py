@@ -0,0 +1,48 @@
+import io
+import json
+
+import pytest
+
+from Utils import iter_masscan
+
+records = [{'ip': f'10.0.0.{i}', 'timestamp': str(1600000000 + i),
+            'ports': [{'port': 5555, 'proto': 'tcp', 'status': 'open', 'reason': 'syn-ack', 'ttl': 64}]}
+           for i in range(1, 21)]
+
+
+def array_format() -> str:
+    return '[\n' + ''.join(json.dumps(record) + ',\n' for record in records) + ']\n'
+
+
+def line_format() -> str:
+    return ''.join(json.dumps(record) + '\n' for record in records)
+
+
+@pytest.mark.parametrize('text', [array_format(), line_format()])
+@pytest.mark.parametrize('chunk_size', [1, 7, 64, 1024 * 1024])
+def test_formats_and_chunks(text, chunk_size):
+    assert list(iter_masscan(io.StringIO(text), chunk_size)) == records
+
+
+def test_empty():
+    assert list(iter_masscan(io.StringIO(''))) == []
+    assert list(iter_masscan(io.StringIO('[\n]\n'))) == []
+
+
+def test_record_split_across_chunks():
+    text = json.dumps(records[0]) + '\n' + json.dumps(records[1])
+    assert list(iter_masscan(io.StringIO(text), len(text) // 2)) == records[:2]
+
+
+def test_lazy():
+    stream = io.StringIO(line_format())
+    parsed = iter_masscan(stream, 64)
+    assert next(parsed) == records[0]
+    assert stream.tell() < len(stream.getvalue())
+
+
+def test_truncated():
+    text = array_format()[:-40]
+    parsed = iter_masscan(io.StringIO(text), 16)
+    with pytest.raises(json.JSONDecodeError):
+        list(parsed)
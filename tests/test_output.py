@@ -0,0 +1,61 @@
+import gzip
+import json
+
+import pytest
+
+from Utils import OutputSink
+
+
+def read_records(path):
+    opener = gzip.open if str(path).endswith('.gz') else open
+    with opener(path, 'rt') as f:
+        return [json.loads(line) for line in f]
+
+
+def test_ndjson(tmp_path):
+    path = tmp_path / 'out.ndjson'
+    with OutputSink(str(path), 'uptime', limit=8) as sink:
+        with sink.device('10.0.0.1:5555') as output:
+            output.write(b'up 3 ')
+            output.write(b'days, 2 users')
+            output.returncode = 0
+        with sink.device('emulator-5554') as output:
+            output.write(b'ok')
+            output.returncode = 1
+    first, second = read_records(path)
+    assert first['serial'] == '10.0.0.1:5555' and first['command'] == 'uptime'
+    assert (first['output'], first['bytes'], first['truncated'], first['returncode']) == ('up 3 day', 18, True, 0)
+    assert (second['output'], second['truncated'], second['returncode'], second['error']) == ('ok', False, 1, None)
+
+
+def test_error_is_recorded(tmp_path):
+    path = tmp_path / 'out.jsonl'
+    with OutputSink(str(path), 'ls') as sink:
+        with pytest.raises(ConnectionResetError):
+            with sink.device('10.0.0.1:5555') as output:
+                output.write(b'partial')
+                raise ConnectionResetError('reset')
+    record, = read_records(path)
+    assert (record['output'], record['returncode'], record['error']) == ('partial', None, 'reset')
+
+
+def test_directory(tmp_path):
+    directory = tmp_path / 'out'
+    with OutputSink(str(directory), 'dumpsys', limit=4) as sink:
+        with sink.device('10.0.0.1:5555') as output:
+            output.write(b'a long output, not truncated')
+            output.returncode = 0
+    record, = read_records(directory / 'index.ndjson')
+    assert record['file'] == '10.0.0.1_5555.out' and 'output' not in record
+    assert (directory / record['file']).read_bytes() == b'a long output, not truncated'
+
+
+def test_gzip(tmp_path):
+    path = tmp_path / 'out.ndjson.gz'
+    with OutputSink(str(path), 'id') as sink:
+        with sink.device('emulator-5554') as output:
+            output.write(b'uid=0(root)')
+            output.returncode = 0
+    assert sink.compress == 'gzip'
+    record, = read_records(path)
+    assert record['output'] == 'uid=0(root)'
@@ -0,0 +1,170 @@
+import errno
+
+import adbutils
+import pytest
+
+import Utils
+from Utils import RetryPolicy, CircuitBreaker, CircuitOpen, run_guarded
+
+
+class FakeStore:
+    def __init__(self):
+        self.saved = dict()
+
+    def breakers(self):
+        return dict()
+
+    def save_breakers(self, states):
+        self.saved.update({serial: list(state) for serial, state in states.items()})
+
+
+@pytest.fixture(autouse=True)
+def no_delay(monkeypatch):
+    monkeypatch.setattr(RetryPolicy, 'delay', 0.0)
+
+
+@pytest.mark.parametrize('error', [
+    ConnectionResetError(), ConnectionRefusedError(), TimeoutError(), adbutils.AdbTimeout('timed out'),
+    OSError(errno.EHOSTUNREACH, 'No route to host'), adbutils.AdbError("device '10.0.0.1:5555' not found"),
+    adbutils.AdbError('device offline'), adbutils.AdbError('closed'),
+])
+def test_transient(error):
+    assert RetryPolicy.transient(error)
+
+
+@pytest.mark.parametrize('error', [
+    FileNotFoundError(errno.ENOENT, 'No such file'), PermissionError(errno.EACCES, 'Permission denied'),
+    adbutils.AdbError('No such file or directory', '/sdcard/missing'), adbutils.AdbInstallError('INSTALL_FAILED'),
+    ValueError('bad value'),
+])
+def test_not_transient(error):
+    assert not RetryPolicy.transient(error)
+
+
+def test_rejected():
+    assert RetryPolicy.rejected(ConnectionRefusedError())
+    assert RetryPolicy.rejected(adbutils.AdbError('device offline'))
+    assert not RetryPolicy.rejected(ConnectionResetError())
+    assert not RetryPolicy.rejected(adbutils.AdbTimeout('timed out'))
+
+
+def test_call_retries_transient_errors():
+    attempts = []
+
+    def flaky():
+        attempts.append(None)
+        if len(attempts) < 3:
+            raise ConnectionResetError()
+        return 'done'
+
+    assert RetryPolicy.call(flaky) == 'done'
+    assert len(attempts) == 3
+
+
+def test_call_gives_up():
+    attempts = []
+
+    def broken():
+        attempts.append(None)
+        raise ConnectionResetError('reset')
+
+    with pytest.raises(ConnectionResetError, match='reset'):
+        RetryPolicy.call(broken)
+    assert len(attempts) == RetryPolicy.tries
+
+
+def test_call_does_not_retry_request_errors():
+    attempts = []
+
+    def missing():
+        attempts.append(None)
+        raise adbutils.AdbError('No such file or directory', '/sdcard/missing')
+
+    with pytest.raises(adbutils.AdbError):
+        RetryPolicy.call(missing)
+    assert len(attempts) == 1
+
+
+def test_breaker_opens_after_threshold():
+    breaker = CircuitBreaker(FakeStore())
+    for _ in range(CircuitBreaker.threshold - 1):
+        breaker.record('dead', False)
+    breaker.check('dead')
+    breaker.record('dead', False)
+    with pytest.raises(CircuitOpen):
+        breaker.check('dead')
+
+
+def test_breaker_cooldown_doubles(monkeypatch):
+    clock = [1000.0]
+    monkeypatch.setattr(Utils.time, 'time', lambda: clock[0])
+    breaker = CircuitBreaker(FakeStore())
+    for _ in range(CircuitBreaker.threshold):
+        breaker.record('dead', False)
+    assert breaker.states['dead'][2] == 1000.0 + CircuitBreaker.cooldown
+
+    clock[0] += CircuitBreaker.cooldown + 1
+    breaker.check('dead')
+    breaker.record('dead', False)
+    assert breaker.states['dead'][2] == clock[0] + 2 * CircuitBreaker.cooldown
+
+
+def test_breaker_success_resets():
+    store = FakeStore()
+    breaker = CircuitBreaker(store)
+    for _ in range(CircuitBreaker.threshold):
+        breaker.record('flaky', False)
+    breaker.record('flaky', True)
+    breaker.check('flaky')
+    breaker.save()
+    assert store.saved == {'flaky': [0, 0, 0.0]}
+
+
+def test_breaker_disabled(monkeypatch):
+    monkeypatch.setattr(CircuitBreaker, 'enabled', False)
+    breaker = CircuitBreaker(FakeStore())
+    for _ in range(CircuitBreaker.threshold):
+        breaker.record('dead', False)
+    breaker.check('dead')
+
+
+def test_run_guarded_skips_open_breakers():
+    breaker = CircuitBreaker(FakeStore())
+    for _ in range(CircuitBreaker.threshold):
+        breaker.record('dead', False)
+    outcomes = {outcome.item: outcome for outcome in run_guarded(str.upper, ['dead', 'alive'], breaker=breaker)}
+    assert isinstance(outcomes['dead'].error, CircuitOpen)
+    assert outcomes['alive'].value == 'ALIVE'
+
+
+def test_run_guarded_ignores_request_errors():
+    def operation(serial):
+        if serial == 'unreachable':
+            raise ConnectionResetError()
+        raise adbutils.AdbError('No such file or directory', '/sdcard/missing')
+
+    store = FakeStore()
+    breaker = CircuitBreaker(store)
+    for _ in range(CircuitBreaker.threshold):
+        list(run_guarded(operation, ['unreachable', 'missing'], breaker=breaker))
+    assert store.saved['unreachable'][0] == CircuitBreaker.threshold
+    assert 'missing' not in store.saved
+
+
+def test_run_guarded_closes_its_store(monkeypatch, tmp_path):
+    monkeypatch.setenv('XDG_CACHE_HOME', str(tmp_path))
+    stores = []
+
+    class Store(Utils.DeviceStore):
+        def __init__(self, *args):
+            super().__init__(*args)
+            self.closed = False
+            stores.append(self)
+
+        def close(self):
+            super().close()
+            self.closed = True
+
+    monkeypatch.setattr(Utils, 'DeviceStore', Store)
+    assert [outcome.value for outcome in run_guarded(str.upper, ['a'])] == ['A']
+    assert len(stores) == 1 and stores[0].closed
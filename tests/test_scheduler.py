@@ -0,0 +1,85 @@
+import heapq
+import random
+
+import pytest
+
+from Utils import Scheduler, Outcome
+
+
+def simulate(capacity: int, jobs: int = 1500, workers: int = 128, offline: float = 0.0, seed: int = 1):
+    """
+    Runs jobs through a Scheduler against a simulated network: a job started
+    while capacity jobs are in flight, or on an offline host, times out after
+    1s, the others succeed in about 0.1s.
+
+    :return: the limit after every job and the number of failed jobs
+    """
+
+    rnd = random.Random(seed)
+    scheduler = Scheduler(workers)
+    clock, running, limits, failures, started = 0.0, [], [], 0, 0
+    while started < jobs or running:
+        while started < jobs and len(running) < int(scheduler.limit):
+            timeout = len(running) >= capacity or rnd.random() < offline
+            sequence, subnet = scheduler.start(None)
+            duration = 1.0 if timeout else rnd.uniform(0.08, 0.12)
+            heapq.heappush(running, (clock + duration, sequence, subnet, timeout))
+            started += 1
+        clock, sequence, subnet, timeout = heapq.heappop(running)
+        scheduler.finish(Outcome(sequence, 'timeout' if timeout else 'connected', None, duration), sequence, subnet)
+        limits.append(scheduler.limit)
+        failures += timeout
+    return limits, failures
+
+
+@pytest.mark.parametrize('capacity', [4, 16, 40])
+def test_limit_stays_near_capacity(capacity):
+    limits, failures = simulate(capacity)
+    tail = limits[len(limits) // 2:]
+    assert capacity / 2 <= sum(tail) / len(tail) <= capacity * 1.5
+    assert failures < 1500 / 3
+
+
+@pytest.mark.parametrize('seed', [1, 2])
+def test_offline_sweep_is_not_congestion(seed):
+    limits, failures = simulate(10000, offline=0.9, seed=seed)
+    tail = limits[len(limits) // 2:]
+    assert sum(tail) / len(tail) > 100
+
+
+def test_no_failures_reach_the_ceiling():
+    limits, failures = simulate(10000)
+    assert failures == 0
+    assert limits[-1] == 128
+
+
+def test_burst_cuts_once():
+    scheduler = Scheduler(64)
+    jobs = [scheduler.start(None) for _ in range(8)]
+    for sequence, subnet in jobs:
+        scheduler.finish(Outcome(sequence, 'timeout', None, 1.0), sequence, subnet)
+    assert scheduler.limit == pytest.approx(8 * scheduler.backoff)
+    assert not scheduler.slow_start
+
+
+def test_latency():
+    scheduler = Scheduler(64, latency=True)
+    for _ in range(60):
+        sequence, subnet = scheduler.start(None)
+        scheduler.finish(Outcome(sequence, 'connected', None, 0.1), sequence, subnet)
+    assert scheduler.limit == 64
+    for _ in range(5):
+        sequence, subnet = scheduler.start(None)
+        scheduler.finish(Outcome(sequence, 'connected', None, 0.5), sequence, subnet)
+    assert scheduler.limit < 64
+
+
+def test_fixed():
+    class Fixed(Scheduler):
+        adaptive = False
+
+    scheduler = Fixed(32)
+    sequence, subnet = scheduler.start('10.0.0')
+    scheduler.finish(Outcome(sequence, 'timeout', None, 1.0), sequence, subnet)
+    assert scheduler.limit == 32
+    assert scheduler.subnets['10.0.0'] == 0
@@ -0,0 +1,47 @@
+import subprocess
+
+from Utils import Script, ScriptResult
+
+
+def run(script: Script) -> str:
+    return subprocess.run(['sh'], input=script.source(), capture_output=True, text=True).stdout
+
+
+def test_load(tmp_path):
+    path = tmp_path / 'runbook.sh'
+    path.write_text('# comment\nuptime\n\n  # indented comment\n  cd /sdcard  \n')
+    assert Script.load(str(path)).commands == ['uptime', 'cd /sdcard']
+
+
+def test_parse():
+    script = Script(['echo one', 'false', 'printf two'])
+    output = f'one\n\n{script.marker} 0 0\n\n{script.marker} 1 1\ntwo\n{script.marker} 2 0\n'
+    assert script.parse(output) == [ScriptResult('echo one', 'one\n', 0), ScriptResult('false', '', 1),
+                                    ScriptResult('printf two', 'two', 0)]
+
+
+def test_parse_early_exit():
+    script = Script(['echo one', 'exit 3', 'echo two'])
+    output = f'one\n{script.marker} 0 0\nbye\n'
+    assert script.parse(output) == [ScriptResult('echo one', 'one', 0), ScriptResult('exit 3', 'bye\n', None),
+                                    ScriptResult('echo two', '', None)]
+
+
+def test_parse_ignores_other_markers():
+    script = Script(['echo pyadb-0000000000000000 0 0'])
+    output = f'pyadb-0000000000000000 0 0\n{script.marker} 0 0\n'
+    assert script.parse(output) == [ScriptResult('echo pyadb-0000000000000000 0 0', 'pyadb-0000000000000000 0 0', 0)]
+
+
+def test_session_keeps_state():
+    script = Script(['cd /', 'pwd', 'x=1', 'echo $x', 'read line; echo "[$line]"', 'sh -c "exit 7"'])
+    results = script.parse(run(script))
+    assert [result.output for result in results] == ['', '/\n', '', '1\n', '[]\n', '']
+    assert [result.returncode for result in results] == [0, 0, 0, 0, 0, 7]
+
+
+def test_session_exit():
+    script = Script(['echo one', 'exit 3', 'echo two'])
+    results = script.parse(run(script))
+    assert results[0] == ScriptResult('echo one', 'one\n', 0)
+    assert [result.returncode for result in results[1:]] == [None, None]
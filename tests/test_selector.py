@@ -0,0 +1,45 @@
+import pytest
+
+from Utils import Selector
+
+pixel = {'ro.product.model': 'Pixel 7', 'ro.product.manufacturer': 'Google', 'ro.build.version.sdk': '33',
+         'ro.product.cpu.abi': 'arm64-v8a', 'ro.build.version.release': '13'}
+galaxy = {'ro.product.model': 'SM-A515F', 'ro.product.manufacturer': 'samsung', 'ro.build.version.sdk': '9',
+          'ro.product.cpu.abi': 'armeabi-v7a', 'ro.build.version.release': '9'}
+
+
+@pytest.mark.parametrize('expression, expected', [
+    ('model=Pixel 7', [True, False]),
+    ('model=Pixel*', [True, False]),
+    ('model=Pixel 6*|Pixel 7*', [True, False]),
+    ('manufacturer!=samsung', [True, False]),
+    ('ro.product.model=SM-*', [False, True]),
+    ('abi~^arm64', [True, False]),
+    ('sdk>=30', [True, False]),
+    ('sdk>10', [True, False]),
+    ('sdk<10', [False, True]),
+    ('sdk<=9', [False, True]),
+    ('android>=10', [True, False]),
+    ('manufacturer=samsung,sdk>=30', [False, False]),
+    ('abi!=x86*, sdk>=9', [True, True]),
+])
+def test_matches(expression, expected):
+    selector = Selector(expression)
+    assert [selector.matches(properties) for properties in (pixel, galaxy)] == expected
+
+
+def test_missing_property():
+    assert not Selector('ro.vendor.missing=x').matches(pixel)
+    assert not Selector('ro.vendor.missing>1').matches(pixel)
+    assert Selector('ro.vendor.missing!=x').matches(pixel)
+
+
+def test_strings_compared_as_text():
+    assert Selector('model>Pixel 6').matches(pixel)
+    assert not Selector('model<Pixel').matches(pixel)
+
+
+@pytest.mark.parametrize('expression', ['model', 'my prop=1', '=Pixel', 'abi~[arm', 'model=Pixel,'])
+def test_invalid(expression):
+    with pytest.raises(ValueError):
+        Selector(expression)
@@ -0,0 +1,41 @@
+import pytest
+
+import Utils
+from Utils import parse_sockets
+
+
+class FakeRegistry(set):
+    def invalidate(self):
+        pass
+
+
+@pytest.fixture
+def registry(monkeypatch):
+    registry = FakeRegistry({'emulator-5554', '10.0.0.1:5555'})
+    monkeypatch.setattr(Utils, 'registry', registry)
+    monkeypatch.setattr(Utils, 'log', lambda string, end='\n': None)
+    return registry
+
+
+def test_connected(registry):
+    assert parse_sockets('10.0.0.1:5555, emulator-5554,,10.0.0.1:5555') == ['10.0.0.1:5555', 'emulator-5554']
+
+
+def test_not_connected(registry, monkeypatch):
+    logged = []
+    monkeypatch.setattr(Utils, 'log', lambda string, end='\n': logged.append(string))
+    assert parse_sockets('emulator-5554,10.0.0.2:5555') == ['emulator-5554']
+    assert logged == ['[bold red]10.0.0.2:5555 not connected.[/]']
+
+
+def test_connect(registry, monkeypatch):
+    connected = []
+
+    def connect_device(addr, timeout=2.0):
+        connected.append(addr)
+        registry.add(addr)
+        return 'connected'
+
+    monkeypatch.setattr(Utils, 'connect_device', connect_device)
+    assert parse_sockets('10.0.0.2:5555,emulator-5556', connect=True) == ['10.0.0.2:5555']
+    assert connected == ['10.0.0.2:5555']